@@ -2,143 +2,333 @@ import os
 import pickle
 import shutil
 import argparse
+import multiprocessing
 
 import numpy as np
 import torch
 
-from PIL import Image, ImageDraw
+from PIL import Image
+from dl4cv.dataset.utils import render_frames, create_packed_dataset, open_packed_dataset, open_packed_frames, \
+    resize_packed_dataset, is_packed_dataset, create_sequence_index, save_ground_truths, SEQUENCE_INDEX, \
+    CONSOLIDATED_GROUND_TRUTH
 from dl4cv.eval.eval_functions import analyze_dataset
 from dl4cv.utils import str2bool
 
+# Lists the completed shards of a dataset
+MANIFEST = 'manifest.txt'
+
+# Parameters that have to match the stored config to resume or extend a dataset
+RESUME_PARAMETERS = ['seed', 'shard_size', 'len_sequence', 'window_size_x', 'window_size_y', 'ball_radius', 't_frame',
+                     'packed', 'anti_aliasing', 'avoid_collisions', 'feasible_sampling', 'x_min_sampling',
+                     'x_max_sampling', 'y_min_sampling', 'y_max_sampling', 'vx_limit', 'vy_limit', 'ax_limit',
+                     'ay_limit', 'fraction', 'resolutions']
+
 
 def generate_data(c):
 
-    c.x_min = c.ball_radius
-    c.x_max = c.window_size_x - c.ball_radius
-    c.y_min = c.ball_radius
-    c.y_max = c.window_size_y - c.ball_radius
+    init_config(c)
+
+    if c.resolution_list and not c.packed:
+        raise Exception('Additional resolutions are only supported for packed datasets, use --packed True')
+
+    # Sample the trajectories shard by shard. Every shard gets its own seed, so the dataset only depends on the seed
+    # and the shard size but not on the number of workers that render it
+    shards = []
+
+    for i_shard, i_start in enumerate(range(0, c.num_sequences, c.shard_size)):
+        num_sequences = min(c.shard_size, c.num_sequences - i_start)
+
+        shards.append((i_start,) + sample_trajectories(c, num_sequences, get_shard_seed(c.seed, i_shard)))
+
+    if c.eval_before_saving:
+        # Analyze the dataset shard by shard
+        analyze_dataset(
+            (stack_ground_truth(*shard[1:]).numpy() for shard in shards),
+            window_size_x=c.window_size_x,
+            window_size_y=c.window_size_y,
+            mode=c.mode
+        )
+
+    if c.save:
+        if c.resume and os.path.exists(os.path.join(c.save_dir_path, 'config.p')):
+            # Continue or extend the existing dataset
+            completed_shards = load_manifest(c)
+
+            # The index and the consolidated ground truth only get written again once all sequences exist
+            for file_name in [] if c.packed else [SEQUENCE_INDEX, CONSOLIDATED_GROUND_TRUTH]:
+                if os.path.exists(os.path.join(c.save_dir_path, file_name)):
+                    os.remove(os.path.join(c.save_dir_path, file_name))
+        else:
+            # delete old dataset
+            if os.path.exists(c.save_dir_path):
+                shutil.rmtree(c.save_dir_path)
+
+            completed_shards = {}
+
+        # Create folder
+        os.makedirs(c.save_dir_path, exist_ok=True)
+
+        # Save configuration
+        with open(os.path.join(c.save_dir_path, 'config.p'), 'wb') as f:
+            pickle.dump(c, f)
+
+        if c.packed:
+            if is_packed_dataset(c.save_dir_path):
+                resize_packed_dataset(c.save_dir_path, c.num_sequences)
+            else:
+                create_packed_dataset(c.save_dir_path, c.num_sequences, c.len_sequence, c.window_size_x,
+                                      c.window_size_y, resolutions=c.resolution_list)
+
+        # Shards that were completed with the same number of sequences don't have to be generated again
+        num_shards = len(shards)
+        shards_to_save = [(i_shard, shard) for i_shard, shard in enumerate(shards)
+                          if completed_shards.get(i_shard) != shard[1].shape[0]]
+
+        if completed_shards:
+            print("Skipping {} of {} shards that are already completed".format(
+                num_shards - len(shards_to_save), num_shards))
+
+        # Render and save the shards. Limit every worker to one thread to not oversubscribe the cores
+        if c.num_workers > 1:
+            tasks = [(c,) + shard for shard in shards_to_save]
+
+            with multiprocessing.Pool(c.num_workers, initializer=torch.set_num_threads, initargs=(1,)) as pool:
+                for i_shard, num_sequences in pool.imap_unordered(save_shard, tasks):
+                    add_to_manifest(c.save_dir_path, i_shard, num_sequences)
+        else:
+            for shard in shards_to_save:
+                add_to_manifest(c.save_dir_path, *save_shard((c,) + shard))
+
+        if not c.packed:
+            create_sequence_index(c.save_dir_path, c.num_sequences, c.len_sequence)
+            save_ground_truths(c.save_dir_path, np.concatenate(
+                [stack_ground_truth(*shard[1:]).numpy() for shard in shards]).astype(np.float64))
 
-    c.latent_names = ['px', 'py']
 
-    # create image to draw on
-    img = Image.new(mode="L", size=(c.window_size_x, c.window_size_y))
-    # create screen
-    screen = ImageDraw.Draw(img)
+def sample_trajectories(c, num_sequences, seed, verbose=True):
+
+    torch.manual_seed(seed)
 
     # Initialize x,y,vx,vy,ax,ay
-    x_start, y_start, vx_start, vy_start, x_end, y_end, ax, ay = [torch.zeros((c.num_sequences,)) for i in range(8)]
+    x_start, y_start, vx_start, vy_start, ax, ay = [torch.zeros((num_sequences,)) for i in range(6)]
+    x, y, vx, vy = [torch.zeros((num_sequences, c.len_sequence)) for i in range(4)]
 
-    collisions = np.ones((c.num_sequences))
+    collisions = np.ones((num_sequences))
 
     i_run = 0
+    num_rejections = 0
 
-    # Generate Trajectories for all the sequences
+    # Generate Trajectories for all the sequences. Only the rejected sequences get resampled and recomputed
     while collisions.any():
         i_run += 1
 
         idx = collisions.nonzero()[0]
 
-        x_start[idx] = torch.rand_like(torch.Tensor(idx)) * (c.x_max_sampling - c.x_min_sampling) + c.x_min_sampling
-        y_start[idx] = torch.rand_like(torch.Tensor(idx)) * (c.y_max_sampling - c.y_min_sampling) + c.y_min_sampling
+        if not c.feasible_sampling:
+            x_start[idx] = torch.rand_like(torch.Tensor(idx)) * (c.x_max_sampling - c.x_min_sampling) + c.x_min_sampling
+            y_start[idx] = torch.rand_like(torch.Tensor(idx)) * (c.y_max_sampling - c.y_min_sampling) + c.y_min_sampling
 
         if c.vx_limit != 0:
-            vx_start[idx] = sample_near_limit(idx, c.vx_limit, c.fraction, i_run*c.seed)
+            vx_start[idx] = sample_near_limit(idx, c.vx_limit, c.fraction, i_run*seed)
             if 'vx' not in c.latent_names:
                 c.latent_names.append('vx')
 
         if c.vy_limit != 0:
-            vy_start[idx] = sample_near_limit(idx, c.vy_limit, c.fraction, (i_run + 1)*c.seed)
+            vy_start[idx] = sample_near_limit(idx, c.vy_limit, c.fraction, (i_run + 1)*seed)
             if 'vy' not in c.latent_names:
                 c.latent_names.append('vy')
 
         if c.ax_limit != 0:
-            ax[idx] = sample_near_limit(idx, c.ax_limit, c.fraction, (i_run + 2)*c.seed)
+            ax[idx] = sample_near_limit(idx, c.ax_limit, c.fraction, (i_run + 2)*seed)
             if 'ax' not in c.latent_names:
                 c.latent_names.append('ax')
 
         if c.ay_limit != 0:
-            ay[idx] = sample_near_limit(idx, c.ay_limit, c.fraction, (i_run+3)*c.seed)
+            ay[idx] = sample_near_limit(idx, c.ay_limit, c.fraction, (i_run+3)*seed)
             if 'ay' not in c.latent_names:
                 c.latent_names.append('ay')
 
-        x, y, vx, vy = get_trajectories(x_start, y_start, vx_start, vy_start, ax, ay, c.t_frame,
-                                        c.len_sequence)
+        if c.feasible_sampling:
+            # Sample the start positions only where the whole trajectory stays inside the window
+            t_end = (c.len_sequence - 1) * c.t_frame
+
+            x_start[idx], x_feasible = sample_feasible_start(vx_start[idx], ax[idx], t_end, c.x_min, c.x_max,
+                                                             c.x_min_sampling, c.x_max_sampling)
+            y_start[idx], y_feasible = sample_feasible_start(vy_start[idx], ay[idx], t_end, c.y_min, c.y_max,
+                                                             c.y_min_sampling, c.y_max_sampling)
+
+        x[idx], y[idx], vx[idx], vy[idx] = get_trajectories(x_start[idx], y_start[idx], vx_start[idx], vy_start[idx],
+                                                            ax[idx], ay[idx], c.t_frame, c.len_sequence)
+
+        collisions_idx = get_collisions(x[idx], y[idx], c.x_min, c.x_max, c.y_min, c.y_max)
+
+        if c.feasible_sampling:
+            # Velocities and accelerations without any feasible start position have to be resampled
+            collisions_idx[~(x_feasible & y_feasible).numpy()] = 1
 
-        collisions = get_collisions(x, y, c.x_min, c.x_max, c.y_min, c.y_max)
+        collisions = np.zeros((num_sequences))
+        collisions[idx] = collisions_idx
 
         if c.avoid_collisions:
-            print("{} collisions of {} sequences".format(collisions.sum(), c.num_sequences))
+            num_rejections += int(collisions_idx.sum())
+            if verbose:
+                print("{} collisions of {} sampled sequences".format(collisions_idx.sum(), len(idx)))
         else:
-            print("No collision avoidance... but we had {} in {} sequences".format(
-                collisions.sum(), c.num_sequences)
-            )
-            collisions = np.zeros((c.num_sequences))
+            if verbose:
+                print("No collision avoidance... but we had {} in {} sequences".format(
+                    collisions.sum(), num_sequences)
+                )
+            collisions = np.zeros((num_sequences))
 
-    if c.eval_before_saving:
-        trajectories = np.zeros((c.num_sequences, c.len_sequence, 6))
+    if verbose:
+        print("Sampled {} sequences in {} passes with {} rejections".format(num_sequences, i_run, num_rejections))
 
-        trajectories[:, :, 0] = x
-        trajectories[:, :, 1] = y
-        trajectories[:, :, 2] = vx
-        trajectories[:, :, 3] = vy
-        trajectories[:, :, 4] = np.repeat(ax.reshape(-1, 1), c.len_sequence, 1)
-        trajectories[:, :, 5] = np.repeat(ay.reshape(-1, 1), c.len_sequence, 1)
+    return x, y, vx, vy, ax, ay
 
-        analyze_dataset(
-            trajectories,
-            window_size_x=c.window_size_x,
-            window_size_y=c.window_size_y,
-            mode=c.mode
-        )
 
-    if c.save:
-        # delete old dataset
-        if os.path.exists(c.save_dir_path):
-            shutil.rmtree(c.save_dir_path)
+def sample_feasible_start(v_0, a, t_end, p_min, p_max, p_min_sampling, p_max_sampling):
+    # The displacement v_0*t + 0.5*a*t^2 is a parabola. Its extrema over [0, t_end] lie at the borders of the interval
+    # or at the vertex t = -v_0/a. Derive the start positions that keep the whole trajectory inside [p_min, p_max]
+    t_vertex = torch.where(a == 0, torch.zeros_like(a), -v_0 / a).clamp(0, t_end)
 
-        # Create folder
-        os.makedirs(c.save_dir_path, exist_ok=True)
+    displacements = torch.stack([
+        torch.zeros_like(v_0),
+        v_0 * t_end + 0.5 * a * t_end * t_end,
+        v_0 * t_vertex + 0.5 * a * t_vertex * t_vertex
+    ])
 
-        # Save configuration
-        with open(os.path.join(c.save_dir_path, 'config.p'), 'wb') as f:
-            pickle.dump(c, f)
+    low = (p_min - displacements.min(dim=0).values).clamp(min=p_min_sampling)
+    high = (p_max - displacements.max(dim=0).values).clamp(max=p_max_sampling)
+
+    feasible = low <= high
+
+    return torch.rand_like(low) * (high - low) + low, feasible
+
+
+def get_shard_seed(seed, i_shard):
+    # Derive a distinct seed for every shard from the global seed
+    return seed * 100003 + i_shard
+
+
+def save_sequences(c, i_start, x, y, vx, vy, ax, ay):
+    # Render and save the sequences of one shard to seq{i_start} ... seq{i_start + len(x) - 1}
 
-        # Generate frames for the sequences
-        for i_sequence in range(c.num_sequences):
+    if c.packed:
+        frames_packed, ground_truth_packed = open_packed_dataset(c.save_dir_path, mmap_mode='r+')
+        frames_pyramid = {resolution: open_packed_frames(c.save_dir_path, mmap_mode='r+', resolution=resolution)
+                          for resolution in c.resolution_list}
 
-            save_path_sequence = os.path.join(
-                c.save_dir_path,
-                'seq' + str(i_sequence)
-            )
+    # Render blocks of sequences at once to limit the memory footprint
+    for i_block in range(0, x.shape[0], c.render_block_size):
+        block = slice(i_block, min(i_block + c.render_block_size, x.shape[0]))
 
-            os.makedirs(save_path_sequence, exist_ok=True)
+        frames = render_frames(x[block], y[block], c.window_size_x, c.window_size_y, c.ball_radius,
+                               anti_aliasing=c.anti_aliasing).numpy()
 
-            ground_truth = np.zeros((c.len_sequence, 6))
+        ground_truth = stack_ground_truth(x[block], y[block], vx[block], vy[block], ax[block], ay[block]).numpy()
 
-            for i_frame in range(c.len_sequence):
+        if c.packed:
+            packed_block = slice(i_start + block.start, i_start + block.stop)
+            frames_packed[packed_block] = frames
+            ground_truth_packed[packed_block] = ground_truth
+
+            # Render the same trajectories again at the other resolutions of the pyramid
+            for resolution, frames_resolution in frames_pyramid.items():
+                frames_resolution[packed_block] = render_frames(
+                    x[block], y[block], c.window_size_x, c.window_size_y, c.ball_radius,
+                    anti_aliasing=c.anti_aliasing, scale=resolution / c.window_size_x).numpy()
+
+            print("Generated sequence: %d of %d with length %d ..." % (
+                packed_block.stop, c.num_sequences, c.len_sequence))
+
+        else:
+            for i_block_sequence in range(frames.shape[0]):
+                i_sequence = i_start + i_block + i_block_sequence
+
+                save_path_sequence = os.path.join(
+                    c.save_dir_path,
+                    'seq' + str(i_sequence)
+                )
 
-                save_path_frame = os.path.join(
+                os.makedirs(save_path_sequence, exist_ok=True)
+
+                for i_frame in range(c.len_sequence):
+
+                    save_path_frame = os.path.join(
+                        save_path_sequence,
+                        'frame' + str(i_frame) + '.jpeg'
+                    )
+
+                    Image.fromarray(frames[i_block_sequence, i_frame]).save(save_path_frame)
+
+                # Save the values at the last
+                save_path_ground_truth = os.path.join(
                     save_path_sequence,
-                    'frame' + str(i_frame) + '.jpeg'
+                    'ground_truth'
                 )
+                np.save(save_path_ground_truth, ground_truth[i_block_sequence].astype(np.float64))
+
+                if (i_sequence+1) % 100 == 0:
+                    print("Generated sequence: %d of %d with length %d ..." % (
+                        i_sequence+1, c.num_sequences, c.len_sequence))
+
+    if c.packed:
+        frames_packed.flush()
+        ground_truth_packed.flush()
+
+        for frames_resolution in frames_pyramid.values():
+            frames_resolution.flush()
+
+
+def stack_ground_truth(x, y, vx, vy, ax, ay):
+    # Returns the ground truth of the sequences as tensor of shape [num_sequences, len_sequence, 6]
+    return torch.stack([x, y, vx, vy, ax.view(-1, 1).expand_as(x), ay.view(-1, 1).expand_as(x)], dim=2)
+
+
+def save_shard(args):
+    # Wrapper to use save_sequences with Pool.imap_unordered
+    c, i_shard, shard = args
+
+    save_sequences(c, *shard)
 
-                ground_truth[i_frame] = np.array([x[i_sequence, i_frame], y[i_sequence, i_frame],
-                                                  vx[i_sequence, i_frame], vy[i_sequence, i_frame],
-                                                  ax[i_sequence], ay[i_sequence]])
+    return i_shard, shard[1].shape[0]
 
-                draw_ball(screen, c.window_size_x, c.window_size_y, c.ball_radius, x[i_sequence, i_frame], y[i_sequence, i_frame])
-                img.save(save_path_frame)
 
-            # Save the values at the last
-            save_path_ground_truth = os.path.join(
-                save_path_sequence,
-                'ground_truth'
-            )
-            np.save(save_path_ground_truth, ground_truth)
+def add_to_manifest(save_dir_path, i_shard, num_sequences):
+    # Mark a shard as completed. The manifest is only appended to, so a crash can't corrupt completed entries
+    with open(os.path.join(save_dir_path, MANIFEST), 'a') as f:
+        f.write("{} {}\n".format(i_shard, num_sequences))
 
-            if (i_sequence+1) % 100 == 0:
-                print("Generated sequence: %d of %d with length %d ..." % (
-                    i_sequence+1, c.num_sequences, c.len_sequence))
+
+def load_manifest(c):
+    # Returns the completed shards of an existing dataset as {i_shard: num_sequences}
+    with open(os.path.join(c.save_dir_path, 'config.p'), 'rb') as f:
+        stored_config = pickle.load(f)
+
+    # Datasets that were generated before a parameter existed used its default value
+    parser = get_argument_parser()
+
+    for name in RESUME_PARAMETERS:
+        stored_value = getattr(stored_config, name, parser.get_default(name))
+
+        if stored_value != getattr(c, name):
+            raise Exception("Can't resume dataset in {}, {} is {} but the dataset was generated with {}".format(
+                c.save_dir_path, name, getattr(c, name), stored_value))
+
+    if c.num_sequences < stored_config.num_sequences:
+        raise Exception("Can't shrink dataset in {} from {} to {} sequences".format(
+            c.save_dir_path, stored_config.num_sequences, c.num_sequences))
+
+    completed_shards = {}
+
+    if os.path.exists(os.path.join(c.save_dir_path, MANIFEST)):
+        with open(os.path.join(c.save_dir_path, MANIFEST), 'r') as f:
+            for line in f:
+                if line.strip():
+                    i_shard, num_sequences = line.split()
+                    completed_shards[int(i_shard)] = int(num_sequences)
+
+    return completed_shards
 
 
 def sample_near_limit(idx, limit, fraction, seed):
@@ -165,21 +355,6 @@ def get_collisions(x, y, x_min, x_max, y_min, y_max):
     return collisions
 
 
-def draw_ball(screen, window_size_x, window_size_y, ball_radius, x, y):
-    # Reset to a black image
-    screen.rectangle(
-        xy=[(0, 0), (window_size_x, window_size_y)],
-        fill='black',
-        outline=None
-    )
-    # Draw the ball on the clean image
-    screen.ellipse(
-        xy=[(x - ball_radius, y - ball_radius), (x + ball_radius, y + ball_radius)],
-        width=0,
-        fill='white'
-    )
-
-
 def get_trajectories(x_start, y_start, vx_start, vy_start, ax, ay, t_frame, len_sequence):
     t = torch.arange(len_sequence).float() * t_frame
     t = torch.ones(x_start.shape[0], 1) * t.view(1, -1)
@@ -197,7 +372,7 @@ def equation_of_motion(x_0, y_0, vx_0, vy_0, ax, ay, t):
     return x_t, y_t, vx_t, vy_t
 
 
-if __name__ == '__main__':
+def get_argument_parser():
     parser = argparse.ArgumentParser()
 
     # General settings
@@ -210,11 +385,19 @@ if __name__ == '__main__':
     parser.add_argument('--ball_radius', default=2, type=int, help='Ball radius in pixels')
     parser.add_argument('--t_frame', default=1/30, type=float, help='Frame time')
     parser.add_argument('--eval_before_saving', default=True, type=str2bool, help='Evaluate dataset before saving it')
-    parser.add_argument('--mode', default='points', type=str, help='Define mode for plotting the dataset during evaluation')
+    parser.add_argument('--mode', default='density', type=str, help='Define mode for plotting the dataset during evaluation: lines, points or density')
     parser.add_argument('--save', default=True, type=str2bool, help='Generate images for the dataset and save them')
+    parser.add_argument('--packed', default=False, type=str2bool, help='Save all frames and ground truth in one array each instead of single files')
+    parser.add_argument('--anti_aliasing', default=False, type=str2bool, help='Render the ball with anti-aliased edges')
+    parser.add_argument('--render_block_size', default=512, type=int, help='Number of sequences to render at once')
+    parser.add_argument('--shard_size', default=1024, type=int, help='Number of sequences per shard, each shard gets its own seed')
+    parser.add_argument('--num_workers', default=1, type=int, help='Number of processes to render and save the shards')
+    parser.add_argument('--resume', default=False, type=str2bool, help='Skip completed shards of an existing dataset and append new ones')
+    parser.add_argument('--resolutions', default='', type=str, help='Comma separated frame widths, e.g. 16,32, to render additionally (packed only)')
 
     # Trajectory parameters
     parser.add_argument('--avoid_collisions', default=True, type=str2bool, help='Resample trajectories with collisions')
+    parser.add_argument('--feasible_sampling', default=False, type=str2bool, help='Sample start positions only from the region without collisions')
     parser.add_argument('--x_min_sampling', default=64/5, type=float, help='Minimum x value to sample')
     parser.add_argument('--x_max_sampling', default=64 - 64/5, type=float, help='Maximum x value to sample')
     parser.add_argument('--y_min_sampling', default=64/4, type=float, help='Minimum y value to sample')
@@ -225,6 +408,26 @@ if __name__ == '__main__':
     parser.add_argument('--ay_limit', default=60, type=int, help='Min/Max acceleration in y direction to sample')
     parser.add_argument('--fraction', default=0.3, type=float, help='Fraction of the limit from which to sample')
 
-    config = parser.parse_args()
+    return parser
+
+
+def init_config(c):
+    # Add the values that are derived from the arguments
+    c.x_min = c.ball_radius
+    c.x_max = c.window_size_x - c.ball_radius
+    c.y_min = c.ball_radius
+    c.y_max = c.window_size_y - c.ball_radius
+
+    c.latent_names = ['px', 'py']
+
+    # Additional resolutions of the pyramid, the frames at window_size_x are always generated
+    c.resolution_list = sorted(set(int(resolution) for resolution in getattr(c, 'resolutions', '').split(',') if resolution.strip())
+                               - {c.window_size_x})
+
+    return c
+
+
+if __name__ == '__main__':
+    config = get_argument_parser().parse_args()
 
     generate_data(config)
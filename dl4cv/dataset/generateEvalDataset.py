@@ -4,8 +4,11 @@ import shutil
 
 import numpy as np
 import torch
-from PIL import Image, ImageDraw
+from PIL import Image
 
+from dl4cv.dataset.utils import render_frames, create_packed_dataset, open_packed_dataset, create_sequence_index, \
+    save_ground_truths
+from dl4cv.dataset.generateDataset import stack_ground_truth
 from dl4cv.eval.eval_functions import analyze_dataset
 
 
@@ -16,21 +19,24 @@ eval_config = {
 
     'eval_before_generating': False,  # Evaluate the dataset before generating it
     'generate': True,               # Generate the dataset
+    'packed': False,                # Save all frames and ground truth in one array each instead of single files
     'batch_size': 16
 }
 
-num_sequences = eval_config['num_sequences']
-batch_size = eval_config['batch_size']
 
-assert num_sequences % (2 * batch_size) == 0  # We need to build pairs, select an even number of sequences
+def load_config(eval_config):
+    assert eval_config['num_sequences'] % (2 * eval_config['batch_size']) == 0  # We need to build pairs, select an even number of sequences
 
-# Reuse old config
-config = pickle.load(open(eval_config['dataset_config_path'], 'rb'))
-config.save_dir_path = eval_config['save_dir_path']
-config.num_sequences = eval_config['num_sequences']
-config.eval_before_saving = eval_config['eval_before_generating']
-config.generate = eval_config['generate']
-config.batch_size = eval_config['batch_size']
+    # Reuse old config
+    config = pickle.load(open(eval_config['dataset_config_path'], 'rb'))
+    config.save_dir_path = eval_config['save_dir_path']
+    config.num_sequences = eval_config['num_sequences']
+    config.eval_before_saving = eval_config['eval_before_generating']
+    config.generate = eval_config['generate']
+    config.packed = eval_config['packed']
+    config.batch_size = eval_config['batch_size']
+
+    return config
 
 
 # make save_dir_path absolute
@@ -61,21 +67,6 @@ def get_collisions(x, y, x_min, x_max, y_min, y_max):
     return collisions
 
 
-def draw_ball(screen, window_size_x, window_size_y, ball_radius, x, y):
-    # Reset to a black image
-    screen.rectangle(
-        xy=[(0, 0), (window_size_x, window_size_y)],
-        fill='black',
-        outline=None
-    )
-    # Draw the ball on the clean image
-    screen.ellipse(
-        xy=[(x - ball_radius, y - ball_radius), (x + ball_radius, y + ball_radius)],
-        width=0,
-        fill='white'
-    )
-
-
 def get_initial_velocities(x_start, x_end, y_start, y_end, ax, ay, t_end):
     vx_0 = (x_end - x_start - 0.5 * ax * t_end * t_end) / t_end
     vy_0 = (y_end - y_start - 0.5 * ay * t_end * t_end) / t_end
@@ -92,10 +83,16 @@ def get_trajectories(x_start, y_start, vx_start, vy_start, ax, ay, t_frame, len_
 
 def generate_data(c):
 
+    # Datasets generated before the batch rasterizer existed don't store the render settings
+    anti_aliasing = getattr(c, 'anti_aliasing', False)
+    render_block_size = getattr(c, 'render_block_size', 512)
+
     # Remove old dataset
     if os.path.exists(c.save_dir_path):
         shutil.rmtree(c.save_dir_path)
 
+    random_state = np.random.RandomState(c.seed)
+
     for i_latent in range(len(c.latent_names)):
         print("Generating subset where {} is constant".format(c.latent_names[i_latent]))
 
@@ -103,129 +100,177 @@ def generate_data(c):
 
         os.makedirs(latent_path, exist_ok=True)
 
-        # create image to draw on
-        img = Image.new(mode="L", size=(c.window_size_x, c.window_size_y))
-        # create screen
-        screen = ImageDraw.Draw(img)
+        x, y, vx, vy, start_vars = sample_fixed_factor_trajectories(c, i_latent, random_state)
+
+        if c.eval_before_saving:
+            trajectories = np.zeros((c.num_sequences, c.len_sequence, 6))
+
+            trajectories[:, :, 0] = x
+            trajectories[:, :, 1] = y
+            trajectories[:, :, 2] = vx
+            trajectories[:, :, 3] = vy
+            trajectories[:, :, 4] = np.repeat(start_vars[4].reshape(-1, 1), c.len_sequence, 1)
+            trajectories[:, :, 5] = np.repeat(start_vars[5].reshape(-1, 1), c.len_sequence, 1)
+
+            analyze_dataset(
+                trajectories,
+                window_size_x=c.window_size_x,
+                window_size_y=c.window_size_y,
+                mode='density'
+            )
+
+        if c.save:
+            # Save configuration
+            with open(os.path.join(latent_path, 'config.p'), 'wb') as f:
+                pickle.dump(c, f)
+
+            if c.packed:
+                create_packed_dataset(latent_path, c.num_sequences, c.len_sequence, c.window_size_x, c.window_size_y)
+                frames_packed, ground_truth_packed = open_packed_dataset(latent_path, mmap_mode='r+')
 
-        # Initialize x,y,vx,vy,ax,ay
-        start_vars = [torch.zeros((c.num_sequences,)) for _ in range(6)]
+            # Generate frames for the sequences. Render blocks of sequences at once to limit the memory footprint
+            for i_block in range(0, c.num_sequences, render_block_size):
+                block = slice(i_block, min(i_block + render_block_size, c.num_sequences))
 
-        collisions = np.ones((c.num_sequences))
+                frames = render_frames(x[block], y[block], c.window_size_x, c.window_size_y, c.ball_radius,
+                                       anti_aliasing=anti_aliasing).numpy()
 
-        i_run = 0
+                ground_truth = torch.stack([x[block], y[block], vx[block], vy[block],
+                                            start_vars[4][block].view(-1, 1).expand_as(x[block]),
+                                            start_vars[5][block].view(-1, 1).expand_as(x[block])], dim=2).numpy()
 
-        # Generate Trajectories for all the sequences
-        while collisions.any():
-            i_run += 1
+                if c.packed:
+                    frames_packed[block] = frames
+                    ground_truth_packed[block] = ground_truth
 
-            idx = collisions.nonzero()[0]
+                    print("Generated sequence: %d of %d with length %d ..." % (
+                        block.stop, c.num_sequences, c.len_sequence))
 
-            start_vars[0][idx] = torch.rand_like(torch.Tensor(idx)) * (c.x_max - c.x_min) + c.x_min
-            start_vars[1][idx] = torch.rand_like(torch.Tensor(idx)) * (c.y_max - c.y_min) + c.y_min
+                else:
+                    for i_block_sequence in range(frames.shape[0]):
+                        i_sequence = i_block + i_block_sequence
 
-            if c.vx_limit != 0:
-                start_vars[2][idx] = sample_near_limit(idx, c.vx_limit, c.fraction, i_run*c.seed)
-                c.latent_names.append('vx')
+                        save_path_sequence = os.path.join(
+                            latent_path,
+                            'seq' + str(i_sequence)
+                        )
 
-            if c.vy_limit != 0:
-                start_vars[3][idx] = sample_near_limit(idx, c.vy_limit, c.fraction, (i_run + 1)*c.seed)
-                c.latent_names.append('vy')
+                        os.makedirs(save_path_sequence, exist_ok=True)
 
-            if c.ax_limit != 0:
-                start_vars[4][idx] = sample_near_limit(idx, c.ax_limit, c.fraction, (i_run + 2)*c.seed)
-                c.latent_names.append('ax')
+                        for i_frame in range(c.len_sequence):
 
-            if c.ay_limit != 0:
-                start_vars[5][idx] = sample_near_limit(idx, c.ay_limit, c.fraction, (i_run+3)*c.seed)
-                c.latent_names.append('ay')
+                            save_path_frame = os.path.join(
+                                save_path_sequence,
+                                'frame' + str(i_frame) + '.jpeg'
+                            )
 
-            # Build batch pairs where one variable is always fixed for two consecutive batches
-            for i_pair in range(0, num_sequences, (2 * batch_size)):
-                start_vars[i_latent][i_pair + batch_size: i_pair + 2 * batch_size] = start_vars[i_latent][i_pair: i_pair + batch_size]
+                            Image.fromarray(frames[i_block_sequence, i_frame]).save(save_path_frame)
 
-            x, y, vx, vy = get_trajectories(*start_vars, c.t_frame, c.len_sequence)
+                        # Save the values at the last
+                        save_path_ground_truth = os.path.join(
+                            save_path_sequence,
+                            'ground_truth'
+                        )
+                        np.save(save_path_ground_truth, ground_truth[i_block_sequence].astype(np.float64))
 
-            collisions = get_collisions(x, y, c.x_min, c.x_max, c.y_min, c.y_max)
+                        if (i_sequence+1) % 100 == 0:
+                            print("Generated sequence: %d of %d with length %d ..." % (
+                                i_sequence+1, c.num_sequences, c.len_sequence))
 
-            if c.avoid_collisions:
-                print("{} collisions of {} sequences".format(collisions.sum(), c.num_sequences))
+            if c.packed:
+                frames_packed.flush()
+                ground_truth_packed.flush()
             else:
-                print("No collision avoidance... but we had {} in {} sequences".format(
-                    collisions.sum(), c.num_sequences)
-                )
-                collisions = np.zeros((c.num_sequences))
+                create_sequence_index(latent_path, c.num_sequences, c.len_sequence)
+                save_ground_truths(latent_path, stack_ground_truth(
+                    x, y, vx, vy, start_vars[4], start_vars[5]).numpy().astype(np.float64))
 
-        if config.eval_before_saving:
-            trajectories = np.zeros((c.num_sequences, c.len_sequence, 6))
 
-            trajectories[:, :, 0] = x
-            trajectories[:, :, 1] = y
-            trajectories[:, :, 2] = vx
-            trajectories[:, :, 3] = vy
-            trajectories[:, :, 4] = np.repeat(start_vars[4].reshape(-1, 1), c.len_sequence, 1)
-            trajectories[:, :, 5] = np.repeat(start_vars[5].reshape(-1, 1), c.len_sequence, 1)
+def sample_fixed_factor_trajectories(c, i_latent, random_state, verbose=True):
+    # Sample batch pairs where start variable i_latent is the same for two consecutive batches.
+    # All start variables are drawn from random_state, a np.random.RandomState, so the global random numbers stay as
+    # they are
 
-            analyze_dataset(
-                trajectories,
-                window_size_x=config.window_size_x,
-                window_size_y=config.window_size_y,
-                mode='lines'
-            )
+    # Initialize x,y,vx,vy,ax,ay
+    start_vars = [torch.zeros((c.num_sequences,)) for _ in range(6)]
 
-        if config.save:
-            # Save configuration
-            with open(os.path.join(latent_path, 'config.p'), 'wb') as f:
-                pickle.dump(c, f)
+    collisions = np.ones((c.num_sequences))
 
-            # Generate frames for the sequences
-            for i_sequence in range(c.num_sequences):
+    i_run = 0
 
-                save_path_sequence = os.path.join(
-                    latent_path,
-                    'seq' + str(i_sequence)
-                )
+    # Generate Trajectories for all the sequences
+    while collisions.any():
+        i_run += 1
 
-                os.makedirs(save_path_sequence, exist_ok=True)
+        idx = collisions.nonzero()[0]
 
-                ground_truth = np.zeros((c.len_sequence, 6))
+        start_vars[0][idx] = torch.from_numpy(random_state.uniform(c.x_min, c.x_max, len(idx))).float()
+        start_vars[1][idx] = torch.from_numpy(random_state.uniform(c.y_min, c.y_max, len(idx))).float()
 
-                for i_frame in range(c.len_sequence):
+        if c.vx_limit != 0:
+            start_vars[2][idx] = sample_near_limit(idx, c.vx_limit, c.fraction, random_state)
 
-                    save_path_frame = os.path.join(
-                        save_path_sequence,
-                        'frame' + str(i_frame) + '.jpeg'
-                    )
+        if c.vy_limit != 0:
+            start_vars[3][idx] = sample_near_limit(idx, c.vy_limit, c.fraction, random_state)
 
-                    ground_truth[i_frame] = np.array([x[i_sequence, i_frame], y[i_sequence, i_frame],
-                                                      vx[i_sequence, i_frame], vy[i_sequence, i_frame],
-                                                      start_vars[4][i_sequence], start_vars[5][i_sequence]])
+        if c.ax_limit != 0:
+            start_vars[4][idx] = sample_near_limit(idx, c.ax_limit, c.fraction, random_state)
 
-                    draw_ball(screen, c.window_size_x, c.window_size_y, c.ball_radius, x[i_sequence, i_frame], y[i_sequence, i_frame])
-                    img.save(save_path_frame)
+        if c.ay_limit != 0:
+            start_vars[5][idx] = sample_near_limit(idx, c.ay_limit, c.fraction, random_state)
 
-                # Save the values at the last
-                save_path_ground_truth = os.path.join(
-                    save_path_sequence,
-                    'ground_truth'
+        # Build batch pairs where one variable is always fixed for two consecutive batches
+        for i_pair in range(0, c.num_sequences, (2 * c.batch_size)):
+            start_vars[i_latent][i_pair + c.batch_size: i_pair + 2 * c.batch_size] = start_vars[i_latent][i_pair: i_pair + c.batch_size]
+
+        x, y, vx, vy = get_trajectories(*start_vars, c.t_frame, c.len_sequence)
+
+        collisions = get_collisions(x, y, c.x_min, c.x_max, c.y_min, c.y_max)
+
+        if c.avoid_collisions:
+            if verbose:
+                print("{} collisions of {} sequences".format(collisions.sum(), c.num_sequences))
+        else:
+            if verbose:
+                print("No collision avoidance... but we had {} in {} sequences".format(
+                    collisions.sum(), c.num_sequences)
                 )
-                np.save(save_path_ground_truth, ground_truth)
+            collisions = np.zeros((c.num_sequences))
 
-                if (i_sequence+1) % 100 == 0:
-                    print("Generated sequence: %d of %d with length %d ..." % (
-                        i_sequence+1, c.num_sequences, c.len_sequence))
+    return x, y, vx, vy, start_vars
+
+
+def generate_fixed_factor_batch_pairs(c, i_latent, len_inp_sequence, random_state):
+    """
+    Generates the batch pairs of generate_data in memory instead of saving them. The start variables are drawn from
+    random_state, a np.random.RandomState
+    Yields:
+        x1, x2: torch.tensor, shape [batch_size, len_inp_sequence, window_size_y, window_size_x]
+        input sequences of two batches where start variable i_latent is the same for sequence i of both batches
+    """
+    assert c.num_sequences % (2 * c.batch_size) == 0  # We need to build pairs, select an even number of sequences
+
+    x, y, _, _, _ = sample_fixed_factor_trajectories(c, i_latent, random_state, verbose=False)
+
+    for i_pair in range(0, c.num_sequences, (2 * c.batch_size)):
+        pair = slice(i_pair, i_pair + 2 * c.batch_size)
+
+        frames = render_frames(x[pair, :len_inp_sequence], y[pair, :len_inp_sequence], c.window_size_x,
+                               c.window_size_y, c.ball_radius, anti_aliasing=getattr(c, 'anti_aliasing', False))
+        frames = frames.float().div_(255)
+
+        yield frames[:c.batch_size], frames[c.batch_size:]
 
 
-def sample_near_limit(idx, limit, fraction, seed):
+def sample_near_limit(idx, limit, fraction, random_state):
     # Use this function to only sample from the lowest highest fraction of the sample range
 
-    values = torch.rand_like(torch.Tensor(idx)) * limit * fraction - limit
-    torch.manual_seed(seed)
-    indices = torch.rand_like(values) >= 0.5
-    values[indices] = torch.rand_like(values[indices]) * limit * fraction + limit - limit * fraction
+    values = random_state.rand(len(idx)) * limit * fraction - limit
+    indices = random_state.rand(len(idx)) >= 0.5
+    values[indices] = random_state.rand(indices.sum()) * limit * fraction + limit - limit * fraction
 
-    return values
+    return torch.from_numpy(values).float()
 
 
 if __name__ == '__main__':
-    generate_data(config)
+    generate_data(load_config(eval_config))
@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+
+class InMemoryLoader(object):
+    """
+    Replaces the DataLoader for datasets with load_to_ram. Every batch is gathered from the RAM store of the dataset
+    with one indexing operation instead of one __getitem__ call per sample and default_collate.
+    Yields the same (x, y, question, ground_truth) batches as a DataLoader with drop_last over the dataset.
+    """
+    def __init__(self, dataset, indices, batch_size, shuffle=True, drop_last=True):
+        if not dataset.load_to_ram or dataset.frames is None:
+            raise Exception('The InMemoryLoader needs a dataset with load_to_ram')
+
+        self.dataset = dataset
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = self.indices[torch.randperm(len(self.indices))]
+        else:
+            indices = self.indices
+
+        for i_batch in range(len(self)):
+            yield self.get_batch(indices[i_batch * self.batch_size:(i_batch + 1) * self.batch_size])
+
+    def get_batch(self, indices):
+        dataset = self.dataset
+        batch_size = len(indices)
+
+        rows = torch.from_numpy(dataset.ram_rows[indices.numpy()])
+
+        if (rows < 0).any():
+            raise Exception('The batch contains sequences that were not loaded to RAM, add them to load_indices')
+
+        len_sequence = dataset.frames.shape[1]
+
+        x = self.gather(rows, slice(0, dataset.len_inp_sequence)) if dataset.len_inp_sequence > 0 else \
+            torch.zeros(batch_size, dtype=torch.long)
+
+        if dataset.question:
+            # Sample the target frames of all sequences at once
+            target_idx = torch.randint(0, len_sequence - dataset.len_out_sequence - 1,
+                                       (batch_size, dataset.num_questions))
+            times = target_idx.unsqueeze(2) + torch.arange(dataset.len_out_sequence).view(1, 1, -1)
+
+            y = self.gather(rows.view(-1, 1, 1), times) if dataset.len_out_sequence > 0 else \
+                torch.zeros(batch_size, dtype=torch.long)
+            question = target_idx.float()
+
+            if dataset.num_questions == 1:
+                y = y[:, 0] if dataset.len_out_sequence > 0 else y
+                question = question[:, 0]
+        else:
+            start_y = dataset.len_inp_sequence
+            end_y = dataset.len_inp_sequence + dataset.len_out_sequence
+
+            y = self.gather(rows, slice(start_y, end_y)) if dataset.len_out_sequence > 0 else \
+                torch.zeros(batch_size, dtype=torch.long)
+            question = torch.full((batch_size,), -1, dtype=torch.long)
+
+        if dataset.load_ground_truth:
+            ground_truth = torch.from_numpy(dataset.get_ground_truths(indices.numpy()))
+        else:
+            ground_truth = torch.zeros(batch_size, dtype=torch.long)
+
+        return x, y, question, ground_truth
+
+    def gather(self, rows, times):
+        """
+        Returns the frames [rows, times] of the RAM store as float tensor in [0, 1]
+        """
+        frames = self.dataset.frames
+
+        if torch.is_tensor(frames):
+            # The float store already holds the final frames
+            return frames[rows, times]
+
+        if not isinstance(times, slice):
+            times = times.numpy()
+
+        frames = frames[rows.numpy(), times]
+
+        if self.dataset.ram_format == 'bits':
+            frames = np.unpackbits(frames, axis=-1, count=self.dataset.frame_width) * np.uint8(255)
+
+        return torch.from_numpy(frames.astype(np.float32)).div_(255)
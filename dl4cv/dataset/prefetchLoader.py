@@ -0,0 +1,99 @@
+import queue
+import threading
+
+import torch
+
+
+class PrefetchLoader(object):
+    """
+    Wraps a loader and prepares the next batches on a background thread while the current step computes.
+    On a GPU the batches are pinned and copied non-blocking on a side stream, on the CPU the thread overlaps the
+    loading and collating of the next batches with the step.
+    Yields the batches of the wrapped loader with all tensors on the device.
+    """
+    def __init__(self, loader, device, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.use_stream = self.device.type == 'cuda' and torch.cuda.is_available()
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.num_prefetch <= 0:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.prefetch, args=(batches, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = batches.get()
+
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                batch, event = item
+
+                if event is not None:
+                    # Wait for the copy on the side stream and keep its memory alive on the compute stream
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    for tensor in batch:
+                        if torch.is_tensor(tensor):
+                            tensor.record_stream(torch.cuda.current_stream(self.device))
+
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the thread if it waits for a free slot
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def prefetch(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.use_stream else None
+
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = self.to_device(batch, pin=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch, event = self.to_device(batch), None
+
+                batches.put((batch, event))
+
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def to_device(self, batch, pin=False):
+        staged = []
+
+        for tensor in batch:
+            if torch.is_tensor(tensor):
+                if pin and not tensor.is_pinned():
+                    tensor = tensor.pin_memory()
+                tensor = tensor.to(self.device, non_blocking=pin)
+
+            staged.append(tensor)
+
+        return type(batch)(staged) if isinstance(batch, tuple) else staged
@@ -0,0 +1,106 @@
+import os
+import pickle
+
+import numpy as np
+import torch
+
+from dl4cv.dataset.generateDataset import get_argument_parser, init_config, sample_trajectories, get_shard_seed, \
+    stack_ground_truth
+from dl4cv.dataset.utils import CustomDataset, render_frames
+
+
+class ProceduralDataset(CustomDataset):
+    """
+    Generates and renders sequence i on the fly instead of loading it from disk.
+    Every sequence is sampled with its own seed, so sequence i is always the same and equals sequence i of a dataset
+    that generateDataset.py creates with the same config and a shard size of 1.
+    """
+    def __init__(self, config, num_sequences, len_inp_sequence, len_out_sequence,
+                 question=False, load_ground_truth=False, num_questions=1):
+        self.path = None
+        self.transform = None
+        self.len_inp_sequence = len_inp_sequence
+        self.len_out_sequence = len_out_sequence
+        self.question = question
+        self.num_questions = num_questions
+        self.load_ground_truth = load_ground_truth
+        self.load_to_ram = False
+        self.packed = True
+
+        self.config = init_config(config)
+        self.num_sequences = num_sequences
+
+        # The last generated sequence, frames and ground truth are requested separately
+        self.cached_index = None
+        self.cached_sequence = None
+
+        self.resolution = None
+        self.frames = None
+        self.shared_memory_segments = []
+        self.released_segments = []
+
+    def generate_sequence(self, index):
+        if index != self.cached_index:
+            c = self.config
+
+            # Don't interfere with the random numbers of the process that uses the dataset
+            with torch.random.fork_rng(devices=[]):
+                x, y, vx, vy, ax, ay = sample_trajectories(c, 1, get_shard_seed(c.seed, index), verbose=False)
+
+            scale = 1. if self.resolution is None else self.resolution / c.window_size_x
+
+            frames = render_frames(x, y, c.window_size_x, c.window_size_y, c.ball_radius,
+                                   anti_aliasing=c.anti_aliasing, scale=scale)[0].numpy()
+
+            ground_truth = stack_ground_truth(x, y, vx, vy, ax, ay)[0].numpy()
+
+            self.cached_index = index
+            self.cached_sequence = (frames, ground_truth)
+
+        return self.cached_sequence
+
+    def get_packed_sequence(self, index):
+        return self.generate_sequence(index)[0]
+
+    def set_resolution(self, resolution):
+        # Every resolution can be rendered on the fly
+        self.resolution = resolution
+        self.cached_index = None
+
+    def get_ground_truth(self, index):
+        return np.array(self.generate_sequence(index)[1])
+
+    def get_ground_truths(self, indices=None):
+        indices = range(self.num_sequences) if indices is None else indices
+
+        return np.stack([self.get_ground_truth(int(index)) for index in indices])
+
+    def __len__(self):
+        return self.num_sequences
+
+
+def get_default_config():
+    # The default settings of generateDataset.py
+    return get_argument_parser().parse_args([])
+
+
+def get_generator_config(data_path=None, overrides=None):
+    """
+    Returns the generateDataset.py settings for a ProceduralDataset: the config of the dataset in data_path if it has
+    one, otherwise the defaults, with the settings in the dict overrides replaced
+    """
+    config = get_default_config()
+    config_path = os.path.join(data_path, 'config.p') if data_path is not None else None
+
+    if config_path is not None and os.path.exists(config_path):
+        with open(config_path, 'rb') as f:
+            # Datasets generated by older versions miss the newer settings, they keep their defaults
+            vars(config).update(vars(pickle.load(f)))
+
+    for key, value in (overrides or {}).items():
+        if not hasattr(config, key):
+            raise Exception('{} is not a setting of generateDataset.py'.format(key))
+
+        setattr(config, key, value)
+
+    return config
@@ -1,16 +1,71 @@
-import copy
+import fcntl
+import gc
+import hashlib
+import multiprocessing
 import os
 import pickle
+import queue
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np
 import torch
+import torch.distributed as dist
+from PIL import Image, ImageDraw
+from torch.utils.data import DistributedSampler, Sampler, get_worker_info
 from torch.utils.data.dataset import Dataset
 from torchvision.datasets.folder import IMG_EXTENSIONS, has_file_allowed_extension, pil_loader
 
+# File names of the packed dataset format
+PACKED_HEADER = 'header.p'
+PACKED_FRAMES = 'frames.npy'
+PACKED_GROUND_TRUTH = 'ground_truth.npy'
+# Datasets with single files consolidate the ground truth of all sequences in the same file
+CONSOLIDATED_GROUND_TRUTH = PACKED_GROUND_TRUTH
+# Lists the sequence directories and frame files of a dataset with single files, so it can be opened without os.walk
+SEQUENCE_INDEX = 'index.p'
+# Number of int64 values in front of the frames of a shared memory segment: ready flag, dtype, frame width, shape
+SHARED_HEADER_LENGTH = 16
+SHARED_DTYPES = [np.uint8, np.float32]
+# Header entry with the pid of the process that creates the segment
+SHARED_PID = SHARED_HEADER_LENGTH - 1
+# Header entry with the number of processes that use the segment, the last one removes it
+SHARED_USERS = SHARED_HEADER_LENGTH - 2
+# Seconds to wait for another process to fill a shared memory segment before it is rebuilt
+SHARED_TIMEOUT = 30 * 60
+
 
 class CustomDataset(Dataset):
+    """
+    transform: applied to the PIL images of datasets with single files. None decodes the grayscale JPEGs directly to
+        uint8 arrays, which gives the same frames as Grayscale() and ToTensor() but is several times faster
+    load_indices: only load these sequences with load_to_ram, e.g. the ones the samplers use. None loads all
+    num_questions: number of target frames per sequence in question mode. With more than one, y has the shape
+        [num_questions, len_out_sequence, height, width] and question the shape [num_questions]
+    num_load_workers: number of processes that decode the images for load_to_ram, None for the number of cores
+        divided by the number of processes of a distributed run
+    cache_bytes: without load_to_ram, keep up to this many bytes of decoded sequences of a dataset with single files
+        in an LRU cache. Every DataLoader worker has its own cache
+    readahead: number of sequences a background thread decodes ahead into the cache. Needs a ReadaheadSampler, see
+        set_readahead_sampler()
+    ram_format: how load_to_ram stores the frames.
+        'uint8': one contiguous uint8 array, lossless and 4x smaller than float
+        'bits': one contiguous bit-packed array, 32x smaller than float. Pixels are thresholded at half intensity,
+            so this only fits datasets without anti-aliasing
+        'float': one contiguous float tensor, 4x larger than uint8 but the frames are returned as views without any
+            conversion
+    shared_memory: keep the frames of load_to_ram in a named shared memory segment in /dev/shm. The first process
+        decodes the dataset, all later processes on the machine attach to the segment read-only. The segments persist
+        after the processes exit, remove them with rm /dev/shm/dl4cv_*
+    """
     def __init__(self, path, transform, len_inp_sequence, len_out_sequence,
                  question=False, load_ground_truth=False, load_to_ram=False,
-                 only_input=False, load_config=False):
+                 only_input=False, load_config=False, ram_format='uint8', shared_memory=False, load_indices=None,
+                 num_load_workers=None, num_questions=1, cache_bytes=0, readahead=0):
         self.path = path
         self.transform = transform
         self.sequences = {}
@@ -18,61 +73,246 @@ class CustomDataset(Dataset):
         self.len_inp_sequence = len_inp_sequence
         self.len_out_sequence = len_out_sequence
         self.question = question
+        self.num_questions = num_questions
         self.load_ground_truth = load_ground_truth
         self.load_to_ram = load_to_ram
         self.only_input = only_input
+        self.packed = is_packed_dataset(path)
+        self.ram_format = ram_format
+        self.shared_memory = shared_memory
+        self.shared_memory_segments = []
+        self.released_segments = []
+        self.num_load_workers = num_load_workers if num_load_workers is not None else get_default_load_workers()
+        self.frames = None
+        self.ground_truths = None
+        # Resolution of the dataset pyramid the frames are taken from, None for the generated resolution
+        self.resolution = None
+        self.cache_bytes = cache_bytes
+        self.readahead = readahead
+        self.readahead_sampler = None
+        self.readahead_batch_size = 1
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # The cache and the readahead thread are created in the process that uses them, see init_cache()
+        self.cache_pid = None
+        # Sequences in the RAM store, None for all, and the row of every sequence in it, -1 if it isn't loaded
+        self.ram_indices = None
+        self.ram_rows = None
 
-        num_sequences = 0
+        if ram_format not in ['uint8', 'bits', 'float']:
+            raise Exception('Unknown ram_format {}, use uint8, bits or float'.format(ram_format))
 
         if load_config:
             with open(os.path.join(path, 'config.p'), 'rb') as f:
                 self.config = pickle.load(f)
 
+        if self.packed:
+            # All frames and the ground truth are stored in one array each. Memory map them or load them to RAM
+            self.frames, self.ground_truths = open_packed_dataset(path, mmap_mode='r')
+            self.sequence_paths = [os.path.join(path, 'seq' + str(i)) for i in range(self.frames.shape[0])]
+
+            if self.load_to_ram:
+                self.set_ram_indices(load_indices)
+
+                frames = self.frames
+                self.frames = self.keep_frames_in_ram(lambda: self.cache_frames(self.select_ram_sequences(frames)))
+                self.ground_truths = np.array(self.ground_truths)
+
+        else:
+            self.find_sequences()
+
+            if self.load_to_ram:
+                self.set_ram_indices(load_indices)
+
+                self.frames = self.keep_frames_in_ram(self.load_frames_to_ram)
+
+        if len(self.sequence_paths) == 0:
+            raise Exception('Length of the dataset is 0. Make sure the dataset exists and path is correct')
+
+    def find_sequences(self):
+        # Use the index of the dataset and create it on the first open if the generator didn't
+        sequences = load_sequence_index(self.path)
+
+        if sequences is None:
+            sequences = self.walk_sequences()
+
+        if sequences and not os.path.exists(os.path.join(self.path, SEQUENCE_INDEX)):
+            try:
+                save_sequence_index(self.path, sequences)
+            except OSError:
+                print("Could not save the sequence index of {}".format(self.path))
+
+        for seq_dir, fnames in sequences:
+            seq_path = os.path.join(self.path, seq_dir)
+
+            self.sequence_paths.append(seq_path)
+            self.sequences[seq_path] = {
+                'ground_truth': os.path.join(seq_path, 'ground_truth.npy'),
+                'images': [os.path.join(seq_path, fname) for fname in fnames]
+            }
+
+    def walk_sequences(self):
+        """
+        Returns the sequences in path as list of (sequence directory relative to path, sorted frame file names)
+        """
+        sequences = []
+
         # Find all sequences. Taken form torchvision.dataset.folder.make_dataset()
-        for root, dir_names, _ in sorted(os.walk(path)):
+        for root, dir_names, _ in sorted(os.walk(self.path)):
 
             for dir_name in sorted(dir_names, key=lambda s: int(s.split("seq")[1])):
 
                 seq_path = os.path.join(root, dir_name)
 
-                self.sequence_paths.append(seq_path)
-                self.sequences[seq_path] = {}
-
                 for _, _, fnames in os.walk(seq_path):
 
-                    self.sequences[seq_path]['ground_truth'] = os.path.join(seq_path, 'ground_truth.npy')
-                    self.sequences[seq_path]['images'] = []
+                    fnames = [fname for fname in fnames if fname != 'ground_truth.npy']
+                    fnames = [fname for fname in sorted(fnames, key=lambda s: int(s.split("frame")[1].split(".")[0]))
+                              if has_file_allowed_extension(fname, IMG_EXTENSIONS)]
 
-                    num_sequences += 1
+                    sequences.append((os.path.relpath(seq_path, self.path), fnames))
 
-                    if (num_sequences % 100) == 0:
-                        print("\rFound {} sequences.".format(num_sequences), end='')
+                    if (len(sequences) % 100) == 0:
+                        print("\rFound {} sequences.".format(len(sequences)), end='')
 
-                    fnames = [fname for fname in fnames if fname != 'ground_truth.npy']
+        print('\n', end='')
+
+        return sequences
+
+    def keep_frames_in_ram(self, load_frames, resolution=None):
+        """
+        Returns the frames that load_frames() loads to RAM. With shared_memory they are only loaded if no other
+        process on the machine did before
+        """
+        if not self.shared_memory:
+            return load_frames()
+
+        name = get_shared_memory_name(self.path, self.ram_format, resolution, self.ram_indices)
+
+        shared_frames = attach_shared_frames(name)
+        frames = None
+
+        while shared_frames is None:
+            if frames is None:
+                frames = load_frames()
+
+            shared_frames = create_shared_frames(name, frames, self.frame_width)
+
+            if shared_frames is None:
+                # Another process created the segment in the meantime
+                shared_frames = attach_shared_frames(name)
 
-                    for fname in sorted(fnames, key=lambda s: int(s.split("frame")[1].split(".")[0])):
+        segment, frames, self.frame_width = shared_frames
 
-                        if has_file_allowed_extension(fname, IMG_EXTENSIONS):
+        # Keep the segment open as long as the dataset exists
+        self.shared_memory_segments.append(segment)
 
-                            item_path = os.path.join(seq_path, fname)
-                            self.sequences[seq_path]['images'].append(item_path)
+        if self.ram_format == 'float':
+            # The tensor is only read, so the warning about the read-only array doesn't apply
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                frames = torch.from_numpy(frames)
+
+        return frames
+
+    def set_ram_indices(self, load_indices):
+        num_sequences = len(self.sequence_paths)
+
+        if load_indices is None:
+            self.ram_indices = None
+            self.ram_rows = np.arange(num_sequences)
+            return
+
+        self.ram_indices = np.unique(np.asarray(load_indices, dtype=np.int64))
+
+        if len(self.ram_indices) > 0 and (self.ram_indices[0] < 0 or self.ram_indices[-1] >= num_sequences):
+            raise Exception('Trying to load sequences outside of the dataset with {} sequences to RAM'.format(
+                num_sequences))
+
+        self.ram_rows = np.full(num_sequences, -1, dtype=np.int64)
+        self.ram_rows[self.ram_indices] = np.arange(len(self.ram_indices))
+
+    def select_ram_sequences(self, frames):
+        # Read the sequences that are kept in RAM from a packed array
+        if self.ram_indices is None:
+            return np.array(frames)
+
+        return frames[self.ram_indices]
+
+    def load_frames_to_ram(self):
+        """
+        Decodes the frames of the sequences in ram_indices into one contiguous array of shape
+        [num_sequences, len_sequence, height, width(/8)]. The images are decoded by a pool of processes
+        """
+        indices = self.ram_indices if self.ram_indices is not None else range(len(self.sequence_paths))
+        tasks = [(self.sequences[self.sequence_paths[i]]['images'], self.transform) for i in indices]
+
+        frames = None
+
+        # The pool is terminated when loading fails as well
+        with multiprocessing.Pool(self.num_load_workers) if self.num_load_workers > 1 else nullcontext() as pool:
+            if pool is not None:
+                sequences = pool.imap(decode_sequence, tasks, chunksize=16)
+            else:
+                sequences = map(decode_sequence, tasks)
+
+            for row, sequence in enumerate(sequences):
+
+                if (row % 100) == 0:
+                    print("\rLoading sequences to RAM: {}/{}".format(row, len(tasks)), end='')
+
+                sequence = self.to_ram_format(sequence)
+
+                # Preallocate the store once the shape of the frames is known
+                if frames is None and torch.is_tensor(sequence):
+                    frames = torch.empty((len(tasks),) + sequence.shape, dtype=sequence.dtype)
+                elif frames is None:
+                    frames = np.empty((len(tasks),) + sequence.shape, dtype=sequence.dtype)
+
+                frames[row] = sequence
 
         print('\n', end='')
 
-        if self.load_to_ram:
+        return frames
 
-            for i, seq_path in enumerate(self.sequence_paths):
+    def to_ram_format(self, sequence):
+        # Convert the frames that decode_sequence returns to the format of the RAM store
+        if sequence.dtype == np.float32 and self.ram_format == 'float':
+            # The transformed frames skip cache_frames, which sets the frame width otherwise
+            self.frame_width = sequence.shape[-1]
+            return torch.from_numpy(sequence)
 
-                if (i % 100) == 0:
-                    print("\rLoading sequences to RAM: {}/{}".format(i, num_sequences), end='')
+        if sequence.dtype == np.float32:
+            sequence = np.round(sequence * np.float32(255)).astype(np.uint8)
 
-                self.sequences[seq_path]['images'] = [self.transform(pil_loader(img))
-                                                      for img in self.sequences[seq_path]['images']]
+        return self.cache_frames(sequence)
+
+    def load_sequence(self, seq_path):
+        """
+        Returns the frames of a sequence on disk as uint8 array of shape [len_sequence, height, width] without a
+        transform, otherwise the transformed frames as float tensor
+        """
+        sequence = decode_sequence((self.sequences[seq_path]['images'], self.transform))
 
-            print('\n', end='')
+        return sequence if self.transform is None else torch.from_numpy(sequence)
 
-        if len(self.sequence_paths) == 0:
-            raise Exception('Length of the dataset is 0. Make sure the dataset exists and path is correct')
+    def cache_frames(self, frames):
+        """
+        Converts uint8 frames to the ram_format if they are kept in RAM: bit-packed along the width for 'bits' and
+        a float tensor in [0, 1] for 'float'
+        """
+        self.frame_width = frames.shape[-1]
+
+        if not self.load_to_ram:
+            return frames
+
+        if self.ram_format == 'bits':
+            return np.packbits(frames >= 128, axis=-1)
+
+        if self.ram_format == 'float' and not torch.is_tensor(frames):
+            return torch.from_numpy(frames).float().div_(255)
+
+        return frames
 
     def __getitem__(self, index):
         """
@@ -89,30 +329,48 @@ class CustomDataset(Dataset):
             get_full_sequence = index[1] != 0
             index = index[0]
 
-        seq_path = self.sequence_paths[index]
+        if self.packed or self.frames is not None:
+            # Slicing the memory map or the RAM store is free
+            sequence = self.get_packed_sequence(index)
+        elif self.cache_bytes > 0:
+            sequence = self.get_cached_sequence(index)
+        else:
+            sequence = self.load_sequence(self.sequence_paths[index])
 
-        sequence = copy.deepcopy(self.sequences[seq_path])
+        len_sequence = sequence.shape[0]
 
-        if not self.load_to_ram:
-            sequence['images'] = [self.transform(pil_loader(img)) for img in self.sequences[seq_path]['images']]
+        if torch.is_tensor(sequence):
+            # Float frames are returned as views of the sequence
+            def get_frames(start, end):
+                return sequence[start:end]
+        else:
+            # Only the uint8 frames that are used get converted
+            def get_frames(start, end):
+                return torch.from_numpy(sequence[start:end].astype(np.float32)).div_(255)
 
-        x = torch.cat(sequence['images'][:self.len_inp_sequence]) if self.len_inp_sequence > 0 else 0
+        x = get_frames(0, self.len_inp_sequence) if self.len_inp_sequence > 0 else 0
 
         if get_full_sequence:
-            full_sequence = torch.cat(sequence['images'][:])
+            full_sequence = get_frames(0, len_sequence)
 
-        if self.question:
-            target_idx = np.random.randint(low=0, high=len(sequence['images']) - self.len_out_sequence - 1)
-            y = torch.cat(sequence['images'][target_idx:target_idx + self.len_out_sequence]) if self.len_out_sequence > 0 else 0
+        if self.question and self.num_questions > 1:
+            target_idx = np.random.randint(low=0, high=len_sequence - self.len_out_sequence - 1,
+                                           size=self.num_questions)
+            y = torch.stack([get_frames(t, t + self.len_out_sequence) for t in target_idx]) \
+                if self.len_out_sequence > 0 else 0
+            question = torch.tensor(target_idx, dtype=torch.float32)
+        elif self.question:
+            target_idx = np.random.randint(low=0, high=len_sequence - self.len_out_sequence - 1)
+            y = get_frames(target_idx, target_idx + self.len_out_sequence) if self.len_out_sequence > 0 else 0
             question = torch.tensor(target_idx, dtype=torch.float32)
         else:
             start_y = self.len_inp_sequence
             end_y = self.len_inp_sequence + self.len_out_sequence
-            y = torch.cat(sequence['images'][start_y:end_y]) if self.len_out_sequence > 0 else 0
+            y = get_frames(start_y, end_y) if self.len_out_sequence > 0 else 0
             question = -1
 
         if self.load_ground_truth:
-            ground_truth = np.load(sequence['ground_truth'])
+            ground_truth = self.get_ground_truth(index)
         else:
             ground_truth = 0
 
@@ -121,8 +379,725 @@ class CustomDataset(Dataset):
         else:
             return x, y, question, ground_truth
 
+    def get_packed_sequence(self, index):
+        """
+        Returns the frames of a packed sequence as uint8 array of shape [len_sequence, window_size_y, window_size_x],
+        or as float tensor for ram_format 'float'
+        """
+        if self.load_to_ram:
+            row = self.ram_rows[index]
+
+            if row < 0:
+                raise Exception('Sequence {} was not loaded to RAM, add it to load_indices'.format(index))
+
+            if self.ram_format == 'bits':
+                return np.unpackbits(self.frames[row], axis=-1, count=self.frame_width) * np.uint8(255)
+
+            return self.frames[row]
+
+        return self.frames[index]
+
+    def set_resolution(self, resolution):
+        """
+        Switches to the frames of another resolution of the dataset pyramid, None for the generated resolution
+        """
+        if not self.packed:
+            raise Exception('Only packed datasets can contain multiple resolutions')
+
+        if resolution == self.resolution:
+            return
+
+        # Free the store of the old resolution before the new one is loaded
+        self.release_frames()
+
+        frames = open_packed_frames(self.path, mmap_mode='r', resolution=resolution)
+        self.resolution = resolution
+
+        if self.load_to_ram:
+            self.frames = self.keep_frames_in_ram(lambda: self.cache_frames(self.select_ram_sequences(frames)),
+                                                  resolution)
+        else:
+            self.frames = self.cache_frames(frames)
+
+    def release_frames(self):
+        self.frames = None
+
+        for segment in self.shared_memory_segments:
+            detach_shared_frames(segment)
+
+        segments = self.released_segments + self.shared_memory_segments
+        self.shared_memory_segments = []
+        self.released_segments = []
+
+        for segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                # A sample still views the segment, try again with the next release
+                self.released_segments.append(segment)
+
+    def close(self):
+        """
+        Releases the frames and closes the shared memory segments of the dataset. The last process that closes a
+        segment removes it. Call it when the dataset isn't used anymore, closing the segments in SharedMemory.__del__
+        at exit fails while the frames still view them
+        """
+        self.release_frames()
+
+        if len(self.released_segments) > 0:
+            # Samples that view the frames may only wait for the garbage collector
+            gc.collect()
+            self.release_frames()
+
+        if len(self.released_segments) > 0:
+            print("{} shared memory segments are still viewed by samples of the dataset".format(
+                len(self.released_segments)))
+
     def get_ground_truth(self, index):
-        return np.load(self.sequences[self.sequence_paths[index]]['ground_truth'])
+        return np.array(self.get_ground_truth_array()[index])
+
+    def get_ground_truths(self, indices=None):
+        """
+        Returns the ground truth of the sequences with the given indices, all if None, as array of shape
+        [len(indices), len_sequence, 6]
+        """
+        if indices is None:
+            return np.array(self.get_ground_truth_array())
+
+        return self.get_ground_truth_array()[np.asarray(indices, dtype=np.int64)]
+
+    def get_ground_truth_array(self):
+        """
+        Returns the ground truth of all sequences as memory mapped array of shape [num_sequences, len_sequence, 6].
+        Datasets with single files read it from the consolidated ground truth file, which is built on the first access
+        if the generator didn't write it
+        """
+        if self.ground_truths is None:
+            ground_truth_path = os.path.join(self.path, CONSOLIDATED_GROUND_TRUTH)
+
+            if os.path.exists(ground_truth_path):
+                self.ground_truths = np.load(ground_truth_path, mmap_mode='r')
+
+            if self.ground_truths is None or self.ground_truths.shape[0] != len(self.sequence_paths):
+                ground_truths = np.stack([np.load(self.sequences[seq_path]['ground_truth'])
+                                          for seq_path in self.sequence_paths])
+
+                try:
+                    save_ground_truths(self.path, ground_truths)
+                    self.ground_truths = np.load(ground_truth_path, mmap_mode='r')
+                except OSError:
+                    print("Could not save the consolidated ground truth of {}".format(self.path))
+                    self.ground_truths = ground_truths
+
+        return self.ground_truths
+
+    def set_readahead_sampler(self, sampler, batch_size):
+        """
+        Reads the sequences ahead in the order of the sampler. The batch size tells the DataLoader workers which of the
+        upcoming indices they will get
+        """
+        self.readahead_sampler = sampler
+        self.readahead_batch_size = batch_size
+
+    def init_cache(self):
+        # Threads and locks don't survive the fork into a DataLoader worker, so every process creates its own
+        if self.cache_pid == os.getpid():
+            return
+
+        self.cache_pid = os.getpid()
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.cache_lock = threading.Lock()
+        self.readahead_queued = set()
+        self.readahead_queue = queue.Queue()
+
+        if self.readahead > 0:
+            threading.Thread(target=self.read_ahead_loop, daemon=True).start()
+
+    def get_cached_sequence(self, index):
+        self.init_cache()
+
+        with self.cache_lock:
+            sequence = self.cache.get(index)
+
+            if sequence is not None:
+                self.cache.move_to_end(index)
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+        if sequence is None:
+            sequence = self.load_sequence(self.sequence_paths[index])
+            self.add_to_cache(index, sequence)
+
+        if self.readahead > 0 and self.readahead_sampler is not None:
+            with self.cache_lock:
+                upcoming = [i for i in self.get_upcoming_indices(index)
+                            if i not in self.cache and i not in self.readahead_queued]
+                self.readahead_queued.update(upcoming)
+
+            for i in upcoming:
+                self.readahead_queue.put(i)
+
+        return sequence
+
+    def add_to_cache(self, index, sequence):
+        num_bytes = sequence.nbytes if not torch.is_tensor(sequence) else sequence.element_size() * sequence.nelement()
+
+        if num_bytes > self.cache_bytes:
+            return
+
+        with self.cache_lock:
+            if index in self.cache:
+                return
+
+            self.cache[index] = sequence
+            self.cache_size += num_bytes
+
+            # Evict the least recently used sequences
+            while self.cache_size > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_size -= evicted.nbytes if not torch.is_tensor(evicted) else \
+                    evicted.element_size() * evicted.nelement()
+
+    def get_upcoming_indices(self, index):
+        """
+        Returns the next indices of the readahead sampler after index that the current process will get
+        """
+        order, positions = self.readahead_sampler.get_order()
+
+        if index not in positions:
+            return []
+
+        position = positions[index] + 1
+        worker_info = get_worker_info()
+
+        if worker_info is None:
+            return order[position:position + self.readahead]
+
+        # The DataLoader hands out the batches to its workers in turn
+        upcoming = []
+
+        while len(upcoming) < self.readahead and position < len(order):
+            if (position // self.readahead_batch_size) % worker_info.num_workers == worker_info.id:
+                upcoming.append(order[position])
+                position += 1
+            else:
+                position = (position // self.readahead_batch_size + 1) * self.readahead_batch_size
+
+        return upcoming
+
+    def read_ahead_loop(self):
+        while True:
+            index = self.readahead_queue.get()
+
+            try:
+                with self.cache_lock:
+                    cached = index in self.cache
+
+                if not cached:
+                    self.add_to_cache(index, self.load_sequence(self.sequence_paths[index]))
+            except Exception as e:
+                # Keep reading ahead, the sample loads the sequence again and raises the error there
+                print("Could not read sequence {} ahead: {}".format(index, e))
+            finally:
+                with self.cache_lock:
+                    self.readahead_queued.discard(index)
+
+    def get_cache_statistics(self):
+        """
+        Returns the hits and misses of the sequence cache of this process and how much of the budget it uses
+        """
+        num_requests = self.cache_hits + self.cache_misses
+
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / num_requests if num_requests > 0 else 0.,
+            'num_sequences': len(self.cache) if self.cache_pid is not None else 0,
+            'bytes': self.cache_size if self.cache_pid is not None else 0
+        }
+
+    def __getstate__(self):
+        # Locks, queues and threads can't be pickled, the process that unpickles the dataset creates new ones
+        state = self.__dict__.copy()
+
+        for key in ['cache', 'cache_size', 'cache_lock', 'readahead_queued', 'readahead_queue']:
+            state.pop(key, None)
+
+        state['cache_pid'] = None
+
+        return state
 
     def __len__(self):
         return len(self.sequence_paths)
+
+
+class DistributedSubsetSampler(DistributedSampler):
+    """
+    DistributedSampler over the given indices of a dataset instead of all of them
+    """
+    def __init__(self, indices, **kwargs):
+        self.indices = list(indices)
+        super(DistributedSubsetSampler, self).__init__(self.indices, **kwargs)
+
+    def __iter__(self):
+        return (self.indices[i] for i in super(DistributedSubsetSampler, self).__iter__())
+
+
+class ReadaheadSampler(Sampler):
+    """
+    Samples the indices in an order that the dataset can predict to read the upcoming sequences ahead.
+    The order of every epoch only depends on the seed and the epoch, so the copies of the sampler in the DataLoader
+    workers know it as well. The epoch lives in shared memory, so persistent workers see it advance too.
+    """
+    def __init__(self, indices, shuffle=True, seed=None):
+        self.indices = list(indices)
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else int(torch.randint(2 ** 31, (1,)))
+        # Every pass starts the next epoch, the first one is epoch 0
+        self.shared_epoch = multiprocessing.Value('q', -1, lock=False)
+        self.order = None
+
+    @property
+    def epoch(self):
+        return self.shared_epoch.value
+
+    def get_order(self):
+        """
+        Returns the order of the current epoch and the position of every index in it
+        """
+        if self.order is None or self.order[0] != self.epoch:
+            if self.shuffle:
+                generator = torch.Generator().manual_seed(self.seed * 100003 + self.epoch)
+                order = [self.indices[i] for i in torch.randperm(len(self.indices), generator=generator).tolist()]
+            else:
+                order = self.indices
+
+            self.order = (self.epoch, order, {index: position for position, index in enumerate(order)})
+
+        return self.order[1], self.order[2]
+
+    def __iter__(self):
+        # Only the main process iterates, the workers read the epoch from shared memory. A pass starts after the
+        # DataLoader handed out all indices of the previous one, so the workers look every index up in its epoch
+        self.shared_epoch.value += 1
+        order, _ = self.get_order()
+
+        for index in order:
+            yield index
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def render_frames(x, y, window_size_x, window_size_y, ball_radius, anti_aliasing=False, scale=1.):
+    """
+    Renders the ball for a whole block of sequences at once
+    Without anti-aliasing the frames are pixel for pixel the ones ImageDraw.ellipse draws with the bounding box
+    [x - ball_radius, y - ball_radius, x + ball_radius, y + ball_radius], also at fractional positions.
+    With anti-aliasing the pixel intensity falls off linearly over one pixel around the edge of the ball.
+    Args:
+        x: torch.tensor, shape [num_sequences, len_sequence], x positions of the ball
+        y: torch.tensor, shape [num_sequences, len_sequence], y positions of the ball
+        scale: render the frames at scale times the window size, e.g. 0.5 for 32x32 frames of a 64x64 window
+    Returns:
+        frames: torch.tensor, dtype uint8, shape [num_sequences, len_sequence, window_size_y, window_size_x]
+    """
+    x = torch.as_tensor(x, dtype=torch.float32)
+    y = torch.as_tensor(y, dtype=torch.float32)
+
+    if scale != 1:
+        # Pixel i covers [i - 0.5, i + 0.5], so the window starts at -0.5 for every scale
+        x = (x + 0.5) * scale - 0.5
+        y = (y + 0.5) * scale - 0.5
+        window_size_x = int(round(window_size_x * scale))
+        window_size_y = int(round(window_size_y * scale))
+        ball_radius = ball_radius * scale
+
+    if not anti_aliasing:
+        return render_ellipses(x, y, window_size_x, window_size_y, ball_radius)
+
+    # The squared distance is separable, so compute it per column and per row and broadcast
+    dx = torch.arange(window_size_x, dtype=torch.float32).view(1, 1, 1, -1) - x.unsqueeze(-1).unsqueeze(-1)
+    dy = torch.arange(window_size_y, dtype=torch.float32).view(1, 1, -1, 1) - y.unsqueeze(-1).unsqueeze(-1)
+    squared_distance = dx * dx + dy * dy
+
+    edge = ball_radius + 0.5
+
+    coverage = (edge + 0.5 - squared_distance.sqrt()).clamp(0, 1)
+    return (coverage * 255).round().to(torch.uint8)
+
+
+def render_ellipses(x, y, window_size_x, window_size_y, ball_radius):
+    """
+    Renders the ball like ImageDraw.ellipse. PIL truncates the corners of the bounding box to integers and fills the
+    same rows for every box of the same size, so the rows of the box sizes in the block are drawn once with PIL and
+    moved to the truncated corners of every frame
+    """
+    x0 = torch.trunc(x - ball_radius).long()
+    y0 = torch.trunc(y - ball_radius).long()
+    widths = torch.trunc(x + ball_radius).long() - x0
+    heights = torch.trunc(y + ball_radius).long() - y0
+
+    min_width, max_width = int(widths.min()), int(widths.max())
+    min_height, max_height = int(heights.min()), int(heights.max())
+
+    # The ellipse covers one run of pixels per row. starts and ends[width - min_width, height - min_height, row] are
+    # the first and last pixel of the run of a box with that size at the origin, rows outside the box are empty
+    starts = torch.full((max_width - min_width + 1, max_height - min_height + 1, max_height + 3), max_width + 1)
+    ends = torch.full_like(starts, -1)
+
+    for width in range(min_width, max_width + 1):
+        for height in range(min_height, max_height + 1):
+            image = Image.new(mode='L', size=(width + 1, height + 1))
+            ImageDraw.Draw(image).ellipse(xy=[(0, 0), (width, height)], width=0, fill='white')
+
+            for row, pixels in enumerate(np.asarray(image) > 0):
+                columns = np.flatnonzero(pixels)
+                if len(columns) > 0:
+                    # Row 0 is above the box
+                    starts[width - min_width, height - min_height, row + 1] = int(columns[0])
+                    ends[width - min_width, height - min_height, row + 1] = int(columns[-1])
+
+    # Row of every pixel row in the box of its frame, the rows above and below the box map to an empty row
+    rows = (torch.arange(window_size_y).view(1, 1, -1) - y0.unsqueeze(-1) + 1).clamp(0, max_height + 2)
+    box_sizes = (widths - min_width).unsqueeze(-1), (heights - min_height).unsqueeze(-1)
+    row_starts = (starts[box_sizes + (rows,)] + x0.unsqueeze(-1)).unsqueeze(-1)
+    row_ends = (ends[box_sizes + (rows,)] + x0.unsqueeze(-1)).unsqueeze(-1)
+
+    columns = torch.arange(window_size_x).view(1, 1, 1, -1)
+
+    return ((columns >= row_starts) & (columns <= row_ends)).to(torch.uint8) * 255
+
+
+def create_packed_dataset(path, num_sequences, len_sequence, window_size_x, window_size_y, resolutions=()):
+    """
+    Creates the files of a packed dataset: all frames in one uint8 array of shape
+    [num_sequences, len_sequence, window_size_y, window_size_x], all ground truth in one float32 array of shape
+    [num_sequences, len_sequence, 6] and a header describing them. The arrays get filled via open_packed_dataset.
+    For every additional resolution (frame width in pixels) there is another frames array with smaller or larger frames.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    resolutions = [resolution for resolution in resolutions if resolution != window_size_x]
+
+    header = {
+        'num_sequences': num_sequences,
+        'len_sequence': len_sequence,
+        'window_size_x': window_size_x,
+        'window_size_y': window_size_y,
+        'resolutions': resolutions
+    }
+
+    with open(os.path.join(path, PACKED_HEADER), 'wb') as f:
+        pickle.dump(header, f)
+
+    np.lib.format.open_memmap(os.path.join(path, PACKED_FRAMES), mode='w+', dtype=np.uint8,
+                              shape=(num_sequences, len_sequence, window_size_y, window_size_x))
+    np.lib.format.open_memmap(os.path.join(path, PACKED_GROUND_TRUTH), mode='w+', dtype=np.float32,
+                              shape=(num_sequences, len_sequence, 6))
+
+    for resolution in resolutions:
+        np.lib.format.open_memmap(os.path.join(path, get_packed_frames_file(resolution)), mode='w+', dtype=np.uint8,
+                                  shape=(num_sequences, len_sequence,
+                                         int(round(window_size_y * resolution / window_size_x)), resolution))
+
+
+def open_packed_dataset(path, mmap_mode='r'):
+    """
+    Opens the frames and ground truth arrays of a packed dataset as memory maps
+    Use mmap_mode='r+' to write to them and mmap_mode=None to load them to RAM
+    """
+    frames = open_packed_frames(path, mmap_mode=mmap_mode)
+    ground_truth = np.load(os.path.join(path, PACKED_GROUND_TRUTH), mmap_mode=mmap_mode)
+
+    return frames, ground_truth
+
+
+def open_packed_frames(path, mmap_mode='r', resolution=None):
+    """
+    Opens the frames of a packed dataset at the given resolution, the generated resolution if it is None
+    """
+    with open(os.path.join(path, PACKED_HEADER), 'rb') as f:
+        header = pickle.load(f)
+
+    if resolution is not None and resolution != header['window_size_x']:
+        if resolution not in header.get('resolutions', []):
+            raise Exception('The dataset in {} does not contain frames with resolution {}'.format(path, resolution))
+
+        return np.load(os.path.join(path, get_packed_frames_file(resolution)), mmap_mode=mmap_mode)
+
+    return np.load(os.path.join(path, PACKED_FRAMES), mmap_mode=mmap_mode)
+
+
+def get_packed_frames_file(resolution):
+    return 'frames_{}.npy'.format(resolution)
+
+
+def resize_packed_dataset(path, num_sequences):
+    """
+    Changes the number of sequences of a packed dataset. Existing sequences are kept, new sequences are empty
+    """
+    with open(os.path.join(path, PACKED_HEADER), 'rb') as f:
+        header = pickle.load(f)
+
+    if header['num_sequences'] == num_sequences:
+        return
+
+    file_names = [PACKED_FRAMES, PACKED_GROUND_TRUTH]
+    file_names.extend(get_packed_frames_file(resolution) for resolution in header.get('resolutions', []))
+
+    # Copy the old arrays into new ones and replace them afterwards, so a crash doesn't leave a broken dataset
+    num_kept = min(header['num_sequences'], num_sequences)
+
+    for file_name in file_names:
+        array = np.load(os.path.join(path, file_name), mmap_mode='r')
+        resized = np.lib.format.open_memmap(os.path.join(path, file_name + '.tmp'), mode='w+', dtype=array.dtype,
+                                            shape=(num_sequences,) + array.shape[1:])
+        resized[:num_kept] = array[:num_kept]
+        resized.flush()
+        del array, resized
+
+    for file_name in file_names:
+        os.replace(os.path.join(path, file_name + '.tmp'), os.path.join(path, file_name))
+
+    header['num_sequences'] = num_sequences
+
+    with open(os.path.join(path, PACKED_HEADER), 'wb') as f:
+        pickle.dump(header, f)
+
+
+def create_sequence_index(path, num_sequences, len_sequence):
+    """
+    Writes the index of a dataset in the layout of the generators: seq{i}/frame{j}.jpeg and seq{i}/ground_truth.npy
+    """
+    save_sequence_index(path, [('seq' + str(i), ['frame' + str(j) + '.jpeg' for j in range(len_sequence)])
+                               for i in range(num_sequences)])
+
+
+def save_ground_truths(path, ground_truths):
+    """
+    Saves the ground truth of all sequences of a dataset with single files as one array
+    """
+    # Write to a temporary file first, so an interrupted write doesn't leave a broken file
+    with open(os.path.join(path, CONSOLIDATED_GROUND_TRUTH + '.tmp'), 'wb') as f:
+        np.save(f, ground_truths)
+
+    os.replace(os.path.join(path, CONSOLIDATED_GROUND_TRUTH + '.tmp'), os.path.join(path, CONSOLIDATED_GROUND_TRUTH))
+
+
+def save_sequence_index(path, sequences):
+    # Write to a temporary file first, so an interrupted write doesn't leave a broken index
+    with open(os.path.join(path, SEQUENCE_INDEX + '.tmp'), 'wb') as f:
+        pickle.dump(sequences, f)
+
+    os.replace(os.path.join(path, SEQUENCE_INDEX + '.tmp'), os.path.join(path, SEQUENCE_INDEX))
+
+
+def load_sequence_index(path):
+    """
+    Returns the sequences of a dataset as list of (sequence directory, frame file names) or None without an index
+    """
+    if not os.path.exists(os.path.join(path, SEQUENCE_INDEX)):
+        return None
+
+    with open(os.path.join(path, SEQUENCE_INDEX), 'rb') as f:
+        return pickle.load(f)
+
+
+def decode_sequence(args):
+    """
+    Decodes the images of a sequence. Returns a uint8 array of shape [len_sequence, height, width] without a
+    transform, otherwise a float32 array of the transformed frames. Arrays are cheaper to send between processes
+    """
+    images, transform = args
+
+    if transform is None:
+        return np.stack([load_grayscale(img) for img in images])
+
+    return torch.cat([transform(pil_loader(img)) for img in images]).numpy()
+
+
+def load_grayscale(path):
+    # Decode a JPEG to a single channel uint8 array without the detour over RGB of pil_loader
+    with open(path, 'rb') as f:
+        return np.asarray(Image.open(f).convert('L'))
+
+
+def get_shared_memory_name(path, ram_format, resolution=None, indices=None):
+    # Regenerating a dataset rewrites its config, so its modification time tells different versions apart
+    config_path = os.path.join(path, 'config.p')
+    modification_time = os.path.getmtime(config_path) if os.path.exists(config_path) else 0
+
+    # Runs that load different subsets of the dataset use different segments
+    indices_hash = hashlib.md5(np.asarray(indices).tobytes()).hexdigest() if indices is not None else None
+
+    key = '{}|{}|{}|{}|{}'.format(os.path.abspath(path), ram_format, resolution, modification_time, indices_hash)
+
+    return 'dl4cv_' + hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def create_shared_frames(name, frames, frame_width):
+    """
+    Copies the frames to a new shared memory segment and returns (segment, read-only frames, frame_width),
+    or None if the segment already exists
+    """
+    frames = frames.numpy() if torch.is_tensor(frames) else frames
+
+    header_size = SHARED_HEADER_LENGTH * np.dtype(np.int64).itemsize
+
+    try:
+        segment = shared_memory.SharedMemory(name=name, create=True, size=header_size + frames.nbytes)
+    except FileExistsError:
+        return None
+
+    # Don't remove the segment when this process exits, other processes may still use it
+    resource_tracker.unregister(segment._name, 'shared_memory')
+
+    header = np.ndarray((SHARED_HEADER_LENGTH,), dtype=np.int64, buffer=segment.buf)
+    # Lets waiting processes notice if this process dies before the segment is ready
+    header[SHARED_PID] = os.getpid()
+    header[1] = SHARED_DTYPES.index(frames.dtype.type)
+    header[2] = frame_width
+    header[3] = frames.ndim
+    header[4:4 + frames.ndim] = frames.shape
+    header[SHARED_USERS] = 1
+
+    shared_frames = get_segment_array(segment, frames.shape, frames.dtype, header_size)
+    shared_frames[:] = frames
+    shared_frames.flags.writeable = False
+
+    # Mark the segment as ready last
+    header[0] = 1
+
+    return segment, shared_frames, frame_width
+
+
+def attach_shared_frames(name):
+    """
+    Returns (segment, read-only frames, frame_width) of an existing shared memory segment or None if it doesn't exist.
+    Waits until the process that creates the segment has copied the frames. If that process died or doesn't finish
+    within SHARED_TIMEOUT seconds, the stale segment is removed and None is returned, so the caller rebuilds it
+    """
+    header_size = SHARED_HEADER_LENGTH * np.dtype(np.int64).itemsize
+    deadline = time.time() + SHARED_TIMEOUT
+
+    while True:
+        try:
+            segment = shared_memory.SharedMemory(name=name)
+            break
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # The segment was created but doesn't have its size yet
+            if time.time() > deadline:
+                raise Exception('Shared memory segment {} never got a size, remove /dev/shm/{} and try again'.format(
+                    name, name))
+            time.sleep(0.1)
+
+    resource_tracker.unregister(segment._name, 'shared_memory')
+
+    header = np.ndarray((SHARED_HEADER_LENGTH,), dtype=np.int64, buffer=segment.buf)
+
+    if header[0] == 0:
+        print("Waiting for another process to load the dataset to shared memory segment {}".format(name))
+
+    while header[0] == 0:
+        creator = int(header[SHARED_PID])
+
+        # A pid of 0 means the creator hasn't written it yet
+        if (creator != 0 and not is_process_alive(creator)) or time.time() > deadline:
+            print("Shared memory segment {} is stale, rebuilding it".format(name))
+            del header
+            segment.close()
+
+            try:
+                # unlink() unregisters the segment from the resource tracker again
+                resource_tracker.register(segment._name, 'shared_memory')
+                segment.unlink()
+            except FileNotFoundError:
+                # Another waiting process removed it first
+                pass
+
+            return None
+
+        time.sleep(1)
+
+    with lock_segment(segment):
+        if header[SHARED_USERS] == 0:
+            # The last user is removing the segment, build a new one
+            del header
+            segment.close()
+            return None
+
+        header[SHARED_USERS] += 1
+
+    shape = tuple(header[4:4 + header[3]])
+
+    frames = get_segment_array(segment, shape, SHARED_DTYPES[header[1]], header_size)
+    frames.flags.writeable = False
+
+    return segment, frames, int(header[2])
+
+
+def detach_shared_frames(segment):
+    """
+    Counts the process out of the users of a shared memory segment that it created or attached to and removes the
+    segment if no other process uses it anymore. The segment still has to be closed
+    """
+    header = np.ndarray((SHARED_HEADER_LENGTH,), dtype=np.int64, buffer=segment.buf)
+
+    with lock_segment(segment):
+        header[SHARED_USERS] -= 1
+
+        if header[SHARED_USERS] == 0:
+            try:
+                # unlink() unregisters the segment from the resource tracker again
+                resource_tracker.register(segment._name, 'shared_memory')
+                segment.unlink()
+            except FileNotFoundError:
+                # Removed by hand
+                pass
+
+
+@contextmanager
+def lock_segment(segment):
+    """
+    Locks the users count of a shared memory segment against the other processes
+    """
+    fcntl.flock(segment._fd, fcntl.LOCK_EX)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(segment._fd, fcntl.LOCK_UN)
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        pass
+
+    return True
+
+
+def get_segment_array(segment, shape, dtype, offset):
+    # Unlike np.ndarray(buffer=...), frombuffer holds an export of the buffer, so the segment can't be closed while
+    # an array or tensor still views it
+    return np.frombuffer(segment.buf, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+def get_default_load_workers():
+    # Every process of a distributed run loads its frames with its own pool, so they share the cores
+    world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    return max(1, (os.cpu_count() or 1) // world_size)
+
+
+def is_packed_dataset(path):
+    return os.path.isfile(os.path.join(path, PACKED_HEADER))
@@ -6,7 +6,8 @@ from dl4cv.utils import Config
 import numpy as np
 import torch
 
-from PIL import Image, ImageDraw
+from PIL import Image
+from dl4cv.dataset.utils import render_frames, create_sequence_index, save_ground_truths
 from dl4cv.eval.eval_functions import analyze_dataset
 
 config = Config({
@@ -18,7 +19,9 @@ config = Config({
     'ball_radius': 2,
     't_frame': 1 / 30,
     'eval_before_generating': True,  # Evaluate the dataset before generating it
-    'mode': 'lines',                # plot mode for evaluation 'lines' or 'points'
+    'mode': 'density',              # plot mode for evaluation 'lines', 'points' or 'density'
+    'anti_aliasing': False,         # Render the ball with anti-aliased edges
+    'render_block_size': 512,       # Number of sequences to render at once
     'generate': False                # Generate the dataset
 })
 
@@ -74,21 +77,6 @@ def get_collisions(x, y, x_min, x_max, y_min, y_max):
     return collisions
 
 
-def draw_ball(screen, window_size_x, window_size_y, ball_radius, x, y):
-    # Reset to a black image
-    screen.rectangle(
-        xy=[(0, 0), (window_size_x, window_size_y)],
-        fill='black',
-        outline=None
-    )
-    # Draw the ball on the clean image
-    screen.ellipse(
-        xy=[(x - ball_radius, y - ball_radius), (x + ball_radius, y + ball_radius)],
-        width=0,
-        fill='white'
-    )
-
-
 def get_initial_velocities(x_start, x_end, y_start, y_end, ax, ay, t_end):
     vx_0 = (x_end - x_start - 0.5 * ax * t_end * t_end) / t_end
     vy_0 = (y_end - y_start - 0.5 * ay * t_end * t_end) / t_end
@@ -106,11 +94,6 @@ def get_trajectories(x_start, y_start, vx_start, vy_start, ax, ay, t_frame, sequ
 def generate_data(c):
     t_end = (c.sequence_length - 1) * c.t_frame
 
-    # create image to draw on
-    img = Image.new(mode="L", size=(c.window_size_x, c.window_size_y))
-    # create screen
-    screen = ImageDraw.Draw(img)
-
     # Initialize x,y,vx,vy,ax,ay
     x_start, y_start, vx_start, vy_start, x_end, y_end, ax, ay = [torch.zeros((c.num_sequences,)) for i in range(8)]
 
@@ -193,42 +176,52 @@ def generate_data(c):
         with open(os.path.join(c.save_dir_path, 'config.p'), 'wb') as f:
             pickle.dump(c, f)
 
-        # Generate frames for the sequences
-        for i_sequence in range(c.num_sequences):
+        # Generate frames for the sequences. Render blocks of sequences at once to limit the memory footprint
+        for i_block in range(0, c.num_sequences, c.render_block_size):
+            block = slice(i_block, min(i_block + c.render_block_size, c.num_sequences))
 
-            save_path_sequence = os.path.join(
-                c.save_dir_path,
-                'seq' + str(i_sequence)
-            )
+            frames = render_frames(x[block], y[block], c.window_size_x, c.window_size_y, c.ball_radius,
+                                   anti_aliasing=c.anti_aliasing).numpy()
 
-            os.makedirs(save_path_sequence, exist_ok=True)
+            for i_block_sequence in range(frames.shape[0]):
+                i_sequence = i_block + i_block_sequence
 
-            ground_truth = np.zeros((c.sequence_length, 6))
+                save_path_sequence = os.path.join(
+                    c.save_dir_path,
+                    'seq' + str(i_sequence)
+                )
 
-            for i_frame in range(c.sequence_length):
+                os.makedirs(save_path_sequence, exist_ok=True)
 
-                save_path_frame = os.path.join(
-                    save_path_sequence,
-                    'frame' + str(i_frame) + '.jpeg'
-                )
+                for i_frame in range(c.sequence_length):
 
-                ground_truth[i_frame] = np.array([x[i_sequence, i_frame], y[i_sequence, i_frame],
-                                                  vx[i_sequence, i_frame], vy[i_sequence, i_frame],
-                                                  ax[i_sequence], ay[i_sequence]])
+                    save_path_frame = os.path.join(
+                        save_path_sequence,
+                        'frame' + str(i_frame) + '.jpeg'
+                    )
 
-                draw_ball(screen, c.window_size_x, c.window_size_y, c.ball_radius, x[i_sequence, i_frame], y[i_sequence, i_frame])
-                img.save(save_path_frame)
+                    Image.fromarray(frames[i_block_sequence, i_frame]).save(save_path_frame)
 
-            # Save the values at the last
-            save_path_ground_truth = os.path.join(
-                save_path_sequence,
-                'ground_truth'
-            )
-            np.save(save_path_ground_truth, ground_truth)
+                ground_truth = torch.stack([x[i_sequence], y[i_sequence],
+                                            vx[i_sequence], vy[i_sequence],
+                                            ax[i_sequence].repeat(c.sequence_length),
+                                            ay[i_sequence].repeat(c.sequence_length)], dim=1).double().numpy()
+
+                # Save the values at the last
+                save_path_ground_truth = os.path.join(
+                    save_path_sequence,
+                    'ground_truth'
+                )
+                np.save(save_path_ground_truth, ground_truth)
+
+                if (i_sequence+1) % 100 == 0:
+                    print("Generated sequence: %d of %d with length %d ..." % (
+                        i_sequence+1, c.num_sequences, c.sequence_length))
 
-            if (i_sequence+1) % 100 == 0:
-                print("Generated sequence: %d of %d with length %d ..." % (
-                    i_sequence+1, c.num_sequences, c.sequence_length))
+        create_sequence_index(c.save_dir_path, c.num_sequences, c.sequence_length)
+        save_ground_truths(c.save_dir_path, torch.stack([x, y, vx, vy,
+                                                         ax.view(-1, 1).expand_as(x),
+                                                         ay.view(-1, 1).expand_as(x)], dim=2).double().numpy())
 
 
 if __name__ == '__main__':
@@ -1,13 +1,16 @@
+import copy
 import os
 import pickle
 
 import numpy as np
 
 import torch
-import torchvision.transforms as transforms
 
 from dl4cv.dataset.utils import CustomDataset
+from dl4cv.dataset.generateEvalDataset import generate_fixed_factor_batch_pairs
 from dl4cv.solver import Solver
+from dl4cv.models.models import compile_model
+from dl4cv.utils import benchmark_mixed_precision
 from dl4cv.eval.eval_functions import \
     analyze_dataset, \
     show_solver_history, \
@@ -19,6 +22,7 @@ from dl4cv.eval.eval_functions import \
     show_latent_walk_gifs, \
     walk_over_question, \
     eval_disentanglement, \
+    compute_disentanglement_metric, \
     MIG
 
 
@@ -40,9 +44,10 @@ def evaluate(config):
         model_paths = []
         solver_paths = []
 
-        for _, _, fnames in os.walk(save_path):
-            model_paths = [fname for fname in fnames if 'model' in fname]
-            solver_paths = [fname for fname in fnames if 'solver' in fname]
+        # Only the files in save_path, the history directory beside them holds no checkpoints
+        fnames = [fname for fname in os.listdir(save_path) if os.path.isfile(os.path.join(save_path, fname))]
+        model_paths = [fname for fname in fnames if 'model' in fname]
+        solver_paths = [fname for fname in fnames if 'solver' in fname]
 
         if not model_paths or not solver_paths:
             raise Exception('Model or solver not found.')
@@ -61,10 +66,7 @@ def evaluate(config):
 
     dataset = CustomDataset(
         config['data_path'],
-        transform=transforms.Compose([
-            transforms.Grayscale(),
-            transforms.ToTensor()
-        ]),
+        transform=None,
         len_inp_sequence=config['len_inp_sequence'],
         len_out_sequence=config['len_out_sequence'],
         load_ground_truth=True,
@@ -82,10 +84,10 @@ def evaluate(config):
         indices = np.linspace(0, len(dataset) - 1, config['num_samples'], dtype=int).tolist()
 
         dataset_list = [dataset[i] for i in indices]
-        ground_truth = [dataset.get_ground_truth(i) for i in indices]
+        ground_truth = dataset.get_ground_truths(indices)
     else:
         dataset_list = dataset
-        ground_truth = [dataset.get_ground_truth(i) for i in range(len(dataset))]
+        ground_truth = dataset.get_ground_truths()
 
     model_path, solver_path = get_model_solver_paths(config['save_path'], config['epoch'])
 
@@ -95,6 +97,19 @@ def evaluate(config):
     model = torch.load(model_path, map_location=device)
     model.eval()
 
+    if config.get('mixed_precision', False):
+        model.set_mixed_precision(True)
+
+        x, _, question, _ = dataset[0]
+        t_fp32, t_bf16 = benchmark_mixed_precision(model, x.unsqueeze(0).to(device),
+                                                   torch.as_tensor(question).view(1).to(device), backward=False)
+        print("Time/sample float32: {:.1f}ms   bfloat16 autocast: {:.1f}ms   speedup: {:.2f}x".format(
+            t_fp32, t_bf16, t_fp32 / t_bf16))
+
+    if config.get('compile_model', False):
+        # Most eval functions call encode() and decode() instead of the model
+        model = compile_model(model, ['encode', 'decode'])
+
     if config['analyze_dataset']:
         print("Analysing dataset")
         if config['num_samples'] is not None:
@@ -102,13 +117,15 @@ def evaluate(config):
         else:
             indices = range(len(dataset))
 
-        trajectories = np.array([dataset.get_ground_truth(i) for i in indices])
+        # Load and analyze the ground truth in chunks
+        trajectories = (dataset.get_ground_truths(indices[i_chunk:i_chunk + 1024])
+                        for i_chunk in range(0, len(indices), 1024))
 
         analyze_dataset(
             trajectories,
             window_size_x=dataset_config.window_size_x,
             window_size_y=dataset_config.window_size_y,
-            mode='lines')
+            mode=config.get('analyze_mode', 'density'))
 
     if config['show_solver_history']:
         print("Showing solver history")
@@ -146,10 +163,10 @@ def evaluate(config):
             indices = np.linspace(0, len(dataset) - 1, config['num_samples'], dtype=int).tolist()
 
             dataset_list = [dataset[i] for i in indices]
-            ground_truth = [dataset.get_ground_truth(i) for i in indices]
+            ground_truth = dataset.get_ground_truths(indices)
         else:
             dataset_list = dataset
-            ground_truth = [dataset.get_ground_truth(i) for i in range(len(dataset))]
+            ground_truth = dataset.get_ground_truths()
 
         if mu is None:
             z, mu = show_latent_variables(model, dataset_list, show=False)
@@ -162,34 +179,54 @@ def evaluate(config):
 
     if config['eval_disentanglement']:
         print("Evaluating disentanglement")
-        # load eval dataset to list
-        paths = [os.path.join(config['eval_data_path'], path) for path in dataset_config.latent_names]
-        eval_datasets = [
-            CustomDataset(
-                path,
-                transform=transforms.Compose([
-                    transforms.Grayscale(),
-                    transforms.ToTensor()
-                ]),
-                len_inp_sequence=config['len_inp_sequence'],
-                len_out_sequence=config['len_out_sequence'],
-                load_ground_truth=True,
-                question=config['use_question'],
-                load_to_ram=False,
-                load_config=True,
-            )
-            for path in paths]
-
-        eval_disentanglement(model, eval_datasets, device, num_epochs=100)
+        if config.get('eval_disentanglement_in_memory', False):
+            # Synthesize the batch pairs on demand instead of loading the eval dataset
+            eval_dataset_config = copy.deepcopy(dataset_config)
+            eval_dataset_config.num_sequences = config.get('num_eval_sequences', 2048 + 512)
+            eval_dataset_config.batch_size = config.get('eval_batch_size', 16)
+
+            # The same start variables as generateEvalDataset.py without touching the global random numbers
+            random_state = np.random.RandomState(dataset_config.seed)
+
+            batch_pairs = [
+                generate_fixed_factor_batch_pairs(eval_dataset_config, i_latent, config['len_inp_sequence'],
+                                                  random_state)
+                for i_latent in range(len(dataset_config.latent_names))]
+
+            compute_disentanglement_metric(model, batch_pairs, device)
+
+        else:
+            # load eval dataset to list
+            paths = [os.path.join(config['eval_data_path'], path) for path in dataset_config.latent_names]
+            eval_datasets = [
+                CustomDataset(
+                    path,
+                    transform=None,
+                    len_inp_sequence=config['len_inp_sequence'],
+                    len_out_sequence=config['len_out_sequence'],
+                    load_ground_truth=True,
+                    question=config['use_question'],
+                    load_to_ram=False,
+                    load_config=True,
+                )
+                for path in paths]
+
+            eval_disentanglement(model, eval_datasets, device, num_epochs=100)
+
+            for eval_dataset in eval_datasets:
+                eval_dataset.close()
 
     if config['mutual_information_gap']:
         print("Computing mutual information gap")
         MIG(model, dataset, config['num_samples'], discrete=True)
 
+    dataset.close()
+
 
 if __name__ == '__main__':
     eval_config = {
         'analyze_dataset'          : False,  # Plot positions of the desired datapoints
+        'analyze_mode'             : 'density',  # Plot the positions as 'lines', 'points' or 'density'
         'show_solver_history'      : False,  # Plot losses of the training
         'show_latent_variables'    : False,  # Show the latent variables for the desired datapoints
         'show_model_output'        : True,  # Show the model output for the desired datapoints
@@ -199,6 +236,8 @@ if __name__ == '__main__':
         'latent_walk_gifs'         : False,
         'walk_over_question'       : False,
         'eval_disentanglement'     : False,  # Evaluate disentanglement according to the metric from the BetaVAE paper.
+        'eval_disentanglement_in_memory': False,  # Synthesize the batch pairs instead of loading the eval dataset
+        'num_eval_sequences'       : 2048 + 512,  # Number of sequences to synthesize per latent variable
         'mutual_information_gap'   : False,  # Evaluate disentanglement according to the MIG score
 
         'data_path'                : '../../../datasets/ball_no_acc_x_y_different',
@@ -216,6 +255,8 @@ if __name__ == '__main__':
         'epoch'                    : None,  # Use last model and solver if epoch is none
 
         'use_cuda'                 : False,
+        'mixed_precision'          : False,  # Evaluate with bfloat16 autocast
+        'compile_model'            : False,  # Run the model compiled with torch.compile
     }
 
     evaluate(eval_config)
@@ -16,41 +16,61 @@ from sklearn.metrics import mutual_info_score
 from dl4cv.utils import reparametrize, mutual_information, entropy
 
 
-def analyze_dataset(trajectories, window_size_x=32, window_size_y=32, mode='lines'):
+def analyze_dataset(trajectories, window_size_x=32, window_size_y=32, mode='lines', bins_per_pixel=4, save_path=None):
+    """
+    Plots the positions of the trajectories and the intercorrelation of their start states
+    Args:
+        trajectories: np.array of shape [num_sequences, len_sequence, 6] or an iterable of such arrays. Chunks are
+            processed one after another, so the whole dataset never has to be in memory
+        mode: 'lines' plots every trajectory, 'points' every position and 'density' bins all trajectory segments
+            into one occupancy histogram, which stays fast for any number of sequences
+        bins_per_pixel: resolution of the histogram in 'density' mode
+        save_path: save the position plot to this path instead of showing it
+    """
+    if isinstance(trajectories, np.ndarray):
+        trajectories = [trajectories]
 
     mpl.rcParams['axes.titlesize'] = 'large'
     mpl.rcParams['axes.labelsize'] = 'large'
 
     plt.figure(figsize=(6, 6))
-    if mode == 'lines':
-        for i in range(trajectories.shape[0]):
-            plt.plot(trajectories[i, :, 0].reshape(-1), trajectories[i, :, 1].reshape(-1), 'b', linewidth=0.5)
-    elif mode == 'points':
-        plt.scatter(trajectories[:, :, 0].reshape(-1), trajectories[:, :, 1].reshape(-1), s=0.2)
+
+    occupancy = np.zeros((window_size_x * bins_per_pixel, window_size_y * bins_per_pixel))
+    statistics = None
+
+    for chunk in trajectories:
+        if mode == 'lines':
+            for i in range(chunk.shape[0]):
+                plt.plot(chunk[i, :, 0].reshape(-1), chunk[i, :, 1].reshape(-1), 'b', linewidth=0.5)
+        elif mode == 'points':
+            plt.scatter(chunk[:, :, 0].reshape(-1), chunk[:, :, 1].reshape(-1), s=0.2)
+        elif mode == 'density':
+            occupancy += _get_occupancy(chunk, window_size_x, window_size_y, bins_per_pixel)
+
+        statistics = _merge_statistics(statistics, chunk[:, 0])
+
+    if mode == 'density':
+        plt.imshow(np.log1p(occupancy.T), origin='lower', extent=(0, window_size_x, 0, window_size_y), cmap='Blues')
 
     plt.title("Position")
     plt.xlabel("x")
     plt.ylabel("y")
     plt.xlim(left=0, right=window_size_x)
     plt.ylim(bottom=0, top=window_size_y)
-    plt.show()
 
-    n = trajectories.shape[0]
-
-    trajectories = trajectories[:, 0]
+    if save_path is not None:
+        plt.savefig(save_path)
+        plt.close()
+    else:
+        plt.show()
 
-    meta_mean = trajectories.mean(axis=0)
-    meta_std = trajectories.std(axis=0)
+    n, meta_mean, scatter_matrix = statistics
 
-    correlations = np.zeros((trajectories.shape[1], trajectories.shape[1]))
+    meta_std = np.sqrt(np.diag(scatter_matrix) / n)
 
-    # Calculate correlation from every ground truth variable to itself
-    for i_z in range(trajectories.shape[1]):
-        for i_gt in range(trajectories.shape[1]):
-            # Calculate correlation
-            # From https://www.dummies.com/education/math/statistics/how-to-calculate-a-correlation/
-            correlations[i_z, i_gt] = 1 / (n - 1) * ((trajectories[:, i_z] - meta_mean[i_z]) * (trajectories[:, i_gt] - meta_mean[i_gt])).sum() / \
-                                      (meta_std[i_z] * meta_std[i_gt])
+    # Calculate correlation from every ground truth variable to every other one
+    # From https://www.dummies.com/education/math/statistics/how-to-calculate-a-correlation/
+    correlations = 1 / (n - 1) * scatter_matrix / np.outer(meta_std, meta_std)
 
     correlations = np.abs(correlations)
 
@@ -65,7 +85,53 @@ def analyze_dataset(trajectories, window_size_x=32, window_size_y=32, mode='line
     plt.show()
 
 
-def show_solver_history(solver):
+def _get_occupancy(trajectories, window_size_x, window_size_y, bins_per_pixel, max_samples=2**22):
+    # Sample every segment between two frames densely enough to hit every bin it crosses and histogram the samples
+    bins = (window_size_x * bins_per_pixel, window_size_y * bins_per_pixel)
+    occupancy = np.zeros(bins)
+
+    start = trajectories[:, :-1, :2]
+    delta = trajectories[:, 1:, :2] - start
+
+    num_steps = max(int(np.ceil(np.abs(delta).max(initial=0) * bins_per_pixel)), 1)
+    steps = np.arange(num_steps).reshape(1, 1, -1, 1) / num_steps
+
+    # Process blocks of trajectories to bound the number of samples in memory
+    block_size = max(max_samples // (num_steps * max(delta.shape[1], 1)), 1)
+
+    for i in range(0, trajectories.shape[0], block_size):
+        block = slice(i, i + block_size)
+
+        positions = (start[block, :, None] + delta[block, :, None] * steps).reshape(-1, 2)
+        # Add the last position of every trajectory, the segments only cover their start
+        positions = np.concatenate([positions, trajectories[block, -1, :2]])
+
+        occupancy += np.histogram2d(positions[:, 0], positions[:, 1], bins=bins,
+                                    range=((0, window_size_x), (0, window_size_y)))[0]
+
+    return occupancy
+
+
+def _merge_statistics(statistics, values):
+    """
+    Adds a chunk of samples to the running (count, mean, scatter matrix) of the previous chunks
+    From https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+    n_b = values.shape[0]
+    mean_b = values.mean(axis=0)
+    scatter_b = (values - mean_b).T @ (values - mean_b)
+
+    if statistics is None:
+        return n_b, mean_b, scatter_b
+
+    n_a, mean_a, scatter_a = statistics
+    n = n_a + n_b
+    delta = mean_b - mean_a
+
+    return n, mean_a + delta * n_b / n, scatter_a + scatter_b + np.outer(delta, delta) * n_a * n_b / n
+
+
+def show_solver_history(solver, max_points=100000):
 
     avg_w = 20
 
@@ -73,11 +139,14 @@ def show_solver_history(solver):
     print("Stop time: %fs" % solver.training_time_s)
     print("Epoch: {}".format(solver.epoch))
 
-    total_kl_divergence = np.array(solver.history['total_kl_divergence'])
-    kl_divergence_dim_wise = np.array(solver.history['kl_divergence_dim_wise'])
-    reconstruction_loss = np.array(solver.history['reconstruction_loss'])
-    posterior_mu = np.array(solver.history['posterior_mu'])
-    posterior_var = np.array(solver.history['posterior_var'])
+    # Plot at most max_points rows of the memory mapped history
+    step = max(1, solver.history.num_rows('reconstruction_loss') // max_points)
+
+    total_kl_divergence = solver.history.get('total_kl_divergence', step)
+    kl_divergence_dim_wise = solver.history.get('kl_divergence_dim_wise', step)
+    reconstruction_loss = solver.history.get('reconstruction_loss', step)
+    posterior_mu = solver.history.get('posterior_mu', step)
+    posterior_var = solver.history.get('posterior_var', step)
 
     plt.plot(moving_average(reconstruction_loss[100:], 100), label='Reconstruction loss')
     plt.xlabel("Iterations")
@@ -535,14 +604,17 @@ def walk_over_question(model, dataset):
     x, _, ques, _, full_sequence = dataset.__getitem__((5, 1))
     questions = torch.arange(full_sequence.shape[0])
 
+    # Decode all questions from one encoding
+    preds, _ = model(torch.unsqueeze(x, 0), questions.float().view(1, -1))
+    preds = torch.sigmoid(preds)
+
     sum_pred = torch.zeros_like(torch.unsqueeze(x[0], 0))
     sum_gt = torch.zeros_like(torch.unsqueeze(x[0], 0))
 
     images = []
     f, axes = plt.subplots(1, 2)
     for q in questions:
-        pred, _ = model(torch.unsqueeze(x, 0), torch.tensor([q], dtype=torch.float32))
-        pred = torch.sigmoid(pred)
+        pred = preds[:, q]
         # pred[pred > 0.5] = 1
         # pred[pred < 0.5] = 0
 
@@ -582,32 +654,48 @@ def walk_over_question(model, dataset):
 
 
 def eval_disentanglement(model, eval_datasets, device, num_epochs=50):
-    # initialize z_diffs and targets
-    z_diffs = []
-    targets = []
+    batch_pairs = []
 
     # iterate over every eval subset
-    for i_dataset, eval_dataset in enumerate(eval_datasets):
-        current_latent = eval_dataset.path.split('/')[-1]
-        print("Loading eval subset for latent {}".format(current_latent))
-
+    for eval_dataset in eval_datasets:
         c = eval_dataset.config
 
         # load all samples in the subset
         eval_data_loader = torch.utils.data.DataLoader(eval_dataset, batch_size=2 * c.batch_size)
 
-        for i_batch, sample in enumerate(eval_data_loader):
-            x, _, _, _ = sample
-            x.to(device)
+        batch_pairs.append(_split_batches(eval_data_loader, c.batch_size))
+
+    compute_disentanglement_metric(model, batch_pairs, device)
+
+
+def _split_batches(data_loader, batch_size):
+    # Consecutive batches of the eval datasets are loaded as one batch
+    for x, _, _, _ in data_loader:
+        yield x[:batch_size], x[batch_size:]
+
+
+def compute_disentanglement_metric(model, batch_pairs, device):
+    """
+    Metric from the BetaVAE paper
+    batch_pairs: one iterable of batch pairs (x1, x2) per latent variable, where the latent variable is the same for
+    sequence i of x1 and x2
+    """
+    # initialize z_diffs and targets
+    z_diffs = []
+    targets = []
+
+    for i_latent, latent_batch_pairs in enumerate(batch_pairs):
+        print("Encoding batch pairs for latent {}".format(i_latent))
 
-            z1, _, _ = model.encode(x[:c.batch_size])
-            z2, _, _ = model.encode(x[c.batch_size:])
+        for x1, x2 in latent_batch_pairs:
+            z1, _, _ = model.encode(x1.to(device))
+            z2, _, _ = model.encode(x2.to(device))
 
             z_diff = torch.abs(z1 - z2)
             z_diff = torch.mean(z_diff, dim=0)
-            z_diffs.append(z_diff.detach().numpy())
+            z_diffs.append(z_diff.detach().cpu().numpy())
 
-            target = np.array([i_dataset], dtype=np.long)
+            target = np.array([i_latent], dtype=np.int64)
             targets.append(target)
 
     # Shuffle training data
@@ -1,6 +1,6 @@
 from dl4cv.train import train
 from dl4cv.eval.eval import evaluate
-from dl4cv.utils import Config, str2bool
+from dl4cv.utils import Config, str2bool, parse_run_arguments
 
 import argparse
 
@@ -30,6 +30,7 @@ config = Config({
     'len_out_sequence': 1,              # Number of generated images
 
     'num_workers': 4,                   # Number of workers for data loading
+    'mixed_precision': False,           # Train and evaluate with bfloat16 autocast
 
     # Hyper parameters
     'max_train_time_s': None,
@@ -85,7 +86,7 @@ if __name__ == '__main__':
     parser.add_argument('--train', default=False, type=str2bool, help='Train model')
     parser.add_argument('--eval', default=False, type=str2bool, help='Evaluate model')
 
-    args = parser.parse_args()
+    args = parse_run_arguments(parser, config)
 
     if args.train:
         train(config)
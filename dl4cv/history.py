@@ -0,0 +1,218 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+
+HISTORY_DIRECTORY = 'history'
+HISTORY_COLUMNS = 'columns.p'
+CHUNK_SIZE = 4096
+
+
+class History(object):
+    """
+    Training history with one column of float32 rows per metric.
+    New rows go to preallocated chunks in memory. save() appends them to one raw file per column in a directory
+    beside the checkpoint and from then on the rows are read from a memory map, so neither the checkpoint nor the RAM
+    grows with the number of iterations.
+    The files are append-only. A run that continues from an earlier checkpoint, whose rows were already followed by
+    the rows of later checkpoints, writes its history to a new generation directory history_1, history_2, ...
+    history[key] returns a column as array, get(key, step) every step-th row of it.
+    The MetricLogger thread and the training loop both append rows, a lock keeps the columns consistent.
+    """
+    def __init__(self):
+        self.columns = {}
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def append(self, hist_dict):
+        """
+        Appends one row to every metric of hist_dict
+        """
+        for key, value in hist_dict.items():
+            self.append_rows(key, np.asarray(value, dtype=np.float32)[None])
+
+    def append_rows(self, key, rows):
+        rows = np.asarray(rows, dtype=np.float32)
+
+        with self.lock:
+            if key not in self.columns:
+                self.columns[key] = Column(rows.shape[1:])
+
+            self.columns[key].append(rows)
+
+    def get(self, key, step=1):
+        with self.lock:
+            return self.columns[key].get(step)
+
+    def num_rows(self, key):
+        with self.lock:
+            return len(self.columns[key])
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def keys(self):
+        with self.lock:
+            return list(self.columns.keys())
+
+    def __len__(self):
+        return len(self.columns)
+
+    def save(self, checkpoint_directory):
+        """
+        Appends the rows in memory to the files of the columns beside the checkpoint and returns the state for the
+        checkpoint
+        """
+        with self.lock:
+            return self.save_columns(checkpoint_directory)
+
+    def save_columns(self, checkpoint_directory):
+        if self.can_append(checkpoint_directory):
+            directory = self.directory
+            rewrite = False
+        else:
+            # Write all rows to a generation directory that no other checkpoint uses
+            directory = get_generation_directory(checkpoint_directory)
+            rewrite = True
+
+        os.makedirs(directory, exist_ok=True)
+
+        for key, column in self.columns.items():
+            column.save(get_column_file(directory, key), rewrite)
+
+        shapes = {key: column.row_shape for key, column in self.columns.items()}
+
+        with open(os.path.join(directory, HISTORY_COLUMNS + '.tmp'), 'wb') as f:
+            pickle.dump(shapes, f)
+        os.replace(os.path.join(directory, HISTORY_COLUMNS + '.tmp'), os.path.join(directory, HISTORY_COLUMNS))
+
+        self.directory = directory
+
+        return {
+            'directory': os.path.basename(directory),
+            'lengths': {key: len(column) for key, column in self.columns.items()}
+        }
+
+    def can_append(self, checkpoint_directory):
+        """
+        Returns whether the rows can be appended to the files they were loaded from or last saved to. That is only the
+        case if no other checkpoint appended rows to them since
+        """
+        if self.directory is None or \
+                os.path.abspath(os.path.dirname(self.directory)) != os.path.abspath(checkpoint_directory):
+            return False
+
+        for key, column in self.columns.items():
+            path = get_column_file(self.directory, key)
+
+            if os.path.exists(path) and os.path.getsize(path) != column.stored.nbytes:
+                return False
+
+        return True
+
+    @classmethod
+    def load(cls, state, checkpoint_directory):
+        """
+        Opens the history of a checkpoint. Rows that were appended after the checkpoint are ignored
+        """
+        history = cls()
+
+        if state is None:
+            return history
+
+        if 'lengths' not in state:
+            # Checkpoints before the columnar history stored a dict of lists
+            for key, values in state.items():
+                history.append_rows(key, values)
+            return history
+
+        directory = os.path.join(checkpoint_directory, state['directory'])
+
+        with open(os.path.join(directory, HISTORY_COLUMNS), 'rb') as f:
+            shapes = pickle.load(f)
+
+        for key, length in state['lengths'].items():
+            history.columns[key] = Column(shapes[key])
+            history.columns[key].open(get_column_file(directory, key), length)
+
+        history.directory = directory
+
+        return history
+
+
+class Column(object):
+
+    def __init__(self, row_shape):
+        self.row_shape = tuple(row_shape)
+        # Rows on disk
+        self.stored = np.zeros((0,) + self.row_shape, dtype=np.float32)
+        # Full chunks and the partly filled chunk in memory
+        self.chunks = []
+        self.buffer = np.empty((CHUNK_SIZE,) + self.row_shape, dtype=np.float32)
+        self.fill = 0
+
+    def __len__(self):
+        return len(self.stored) + sum(len(chunk) for chunk in self.chunks) + self.fill
+
+    def append(self, rows):
+        while len(rows) > 0:
+            num_rows = min(len(rows), CHUNK_SIZE - self.fill)
+            self.buffer[self.fill:self.fill + num_rows] = rows[:num_rows]
+            self.fill += num_rows
+            rows = rows[num_rows:]
+
+            if self.fill == CHUNK_SIZE:
+                self.chunks.append(self.buffer)
+                self.buffer = np.empty_like(self.buffer)
+                self.fill = 0
+
+    def get(self, step=1):
+        # Take every step-th row of each part without concatenating the full column first
+        parts = []
+        offset = 0
+
+        for part in [self.stored] + self.chunks + [self.buffer[:self.fill]]:
+            parts.append(part[offset::step])
+            offset = (offset - len(part)) % step
+
+        return np.concatenate(parts)
+
+    def save(self, path, rewrite):
+        # Columns that are new since the last save have no file yet
+        rewrite = rewrite or not os.path.exists(path)
+
+        with open(path, 'wb' if rewrite else 'ab') as f:
+            parts = [self.stored] if rewrite else []
+
+            for part in parts + self.chunks + [self.buffer[:self.fill]]:
+                f.write(np.ascontiguousarray(part).tobytes())
+
+        self.open(path, len(self))
+
+    def open(self, path, length):
+        if length == 0:
+            self.stored = np.zeros((0,) + self.row_shape, dtype=np.float32)
+        else:
+            self.stored = np.memmap(path, dtype=np.float32, mode='r', shape=(length,) + self.row_shape)
+
+        self.chunks = []
+        self.fill = 0
+
+
+def get_generation_directory(checkpoint_directory):
+    directory = os.path.join(checkpoint_directory, HISTORY_DIRECTORY)
+    generation = 0
+
+    while os.path.exists(directory):
+        generation += 1
+        directory = os.path.join(checkpoint_directory, '{}_{}'.format(HISTORY_DIRECTORY, generation))
+
+    return directory
+
+
+def get_column_file(directory, key):
+    return os.path.join(directory, key + '.f32')
@@ -0,0 +1,137 @@
+import queue
+import threading
+
+import torch
+
+
+class MetricLogger(object):
+    """
+    Collects the training metrics of every iteration on the device and copies them to the host in one transfer
+    every flush_after_iters iterations. A background thread writes them to the solver history, the console and
+    tensorboard, so the training loop never waits for a host sync or the writers.
+    """
+    def __init__(self, solver, tensorboard_writer, n_iters, log_after_iters=1, flush_after_iters=50,
+                 history_downsample=1):
+        self.solver = solver
+        self.tensorboard_writer = tensorboard_writer
+        self.n_iters = n_iters
+        self.log_after_iters = log_after_iters
+        self.flush_after_iters = max(1, flush_after_iters)
+        # Only every history_downsample-th iteration goes to the history
+        self.history_downsample = max(1, history_downsample)
+
+        # Exponentially filtered training loss
+        self.train_loss_avg = 0
+
+        self.pending = []
+        self.error = None
+        self.batches = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def log(self, i_iter, loss, reconstruction_loss, total_kl_divergence, C, dim_wise_kld, mu, logvar, t_iter):
+        """
+        Stores the metrics of an iteration without leaving the device
+        """
+        with torch.no_grad():
+            metrics = torch.cat([
+                loss.detach().view(1).float(),
+                reconstruction_loss.detach().view(1).float(),
+                total_kl_divergence.detach().view(1).float(),
+                C.detach().view(1).float(),
+                dim_wise_kld.detach().float(),
+                mu.detach().float().mean(dim=0),
+                logvar.detach().float().exp().mean(dim=0)
+            ])
+
+        self.pending.append((i_iter, metrics, t_iter))
+
+        if len(self.pending) >= self.flush_after_iters:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        i_iters, metrics, t_iters = zip(*self.pending)
+        self.pending = []
+
+        # The only host sync, once per flush
+        self.batches.put((i_iters, torch.stack(metrics).cpu().numpy(), t_iters))
+
+    def wait(self):
+        """
+        Flushes the pending metrics and waits until they are written, e.g. before the history is saved
+        """
+        self.flush()
+        self.batches.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.batches.put(None)
+        self.thread.join()
+
+    def write_loop(self):
+        while True:
+            batch = self.batches.get()
+
+            if batch is None:
+                self.batches.task_done()
+                return
+
+            try:
+                if self.error is None:
+                    self.write(*batch)
+            except Exception as e:
+                # Raised in the training loop by the next wait()
+                self.error = e
+            finally:
+                self.batches.task_done()
+
+    def write(self, i_iters, metrics, t_iters):
+        z_dim = (metrics.shape[1] - 4) // 3
+        writer = self.tensorboard_writer
+
+        kept = metrics[[i_iter % self.history_downsample == 0 for i_iter in i_iters]]
+        history = self.solver.history
+        history.append_rows('train_loss', kept[:, 0])
+        history.append_rows('reconstruction_loss', kept[:, 1])
+        history.append_rows('total_kl_divergence', kept[:, 2])
+        history.append_rows('kl_divergence_dim_wise', kept[:, 4:4 + z_dim])
+        history.append_rows('posterior_mu', kept[:, 4 + z_dim:4 + 2 * z_dim])
+        history.append_rows('posterior_var', kept[:, 4 + 2 * z_dim:])
+
+        for i_iter, row, t_iter in zip(i_iters, metrics, t_iters):
+            loss, reconstruction_loss, total_kl_divergence, C = row[:4].tolist()
+            dim_wise_kld = row[4:4 + z_dim].tolist()
+            mus = row[4 + z_dim:4 + 2 * z_dim].tolist()
+            vars = row[4 + 2 * z_dim:].tolist()
+
+            smooth_window_train = 10
+            self.train_loss_avg = (smooth_window_train-1)/smooth_window_train*self.train_loss_avg + \
+                1/smooth_window_train*loss
+
+            if self.log_after_iters is not None and (i_iter % self.log_after_iters == 0):
+                print("Iteration " + str(i_iter) + "/" + str(self.n_iters) +
+                      "   C: {0:.2f}".format(C) +
+                      "   Reconstruction loss: " + "{0:.6f}".format(reconstruction_loss),
+                      "   KL loss: " + "{0:.6f}".format(total_kl_divergence) +
+                      "   Train loss: " + "{0:.6f}".format(loss) +
+                      "   Avg train loss: " + "{0:.6f}".format(self.train_loss_avg) +
+                      " - Time/iter: " + str(int(t_iter*1000)) + "ms")
+
+            if writer is None:
+                continue
+
+            # One scalar per tag, add_scalars would open an event file per tag
+            writer.add_scalar('Reconstruction_loss', reconstruction_loss, i_iter)
+            writer.add_scalar('KL_loss/C', C, i_iter)
+            writer.add_scalar('KL_loss/Total_KL_loss', total_kl_divergence, i_iter)
+
+            for i in range(z_dim):
+                writer.add_scalar('KL_loss/z{}'.format(i), dim_wise_kld[i], i_iter)
+                writer.add_scalar('Posterior_means/z{}'.format(i), mus[i], i_iter)
+                writer.add_scalar('Posterior_variances/z{}'.format(i), vars[i], i_iter)
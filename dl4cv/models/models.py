@@ -3,12 +3,18 @@ File to store all model architectures
 """
 
 import abc
+import math
 
 import torch
 import torch.nn as nn
 
 import dl4cv.utils as utils
 
+# Frame width the encoder and decoder are built for
+NATIVE_RESOLUTION = 64
+# Number of SkipConv/SkipUpConv blocks of the encoder/decoder at the native resolution
+NUM_SKIP_BLOCKS = 3
+
 
 class BaseModel(nn.Module):
     def __init__(self):
@@ -32,12 +38,19 @@ class BaseModel(nn.Module):
 
 class VariationalAutoEncoder(BaseModel):
     """"This VAE generates means and log-variances of
-    the latent variables and samples from those distributions"""
-    def __init__(self, len_in_sequence, len_out_sequence, z_dim_encoder=6, z_dim_decoder=6, use_physics=False):
+    the latent variables and samples from those distributions.
+    Besides 64x64 frames it can process the other resolutions of a dataset pyramid, see set_resolution().
+    With use_question True or False the bottleneck is fixed to the question, physics or plain path. None decides per
+    batch whether questions were passed, which needs a host sync"""
+    def __init__(self, len_in_sequence, len_out_sequence, z_dim_encoder=6, z_dim_decoder=6, use_physics=False,
+                 resolutions=None, use_question=None):
         super(VariationalAutoEncoder, self).__init__()
         self.z_dim_encoder = z_dim_encoder
         self.z_dim_decoder = z_dim_decoder
         self.use_physics = use_physics
+        self.use_question = use_question
+        self.resolution = None
+        self.mixed_precision = False
 
         self.encoder = nn.Sequential(
             nn.Conv2d(len_in_sequence, 32, 4, 2, 1),  # 32x32
@@ -62,6 +75,17 @@ class VariationalAutoEncoder(BaseModel):
             nn.Conv2d(32, len_out_sequence, 3, 1, 1),
         )
 
+        # Lower resolutions skip the outer skip blocks, higher resolutions need additional ones
+        self.encoder_extra = nn.ModuleDict()
+        self.decoder_extra = nn.ModuleDict()
+
+        for resolution in resolutions or []:
+            depth = get_resolution_depth(resolution)
+
+            if depth > 0:
+                self.encoder_extra[str(resolution)] = nn.Sequential(*[SkipConv(32, 32) for i in range(depth)])
+                self.decoder_extra[str(resolution)] = nn.Sequential(*[SkipUpConv(32, 32) for i in range(depth)])
+
         if self.use_physics:
             self.physics_layer = PhysicsLayer(dt=1. / 10.)
 
@@ -70,39 +94,140 @@ class VariationalAutoEncoder(BaseModel):
     def weight_init(self):
         for block in self._modules:
             if block != 'physics_layer':
-                for m in self._modules[block]:
-                    kaiming_init(m)
+                if isinstance(self._modules[block], nn.ModuleDict):
+                    for sequential in self._modules[block].values():
+                        for m in sequential:
+                            kaiming_init(m)
+                else:
+                    for m in self._modules[block]:
+                        kaiming_init(m)
+
+    def set_resolution(self, resolution):
+        """
+        Sets the width of the frames the model processes, None for the native resolution.
+        For a resolution of 64 * 2^-k the outermost k skip blocks of the encoder and decoder are skipped, so all
+        resolutions share their weights. Resolutions above 64 need the additional blocks passed in the constructor.
+        """
+        depth = get_resolution_depth(resolution) if resolution is not None else 0
+
+        if depth > 0 and str(resolution) not in self.encoder_extra:
+            raise Exception('The model was not built for resolution {}, pass it to the constructor'.format(resolution))
+
+        self.resolution = resolution if depth != 0 else None
+
+    def set_mixed_precision(self, mixed_precision):
+        """
+        Runs the convolutions and linear layers of the encoder and decoder under bfloat16 autocast. Their outputs are
+        cast back to float32, so the sampling, the physics layer and the losses stay in float32
+        """
+        self.mixed_precision = mixed_precision
+
+    def autocast(self, tensor):
+        # Autocast on the device of the input, looking up the device of the parameters would cost every forward pass.
+        # Models that were saved before mixed precision existed don't have the attribute
+        return torch.autocast(device_type=tensor.device.type, dtype=torch.bfloat16,
+                              enabled=getattr(self, 'mixed_precision', False))
+
+    def get_encoder_blocks(self):
+        depth = get_resolution_depth(self.resolution)
+
+        if depth < 0:
+            return [self.encoder[0]] + list(self.encoder[1 - depth:])
+        else:
+            return [self.encoder[0]] + list(self.encoder_extra[str(self.resolution)]) + list(self.encoder[1:])
+
+    def get_decoder_blocks(self):
+        depth = get_resolution_depth(self.resolution)
+        # The skip blocks follow the two linear layers, their ReLUs and the view
+        end_skip_blocks = 5 + NUM_SKIP_BLOCKS
+
+        if depth < 0:
+            return list(self.decoder[:end_skip_blocks + depth]) + list(self.decoder[end_skip_blocks:])
+        else:
+            return list(self.decoder[:end_skip_blocks]) + list(self.decoder_extra[str(self.resolution)]) + \
+                list(self.decoder[end_skip_blocks:])
 
     def forward(self, x, q=-1):
+        """
+        q: questions of shape [batch] or [batch, num_questions]. With several questions per sample all of them are
+            decoded from the same encoding and y has the shape [batch, num_questions, len_out_sequence, height, width]
+        """
         z_encoder, mu, logvar = self.encode(x)
 
         z_decoder = self.bottleneck(z_encoder, q)
 
-        y = self.decode(z_decoder)
+        if z_decoder.dim() == 3:
+            batch_size, num_questions = z_decoder.shape[:2]
+
+            y = self.decode(z_decoder.reshape(batch_size * num_questions, -1))
+            y = y.view((batch_size, num_questions) + y.shape[1:])
+        else:
+            y = self.decode(z_decoder)
 
         return y, (mu, logvar)
 
     def bottleneck(self, z_encoder, q):
-        q = q.to(next(self.parameters()).device)
+        # Models that were saved before the modes existed don't have the attribute
+        use_question = getattr(self, 'use_question', None)
+
+        if use_question is None:
+            return self.bottleneck_any(z_encoder, q)
+
+        if self.use_physics:
+            # Without questions the physics layer predicts one time step ahead
+            if not use_question:
+                return self.bottleneck_physics(z_encoder, None)
+
+            # Like bottleneck_any, a batch without questions (all -1) predicts one time step ahead. The decision stays
+            # on the device
+            q = q.to(z_encoder.device, z_encoder.dtype)
+            q = torch.where((q == -1).all(), torch.ones_like(q), q)
+
+            return self.bottleneck_physics(z_encoder, q)
+
+        if use_question:
+            return self.bottleneck_question(z_encoder, q)
+
+        return z_encoder
+
+    def bottleneck_question(self, z_encoder, q):
+        q = q.to(z_encoder.device, z_encoder.dtype)
+
+        if q.dim() == 2:
+            return torch.cat((z_encoder.unsqueeze(1).expand(-1, q.shape[1], -1), q.unsqueeze(2)), dim=2)
+
+        return torch.cat((z_encoder, q.view(-1, 1)), dim=1)
+
+    def bottleneck_physics(self, z_encoder, q):
+        if z_encoder.dim() == 1:
+            z_encoder = z_encoder.unsqueeze(0)
+
+        if q is None:
+            q = z_encoder.new_ones(z_encoder.shape[0])
+
+        return self.physics_layer(z_encoder, q.to(z_encoder.device, z_encoder.dtype))
+
+    def bottleneck_any(self, z_encoder, q):
         if torch.any(q != -1):
             if self.use_physics:
-                z_decoder = self.physics_layer(z_encoder, q.view(-1))
-            else:
-                z_decoder = torch.cat((z_encoder, q.view(-1, 1)), dim=1)
-        else:
-            if self.use_physics:
-                if len(z_encoder.shape) == 1:
-                    z_encoder = torch.unsqueeze(z_encoder, 0)
+                return self.bottleneck_physics(z_encoder, q)
 
-                z_decoder = self.physics_layer(z_encoder, torch.ones((z_encoder.shape[0]),
-                                                                     device=next(self.parameters()).device))
-            else:
-                z_decoder = z_encoder
+            return self.bottleneck_question(z_encoder, q)
 
-        return z_decoder
+        return self.bottleneck_physics(z_encoder, None) if self.use_physics else z_encoder
 
     def encode(self, x):
-        z_params = self.encoder(x)
+        with self.autocast(x):
+            # Models that were saved before resolutions existed don't have the attribute
+            if getattr(self, 'resolution', None) is None:
+                z_params = self.encoder(x)
+            else:
+                z_params = x
+                for block in self.get_encoder_blocks():
+                    z_params = block(z_params)
+
+        z_params = z_params.float()
+
         mu = z_params[:, :self.z_dim_encoder]
         logvar = z_params[:, self.z_dim_encoder:]
 
@@ -114,7 +239,46 @@ class VariationalAutoEncoder(BaseModel):
         return z_encoder, mu, logvar
 
     def decode(self, z_decoder):
-        return self.decoder(z_decoder)
+        with self.autocast(z_decoder):
+            if getattr(self, 'resolution', None) is None:
+                y = self.decoder(z_decoder)
+            else:
+                y = z_decoder
+                for block in self.get_decoder_blocks():
+                    y = block(y)
+
+        return y.float()
+
+
+def compile_model(model, methods=()):
+    """
+    Returns the model compiled with torch.compile. It shares the parameters with the model and forwards all other
+    attributes like save() to it. Calls of the model itself and of the given methods, e.g. ['encode', 'decode'], run
+    compiled
+    """
+    if not hasattr(torch, 'compile'):
+        raise Exception('Compiling the model needs PyTorch 2.0 or newer')
+
+    compiled = torch.compile(model)
+
+    for method in methods:
+        # The compiled model forwards setattr to the model, which would then save the compiled method with it
+        object.__setattr__(compiled, method, torch.compile(getattr(model, method)))
+
+    return compiled
+
+
+def get_resolution_depth(resolution):
+    """
+    Returns the number of skip blocks a resolution needs in addition to the native resolution, negative for fewer
+    """
+    depth = math.log2(resolution / NATIVE_RESOLUTION)
+
+    if depth != int(depth) or depth < -NUM_SKIP_BLOCKS:
+        raise Exception('Resolution {} is not supported, use {} multiplied or divided by powers of two, at least {}'.format(
+            resolution, NATIVE_RESOLUTION, NATIVE_RESOLUTION // 2 ** NUM_SKIP_BLOCKS))
+
+    return int(depth)
 
 
 class View(nn.Module):
@@ -174,14 +338,15 @@ class PhysicsLayer(nn.Module):
 
     def forward(self, z, q):
         """
-            x.shape: [batch, 6, 1, 1]
-            return shape: [batch, 2, 1, 1]
+            z.shape: [batch, 6]
+            q.shape: [batch] or [batch, num_questions]
+            return shape: [batch, 2] or [batch, num_questions, 2]
         """
-        q *= self.dt
+        t = q.view(z.shape[0], -1) * self.dt
 
-        out = torch.zeros_like(z[:, :2])
+        px = z[:, 0:1] + z[:, 2:3] * t + z[:, 4:5] * 0.5 * t.pow(2.)
+        py = z[:, 1:2] + z[:, 3:4] * t + z[:, 5:6] * 0.5 * t.pow(2.)
 
-        out[:, 0] = z[:, 0] + z[:, 2] * q + z[:, 4] * 0.5 * q.pow(2.)
-        out[:, 1] = z[:, 1] + z[:, 3] * q + z[:, 5] * 0.5 * q.pow(2.)
+        out = torch.stack((px, py), dim=2)
 
-        return out
+        return out if q.dim() == 2 else out[:, 0]
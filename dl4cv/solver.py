@@ -3,8 +3,14 @@ import os
 import time
 
 import torch
-
-from dl4cv.utils import kl_divergence, time_left
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from dl4cv.utils import kl_divergence, time_left, benchmark_mixed_precision
+from dl4cv.dataset.prefetchLoader import PrefetchLoader
+from dl4cv.metricLogger import MetricLogger
+from dl4cv.history import History
+from dl4cv.models.models import compile_model
 from dl4cv.eval.eval_functions import generate_img_figure_for_tensorboardx
 import matplotlib.pyplot as plt
 import numpy as np
@@ -15,13 +21,14 @@ from tensorboardX import SummaryWriter
 class Solver(object):
 
     def __init__(self):
-        self.history = {}
+        self.history = History()
 
         self.optim = []
         self.criterion = []
         self.training_time_s = 0
         self.stop_reason = ''
         self.epoch = 0
+        self.resolution = None
 
     def train(
             self,
@@ -44,35 +51,71 @@ class Solver(object):
             C_stop_iter=1e5,
             gamma=100,
             log_reconstructed_images=True,
-            beta=0
+            beta=0,
+            resolution_schedule=None,
+            num_prefetch=2,
+            flush_after_iters=50,
+            history_downsample=1,
+            validate_after_epochs=1,
+            validate_after_iters=None,
+            mixed_precision=False,
+            use_compile=False
     ):
+        """
+        resolution_schedule: list of [first_epoch, resolution] to train the first epochs on lower resolutions of a
+            dataset pyramid, e.g. [[1, 16], [3, 32], [5, 64]]. None trains on the resolution of the dataset.
+        num_prefetch: number of batches that are loaded and moved to the device while the current step computes,
+            0 loads them in the training loop
+        flush_after_iters: number of iterations after which the metrics are copied from the device and logged
+        history_downsample: keep the training metrics of every history_downsample-th iteration in the history
+        validate_after_epochs: validate at the end of every validate_after_epochs-th epoch, None never at the end of
+            an epoch
+        validate_after_iters: additionally validate every validate_after_iters iterations
+        mixed_precision: run the model under bfloat16 autocast, the losses are still computed in float32
+        use_compile: run the forward passes of the model compiled with torch.compile
+
+        If torch.distributed is initialized, every process trains on its part of the data and DistributedDataParallel
+        averages the gradients. Only rank 0 writes tensorboard and saves checkpoints.
+        """
 
         self.train_config = train_config
         self.dataset_config = dataset_config
         model.to(device)
 
+        distributed = dist.is_available() and dist.is_initialized()
+        world_size = dist.get_world_size() if distributed else 1
+        is_main = not distributed or dist.get_rank() == 0
+
         if self.epoch == 0:
             self.optim = optim
 
+        train_loader = PrefetchLoader(train_loader, device, num_prefetch)
+        val_loader = PrefetchLoader(val_loader, device, num_prefetch)
+
         iter_per_epoch = len(train_loader)
         print("Iterations per epoch: {}".format(iter_per_epoch))
 
-        # Exponentially filtered training loss
-        train_loss_avg = 0
-
         # Path to save model and solver
         if save_path.split('/')[-1] == 'saves':
             save_path = os.path.join(save_path, 'train' + datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
         else:
             save_path = os.path.join(save_path)
 
-        tensorboard_writer = SummaryWriter(os.path.join(tensorboard_path, 'train' + datetime.datetime.now().strftime("%Y%m%d%H%M%S")),
-                                           flush_secs=30)
+        if is_main:
+            tensorboard_writer = SummaryWriter(os.path.join(tensorboard_path, 'train' + datetime.datetime.now().strftime("%Y%m%d%H%M%S")),
+                                               flush_secs=30)
+        else:
+            tensorboard_writer = None
+            log_after_iters = None
+            log_reconstructed_images = False
 
         # Calculate the total number of minibatches for the training procedure
         n_iters = num_epochs*iter_per_epoch
         i_iter = 0
 
+        metric_logger = MetricLogger(self, tensorboard_writer, n_iters, log_after_iters, flush_after_iters,
+                                     history_downsample)
+
         print('Start training at epoch ' + str(self.epoch))
         t_start_training = time.time()
 
@@ -82,12 +125,34 @@ class Solver(object):
         self.C_max = torch.autograd.Variable(torch.FloatTensor([C_max]))
         self.C_max = self.C_max.to(device)
 
+        model.set_mixed_precision(mixed_precision)
+
+        # The compiled model shares the parameters, the model itself is still the one that gets saved
+        forward_model = compile_model(model) if use_compile else model
+        train_model = forward_model
+
+        if distributed:
+            # Compiling the DDP wrapper lets the compiler split the graph at the gradient buckets, so their all-reduces
+            # overlap the backward pass. Validation skips DDP, its buffer broadcasts would make every process wait
+            train_model = DistributedDataParallel(model)
+
+            if use_compile:
+                train_model = compile_model(train_model)
+
         # Do the training here
         for i_epoch in range(num_epochs):
             self.epoch += 1
             print("Starting epoch {}".format(self.epoch))
             t_start_epoch = time.time()
 
+            if resolution_schedule is not None:
+                self.set_resolution(model, [train_loader, val_loader], resolution_schedule)
+
+            # A DistributedSampler shuffles differently in every epoch only if it knows the epoch
+            sampler = getattr(train_loader.loader, 'sampler', None)
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(self.epoch)
+
             # Set model to train mode
             model.train()
 
@@ -95,21 +160,36 @@ class Solver(object):
                 t_start_iter = time.time()
                 i_iter += 1
 
+                # The PrefetchLoader already moved the batch to the device
                 x, y, question, _ = batch
 
-                x = x.to(device)
-                y = y.to(device)
-                if question[0] > 0:
-                    question = question.to(device)
+                if mixed_precision and i_iter == 1:
+                    # Time the first real batch, another iterator over the loader would start its own workers and
+                    # advance the sampler
+                    if is_main:
+                        t_fp32, t_bf16 = benchmark_mixed_precision(model, x, question)
+                        print("Time/iter float32: {:.1f}ms   bfloat16 autocast: {:.1f}ms   speedup: {:.2f}x".format(
+                            t_fp32, t_bf16, t_fp32 / t_bf16))
+
+                    if distributed:
+                        # The other processes wait for the benchmark here instead of in the all-reduce of their first
+                        # backward pass
+                        dist.barrier()
+
+                    t_start_iter = time.time()
 
                 # Forward pass
-                y_pred, (mu, logvar) = model(x, question)
+                y_pred, (mu, logvar) = train_model(x, question)
 
-                # Compute losses
-                reconstruction_loss = F.binary_cross_entropy_with_logits(y_pred, y, reduction='sum').div(y.shape[0])
+                # Compute losses. With several questions per sample average over all targets
+                reconstruction_loss = F.binary_cross_entropy_with_logits(y_pred, y, reduction='sum').div(
+                    get_num_targets(y, question))
                 total_kl_divergence, dim_wise_kld, mean_kld = kl_divergence(mu, logvar, target_var)
 
-                C = torch.clamp(self.C_offset + self.C_max / self.C_stop_iter * i_iter, 0, self.C_max.data[0])
+                # The capacity grows with the iterations of all processes, so it reaches C_max after the same number
+                # of samples as in a single process
+                C = torch.clamp(self.C_offset + self.C_max / self.C_stop_iter * i_iter * world_size, 0,
+                                self.C_max.data[0])
 
                 loss = reconstruction_loss + self.gamma * (total_kl_divergence-C).abs() + beta * total_kl_divergence
 
@@ -118,112 +198,146 @@ class Solver(object):
                 loss.backward()
                 self.optim.step()
 
-                smooth_window_train = 10
-                train_loss_avg = (smooth_window_train-1)/smooth_window_train*train_loss_avg + 1/smooth_window_train*loss.item()
-
-                if log_after_iters is not None and (i_iter % log_after_iters == 0):
-                    print("Iteration " + str(i_iter) + "/" + str(n_iters) +
-                          "   C: {0:.2f}".format(C.item()) +
-                          "   Reconstruction loss: " + "{0:.6f}".format(reconstruction_loss.item()),
-                          "   KL loss: " + "{0:.6f}".format(total_kl_divergence.item()) +
-                          "   Train loss: " + "{0:.6f}".format(loss.item()) +
-                          "   Avg train loss: " + "{0:.6f}".format(train_loss_avg) +
-                          " - Time/iter: " + str(int((time.time()-t_start_iter)*1000)) + "ms")
-
-                    # plot_grad_flow(model.named_parameters())
-
-                mus = mu.mean(dim=0).tolist()
-                vars = logvar.exp().mean(dim=0).tolist()
-
-                self.append_history({'train_loss': loss.item(),
-                                     'total_kl_divergence': total_kl_divergence.item(),
-                                     'kl_divergence_dim_wise': dim_wise_kld.tolist(),
-                                     'reconstruction_loss': reconstruction_loss.item(),
-                                     'posterior_mu': mus,
-                                     'posterior_var': vars
-                                     })
-
-                # Add losses to tensorboard
-                tensorboard_writer.add_scalar('Reconstruction_loss', reconstruction_loss.item(), i_iter)
-
-                z_keys = ['C', 'Total_KL_loss']
-                z_keys.extend(['z{}'.format(i) for i in range(dim_wise_kld.numel())])
-                kls = [C.item(), total_kl_divergence.item()]
-                kls.extend(dim_wise_kld.tolist())
-                tensorboard_writer.add_scalars('KL_loss', dict(zip(z_keys, kls)), i_iter)
-
-                z_keys = ['z{}'.format(i) for i in range(dim_wise_kld.numel())]
-                tensorboard_writer.add_scalars('Posterior_means', dict(zip(z_keys, mus)), i_iter)
-                tensorboard_writer.add_scalars('Posterior_variances', dict(zip(z_keys, vars)), i_iter)
-
-                if log_reconstructed_images and os.getcwd()[:20] != '/home/felix.meissen':
-                    f = generate_img_figure_for_tensorboardx(y, y_pred, question)
-                    plt.show()  # don't log images on server
-                    tensorboard_writer.add_figure('Reconstructed sample', f, i_iter)
-
-            # Validate model
-            print("\nValidate model after epoch " + str(self.epoch) + '/' + str(num_epochs))
-
-            # Set model to evaluation mode
-            model.eval()
-
-            num_val_batches = 0
-            val_loss = 0
-
-            for i, batch in enumerate(val_loader):
-                num_val_batches += 1
-
-                x, y, question, _ = batch
-
-                x = x.to(device)
-                y = y.to(device)
-                if question[0] > 0:
-                    question = question.to(device)
-
-                y_pred, latent_stuff = model(x, question)
-
-                current_val_loss = F.binary_cross_entropy_with_logits(y_pred, y, reduction='sum').div(y.shape[0])
-
-                val_loss += current_val_loss.item()
+                metric_logger.log(i_iter, loss, reconstruction_loss, total_kl_divergence, C, dim_wise_kld, mu, logvar,
+                                  time.time() - t_start_iter)
 
-            val_loss /= num_val_batches
+                # plot_grad_flow(model.named_parameters())
 
-            self.append_history({'val_loss': val_loss})
+                if log_reconstructed_images and os.getcwd()[:20] != '/home/felix.meissen' and \
+                        log_after_iters is not None and (i_iter % log_after_iters == 0):
+                    if question.dim() == 2:
+                        # Show the first question of every sample
+                        f = generate_img_figure_for_tensorboardx(y[:, 0], y_pred[:, 0], question[:, 0])
+                    else:
+                        f = generate_img_figure_for_tensorboardx(y, y_pred, question)
+                    plt.show()  # don't log images on server
+                    tensorboard_writer.add_figure('Reconstructed sample', f, i_iter)
 
-            print('Avg Train Loss: ' + "{0:.6f}".format(train_loss_avg) +
-                  '   Val loss: ' + "{0:.6f}".format(val_loss) +
-                  "   - " + str(int((time.time() - t_start_epoch) * 1000)) + "ms" +
-                  "   time left: {}\n".format(time_left(t_start_training, n_iters, i_iter)))
+                if validate_after_iters is not None and (i_iter % validate_after_iters == 0):
+                    val_loss = self.validate(forward_model, val_loader, i_iter)
+                    if is_main:
+                        print("Iteration " + str(i_iter) + "/" + str(n_iters) + "   Val loss: " + "{0:.6f}".format(val_loss))
+                    model.train()
+
+            # Write the metrics of the epoch before validating and saving
+            metric_logger.wait()
+            train_loss_avg = metric_logger.train_loss_avg
+
+            validate_epoch = validate_after_epochs is not None and (self.epoch % validate_after_epochs == 0)
+
+            if validate_epoch:
+                if is_main:
+                    print("\nValidate model after epoch " + str(self.epoch) + '/' + str(num_epochs))
+                val_loss = self.validate(forward_model, val_loader, i_iter)
+
+            if is_main and validate_epoch:
+                print('Avg Train Loss: ' + "{0:.6f}".format(train_loss_avg) +
+                      '   Val loss: ' + "{0:.6f}".format(val_loss) +
+                      "   - " + str(int((time.time() - t_start_epoch) * 1000)) + "ms" +
+                      "   time left: {}\n".format(time_left(t_start_training, n_iters, i_iter)))
+            elif is_main:
+                print('Avg Train Loss: ' + "{0:.6f}".format(train_loss_avg) +
+                      "   - " + str(int((time.time() - t_start_epoch) * 1000)) + "ms" +
+                      "   time left: {}\n".format(time_left(t_start_training, n_iters, i_iter)))
 
             # Save model and solver
-            if save_after_epochs is not None and (self.epoch % save_after_epochs == 0):
+            if is_main and save_after_epochs is not None and (self.epoch % save_after_epochs == 0):
                 os.makedirs(save_path, exist_ok=True)
                 model.save(save_path + '/model' + str(self.epoch))
                 self.training_time_s += time.time() - t_start_training
                 self.save(save_path + '/solver' + str(self.epoch))
                 model.to(device)
 
-            # Stop if training time is over
-            if max_train_time_s is not None and (time.time() - t_start_training > max_train_time_s):
+            # Stop if training time is over. All processes have to stop after the same epoch, so rank 0 decides
+            time_over = max_train_time_s is not None and (time.time() - t_start_training > max_train_time_s)
+
+            if distributed:
+                time_over = torch.tensor([time_over], dtype=torch.uint8)
+                dist.broadcast(time_over, 0)
+                time_over = bool(time_over.item())
+
+            if time_over:
                 print("Training time is over.")
                 self.stop_reason = "Training time over."
                 break
 
+        metric_logger.close()
+
+        if tensorboard_writer is not None:
+            tensorboard_writer.close()
+
         if self.stop_reason is "":
             self.stop_reason = "Reached number of specified epochs."
 
         # Save model and solver after training
-        os.makedirs(save_path, exist_ok=True)
-        model.save(save_path + '/model' + str(self.epoch))
-        self.training_time_s += time.time() - t_start_training
-        self.save(save_path + '/solver' + str(self.epoch))
+        if is_main:
+            os.makedirs(save_path, exist_ok=True)
+            model.save(save_path + '/model' + str(self.epoch))
+            self.training_time_s += time.time() - t_start_training
+            self.save(save_path + '/solver' + str(self.epoch))
 
         print('FINISH.')
 
+    def validate(self, model, val_loader, i_iter):
+        """
+        Returns the reconstruction loss per target over the validation set and appends it to the history
+        """
+        model.eval()
+
+        # Sum on the device and read the result once
+        val_loss = 0
+        num_targets = 0
+
+        with torch.inference_mode():
+            for batch in val_loader:
+                # The PrefetchLoader already moved the batch to the device
+                x, y, question, _ = batch
+
+                y_pred, latent_stuff = model(x, question)
+
+                val_loss = val_loss + F.binary_cross_entropy_with_logits(y_pred, y, reduction='sum')
+                num_targets += get_num_targets(y, question)
+
+        if dist.is_available() and dist.is_initialized():
+            # Every process validated its part of the validation set
+            totals = torch.tensor([float(val_loss), float(num_targets)], dtype=torch.float64)
+            dist.all_reduce(totals)
+            val_loss, num_targets = totals[0], int(totals[1].item())
+
+        if num_targets == 0:
+            raise Exception('The validation loader is empty.')
+
+        val_loss = val_loss.item() / num_targets
+
+        self.append_history({'val_loss': val_loss, 'val_iteration': i_iter})
+
+        return val_loss
+
+    def set_resolution(self, model, loaders, resolution_schedule):
+        # Use the resolution of the last schedule entry that started at or before the current epoch
+        resolution = None
+
+        for first_epoch, scheduled_resolution in sorted(resolution_schedule):
+            if first_epoch <= self.epoch:
+                resolution = scheduled_resolution
+
+        if resolution != self.resolution:
+            print("Training on resolution {}".format(resolution))
+
+        self.resolution = resolution
+
+        model.set_resolution(resolution)
+
+        for loader in loaders:
+            loader.dataset.set_resolution(resolution)
+
     def save(self, path):
         print('Saving solver... %s\n' % path)
+        # The rows of the history are appended to files beside the checkpoint, it only stores their lengths
+        history_state = self.history.save(os.path.dirname(path))
+
         torch.save({
-            'history': self.history,
+            'history': history_state,
             'epoch': self.epoch,
             'stop_reason': self.stop_reason,
             'training_time_s': self.training_time_s,
@@ -241,7 +355,7 @@ class Solver(object):
             self.optim.load_state_dict(checkpoint['optim_state_dict'])
             self.criterion = checkpoint['criterion']
 
-        self.history = checkpoint['history']
+        self.history = History.load(checkpoint['history'], os.path.dirname(path))
         self.epoch = checkpoint['epoch']
         self.stop_reason = checkpoint['stop_reason']
         self.training_time_s = checkpoint['training_time_s']
@@ -251,11 +365,12 @@ class Solver(object):
             self.dataset_config = checkpoint['dataset_config']
 
     def append_history(self, hist_dict):
-        for key in hist_dict:
-            if key not in self.history:
-                self.history[key] = [hist_dict[key]]
-            else:
-                self.history[key].append(hist_dict[key])
+        self.history.append(hist_dict)
+
+def get_num_targets(y, question):
+    # Number of decoded targets of a batch, the batch size times the number of questions per sample
+    return question.numel() if question.dim() == 2 else y.shape[0]
+
 
 def plot_grad_flow(named_parameters):
     '''Plots the gradients flowing through different layers in the net during training.
@@ -1,23 +1,50 @@
+import os
+
+import numpy as np
 import torch
+import torch.distributed as dist
 
 from torch.utils.data import DataLoader, SequentialSampler, SubsetRandomSampler
-from torchvision import transforms
 
-from dl4cv.dataset.utils import CustomDataset
+from dl4cv.dataset.utils import CustomDataset, DistributedSubsetSampler, ReadaheadSampler
+from dl4cv.dataset.proceduralDataset import ProceduralDataset, get_generator_config
+from dl4cv.dataset.inMemoryLoader import InMemoryLoader
 from dl4cv.models.models import VariationalAutoEncoder
 from dl4cv.solver import Solver
 
 
 def train(config):
+    """
+    Trains with DistributedDataParallel in config['nprocs'] processes on the CPU if it is bigger than 1
+    """
+    nprocs = config.get('nprocs', 1)
+
+    if nprocs > 1:
+        torch.multiprocessing.spawn(train_process, args=(nprocs, config), nprocs=nprocs)
+    else:
+        train_process(0, 1, config)
+
+
+def train_process(rank, world_size, config):
+
+    distributed = world_size > 1
+
+    if distributed:
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', str(config.get('master_port', 29500)))
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+        # Split the cores between the processes instead of letting every process use all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
 
     """ Add a seed to have reproducible results """
 
     seed = 456
-    torch.manual_seed(seed)
+    torch.manual_seed(seed + rank)
 
     """ Configure training with or without cuda """
 
-    if config['use_cuda'] and torch.cuda.is_available():
+    if config['use_cuda'] and torch.cuda.is_available() and not distributed:
         device = torch.device("cuda")
         torch.cuda.manual_seed(seed)
         kwargs = {'pin_memory': True}
@@ -33,19 +60,42 @@ def train(config):
     print("Loading dataset with input sequence length {} and output sequence length {}...".format(
         config['len_inp_sequence'], config['len_out_sequence']))
 
-    dataset = CustomDataset(
-        config['data_path'],
-        transform=transforms.Compose([
-            transforms.Grayscale(),
-            transforms.ToTensor()
-        ]),
-        len_inp_sequence=config['len_inp_sequence'],
-        len_out_sequence=config['len_out_sequence'],
-        load_to_ram=config['load_data_to_ram'],
-        question=config['use_question'],
-        load_ground_truth=False,
-        load_config=True
-    )
+    # Only the sequences the samplers use have to be loaded to RAM
+    if config['do_overfitting']:
+        used_indices = range(config['num_train_overfit'])
+    else:
+        used_indices = range(config['num_train_regular'] + config['num_val_regular'])
+
+    if config.get('procedural_data', False):
+        # Generate the sequences on the fly with the settings of the dataset in data_path, or the defaults of
+        # generateDataset.py, updated with the settings in procedural_config
+        dataset = ProceduralDataset(
+            get_generator_config(config.get('data_path', None), config.get('procedural_config', None)),
+            num_sequences=config['num_train_regular'] + config['num_val_regular'],
+            len_inp_sequence=config['len_inp_sequence'],
+            len_out_sequence=config['len_out_sequence'],
+            question=config['use_question'],
+            load_ground_truth=False,
+            num_questions=config.get('num_questions', 1)
+        )
+    else:
+        dataset = CustomDataset(
+            config['data_path'],
+            transform=None,
+            len_inp_sequence=config['len_inp_sequence'],
+            len_out_sequence=config['len_out_sequence'],
+            load_to_ram=config['load_data_to_ram'],
+            ram_format=config.get('ram_format', 'uint8'),
+            shared_memory=config.get('shared_memory', False),
+            load_indices=used_indices,
+            num_load_workers=config.get('num_load_workers', None),
+            question=config['use_question'],
+            num_questions=config.get('num_questions', 1),
+            cache_bytes=config.get('cache_bytes', 0),
+            readahead=config.get('readahead', 0),
+            load_ground_truth=False,
+            load_config=True
+        )
 
     if config['batch_size'] > len(dataset):
         raise Exception('Batch size bigger than the dataset.')
@@ -55,8 +105,9 @@ def train(config):
         if config['batch_size'] > config['num_train_overfit']:
             raise Exception('Batchsize for overfitting bigger than the number of samples for overfitting.')
         else:
-            train_data_sampler = SequentialSampler(range(config['num_train_overfit']))
-            val_data_sampler = SequentialSampler(range(config['num_train_overfit']))
+            train_indices = range(config['num_train_overfit'])
+            val_indices = range(config['num_train_overfit'])
+            shuffle = False
 
     else:
         print("Training on {} samples".format(config['num_train_regular']))
@@ -66,28 +117,75 @@ def train(config):
                     config['num_train_regular'] + config['num_val_regular'], len(dataset)
                 ))
         else:
-            train_data_sampler = SubsetRandomSampler(range(config['num_train_regular']))
-            val_data_sampler = SubsetRandomSampler(range(
+            train_indices = range(config['num_train_regular'])
+            val_indices = range(
                 config['num_train_regular'],
                 config['num_train_regular'] + config['num_val_regular']
-            ))
-
-    train_data_loader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=config['batch_size'],
-        num_workers=config['num_workers'],
-        sampler=train_data_sampler,
-        drop_last=True,
-        **kwargs
-    )
-    val_data_loader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=config['batch_size'],
-        num_workers=config['num_workers'],
-        sampler=val_data_sampler,
-        drop_last=True,
-        **kwargs
-    )
+            )
+            shuffle = True
+
+    # Validate on a fixed random subset of the validation set, the same in every validation
+    num_val_subset = config.get('num_val_subset', None)
+    if num_val_subset is not None and num_val_subset < len(val_indices):
+        val_indices = np.sort(np.random.RandomState(seed).choice(val_indices, num_val_subset, replace=False)).tolist()
+
+    # Validation doesn't keep activations for the backward pass and can use bigger batches
+    val_batch_size = config.get('val_batch_size', config['batch_size'])
+
+    if distributed:
+        # Every process trains on its part of the indices. The parts have the same size, so all processes run the
+        # same number of iterations
+        rank_train_indices = list(train_indices)[rank::world_size][:len(train_indices) // world_size]
+        val_indices = list(val_indices)[rank::world_size]
+    else:
+        rank_train_indices = train_indices
+
+    if config.get('in_memory_loader', False):
+        # Gather whole batches from the RAM store of the dataset, needs load_data_to_ram
+        train_data_loader = InMemoryLoader(dataset, rank_train_indices, config['batch_size'], shuffle=shuffle)
+        val_data_loader = InMemoryLoader(dataset, val_indices, val_batch_size, shuffle=False, drop_last=False)
+
+    else:
+        if config.get('readahead', 0) > 0 and isinstance(dataset, CustomDataset):
+            # The dataset decodes the upcoming sequences of the training sampler into its cache
+            train_data_sampler = ReadaheadSampler(rank_train_indices, shuffle=shuffle)
+            dataset.set_readahead_sampler(train_data_sampler, config['batch_size'])
+        elif distributed:
+            train_data_sampler = DistributedSubsetSampler(train_indices, num_replicas=world_size, rank=rank,
+                                                          shuffle=shuffle, seed=seed, drop_last=True)
+        elif shuffle:
+            train_data_sampler = SubsetRandomSampler(train_indices)
+        else:
+            train_data_sampler = SequentialSampler(train_indices)
+
+        # The order doesn't matter for the validation loss. SequentialSampler would yield 0..n-1 instead of the indices
+        val_data_sampler = list(val_indices)
+
+        # Keep the workers and their sequence caches alive between epochs. A resolution switch of the dataset in the
+        # main process doesn't reach persistent workers, so they are only used without a resolution schedule
+        if config['num_workers'] > 0 and (config.get('cache_bytes', 0) > 0 or config.get('readahead', 0) > 0) and \
+                config.get('resolution_schedule', None) is None:
+            kwargs['persistent_workers'] = True
+
+        train_data_loader = torch.utils.data.DataLoader(
+            dataset=dataset,
+            batch_size=config['batch_size'],
+            num_workers=config['num_workers'],
+            sampler=train_data_sampler,
+            drop_last=True,
+            **kwargs
+        )
+        val_data_loader = torch.utils.data.DataLoader(
+            dataset=dataset,
+            batch_size=val_batch_size,
+            num_workers=config['num_workers'],
+            sampler=val_data_sampler,
+            drop_last=False,
+            **kwargs
+        )
+
+    # Optionally train the first epochs on lower resolutions of a packed dataset pyramid, e.g. [[1, 16], [3, 32], [5, 64]]
+    resolution_schedule = config.get('resolution_schedule', None)
 
     """ Initialize model and solver """
 
@@ -110,29 +208,46 @@ def train(config):
             len_out_sequence=config['len_out_sequence'],
             z_dim_encoder=config['z_dim_encoder'],
             z_dim_decoder=config['z_dim_decoder'],
-            use_physics=config['use_physics']
+            use_physics=config['use_physics'],
+            use_question=config['use_question'],
+            resolutions=[resolution for _, resolution in resolution_schedule or []]
         )
         solver = Solver()
         optimizer = torch.optim.Adam(model.parameters(), lr=config['learning_rate'])
 
     """ Perform training """
-    solver.train(model=model,
-                 train_config=config,
-                 dataset_config=dataset.config,
-                 tensorboard_path=config['tensorboard_log_dir'],
-                 optim=optimizer,
-                 num_epochs=config['num_epochs'],
-                 max_train_time_s=config['max_train_time_s'],
-                 train_loader=train_data_loader,
-                 val_loader=val_data_loader,
-                 log_after_iters=config['log_interval'],
-                 save_after_epochs=config['save_interval'],
-                 save_path=config['save_path'],
-                 device=device,
-                 C_offset=config['C_offset'],
-                 C_max=config['C_max'],
-                 C_stop_iter=config['C_stop_iter'],
-                 gamma=config['gamma'],
-                 target_var=config['target_var'],
-                 log_reconstructed_images=config['log_reconstructed_images'],
-                 beta=config['beta'])
+    try:
+        solver.train(model=model,
+                     train_config=config,
+                     dataset_config=dataset.config,
+                     tensorboard_path=config['tensorboard_log_dir'],
+                     optim=optimizer,
+                     num_epochs=config['num_epochs'],
+                     max_train_time_s=config['max_train_time_s'],
+                     train_loader=train_data_loader,
+                     val_loader=val_data_loader,
+                     log_after_iters=config['log_interval'],
+                     save_after_epochs=config['save_interval'],
+                     save_path=config['save_path'],
+                     device=device,
+                     C_offset=config['C_offset'],
+                     C_max=config['C_max'],
+                     C_stop_iter=config['C_stop_iter'],
+                     gamma=config['gamma'],
+                     target_var=config['target_var'],
+                     log_reconstructed_images=config['log_reconstructed_images'],
+                     beta=config['beta'],
+                     resolution_schedule=resolution_schedule,
+                     num_prefetch=config.get('num_prefetch', 2),
+                     flush_after_iters=config.get('flush_after_iters', 50),
+                     history_downsample=config.get('history_downsample', 1),
+                     validate_after_epochs=config.get('validate_after_epochs', 1),
+                     validate_after_iters=config.get('validate_after_iters', None),
+                     mixed_precision=config.get('mixed_precision', False),
+                     use_compile=config.get('compile_model', False))
+    finally:
+        # Close the shared memory segments while nothing views them anymore
+        dataset.close()
+
+    if distributed:
+        dist.destroy_process_group()
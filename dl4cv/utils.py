@@ -1,3 +1,4 @@
+import copy
 import csv
 import datetime
 import time
@@ -39,7 +40,8 @@ def kl_divergence(mu, logvar, target_var=1.):
 def reparametrize(mu, logvar):
     # Taken from https://github.com/1Konny/Beta-VAE/blob/master/model.py
     std = logvar.div(2).exp()
-    eps = torch.autograd.Variable(std.data.new(std.size()).normal_())
+    # randn_like instead of a Variable around new().normal_(), which breaks the graph of torch.compile
+    eps = torch.randn_like(std)
     return mu + std*eps
 
 
@@ -61,6 +63,39 @@ def time_left(t_start, n_iters, i_iter):
     return time_left.strftime("%H:%M:%S")
 
 
+def benchmark_mixed_precision(model, x, question, backward=True, num_iters=5):
+    """
+    Returns the milliseconds per forward pass, and backward pass if backward is True, of a copy of the model in
+    float32 and with bfloat16 autocast
+    """
+    model = copy.deepcopy(model)
+    times = []
+
+    for mixed_precision in [False, True]:
+        model.set_mixed_precision(mixed_precision)
+
+        # The first pass is a warm up
+        for i_iter in range(num_iters + 1):
+            if i_iter == 1:
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                t_start = time.time()
+
+            if backward:
+                y, (mu, logvar) = model(x, question)
+                (y.sum() + mu.sum() + logvar.sum()).backward()
+                model.zero_grad()
+            else:
+                with torch.inference_mode():
+                    model(x, question)
+
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        times.append((time.time() - t_start) / num_iters * 1000)
+
+    return times
+
+
 def nearest_distances(X, k=1):
     """
     Source: https://gist.github.com/GaelVaroquaux/ead9898bd3c973c40429
@@ -138,3 +173,21 @@ def str2bool(v):
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def parse_run_arguments(parser, config):
+    """
+    Adds the command line options that override the config of a run to the parser, parses the arguments, writes the
+    options to the config and returns the arguments
+    """
+    parser.add_argument('--mixed_precision', default=config.get('mixed_precision', False), type=str2bool,
+                        help='Train and evaluate with bfloat16 autocast')
+    parser.add_argument('--nprocs', default=config.get('nprocs', 1), type=int,
+                        help='Number of processes for data-parallel training')
+
+    args = parser.parse_args()
+
+    config['mixed_precision'] = args.mixed_precision
+    config['nprocs'] = args.nprocs
+
+    return args
@@ -0,0 +1,494 @@
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image, ImageDraw
+from torchvision import transforms
+
+import dl4cv.dataset.utils
+from dl4cv.dataset.generateDataset import get_argument_parser, generate_data
+from dl4cv.dataset.utils import CustomDataset, render_frames, create_packed_dataset, open_packed_dataset, \
+    open_packed_frames, resize_packed_dataset, get_shared_memory_name, get_default_load_workers, SEQUENCE_INDEX, \
+    SHARED_HEADER_LENGTH, SHARED_PID, CONSOLIDATED_GROUND_TRUTH, ReadaheadSampler, DistributedSubsetSampler
+
+
+def create_small_packed_dataset(path, num_sequences=6, len_sequence=8, resolutions=(), window_size=32,
+                                anti_aliasing=False):
+    """
+    Creates a packed dataset with random trajectories and returns its frames and ground truth
+    """
+    random_state = np.random.RandomState(0)
+    x = torch.tensor(random_state.uniform(0, window_size, (num_sequences, len_sequence)))
+    y = torch.tensor(random_state.uniform(0, window_size, (num_sequences, len_sequence)))
+
+    create_packed_dataset(path, num_sequences, len_sequence, window_size, window_size, resolutions)
+
+    frames, ground_truth = open_packed_dataset(path, mmap_mode='r+')
+    frames[:] = render_frames(x, y, window_size, window_size, 2, anti_aliasing=anti_aliasing).numpy()
+    ground_truth[:] = random_state.rand(num_sequences, len_sequence, 6)
+    frames.flush()
+    ground_truth.flush()
+
+    for resolution in resolutions:
+        frames_resolution = open_packed_frames(path, mmap_mode='r+', resolution=resolution)
+        frames_resolution[:] = render_frames(x, y, window_size, window_size, 2, anti_aliasing=anti_aliasing,
+                                             scale=resolution / window_size).numpy()
+        frames_resolution.flush()
+
+    return np.array(frames), np.array(ground_truth)
+
+
+def create_small_jpeg_dataset(path, num_sequences=10, len_sequence=6):
+    config = get_argument_parser().parse_args(['--save_dir_path', path, '--num_sequences', str(num_sequences),
+                                               '--len_sequence', str(len_sequence), '--eval_before_saving', 'False'])
+    generate_data(config)
+
+
+def draw_ball(window_size_x, window_size_y, ball_radius, x, y):
+    # How the generators drew every frame before render_frames
+    image = Image.new(mode='L', size=(window_size_x, window_size_y))
+    ImageDraw.Draw(image).ellipse(
+        xy=[(x - ball_radius, y - ball_radius), (x + ball_radius, y + ball_radius)],
+        width=0,
+        fill='white'
+    )
+
+    return np.asarray(image)
+
+
+@pytest.mark.parametrize('window_size_x, window_size_y, ball_radius', [(64, 64, 2), (64, 64, 3), (64, 48, 2.5),
+                                                                       (32, 64, 4.2)])
+def test_render_frames_matches_pil_at_fractional_positions(window_size_x, window_size_y, ball_radius):
+    random_state = np.random.RandomState(0)
+    # Include positions with the ball partly outside of the window
+    x = torch.tensor(random_state.uniform(-8, window_size_x + 8, (10, 15)))
+    y = torch.tensor(random_state.uniform(-8, window_size_y + 8, (10, 15)))
+
+    frames = render_frames(x, y, window_size_x, window_size_y, ball_radius).numpy()
+
+    for i_sequence in range(x.shape[0]):
+        for i_frame in range(x.shape[1]):
+            expected = draw_ball(window_size_x, window_size_y, ball_radius, float(x[i_sequence, i_frame]),
+                                 float(y[i_sequence, i_frame]))
+            np.testing.assert_array_equal(frames[i_sequence, i_frame], expected)
+
+
+def test_packed_dataset_round_trip(tmp_path):
+    path = str(tmp_path)
+    frames, ground_truth = create_small_packed_dataset(path)
+
+    opened_frames, opened_ground_truth = open_packed_dataset(path)
+    np.testing.assert_array_equal(opened_frames, frames)
+    np.testing.assert_array_equal(opened_ground_truth, ground_truth)
+
+    dataset = CustomDataset(path, None, 5, 1, load_ground_truth=True)
+    assert len(dataset) == 6
+
+    x, y, question, sample_ground_truth = dataset[3]
+    np.testing.assert_array_equal(x.numpy(), frames[3, :5] / np.float32(255))
+    np.testing.assert_array_equal(y.numpy(), frames[3, 5:6] / np.float32(255))
+    np.testing.assert_array_equal(sample_ground_truth, ground_truth[3])
+
+
+def test_packed_dataset_resolutions(tmp_path):
+    path = str(tmp_path)
+    create_small_packed_dataset(path, resolutions=(16,))
+
+    assert open_packed_frames(path, resolution=16).shape == (6, 8, 16, 16)
+    # The generated resolution is always there
+    assert open_packed_frames(path, resolution=32).shape == (6, 8, 32, 32)
+
+    with pytest.raises(Exception):
+        open_packed_frames(path, resolution=64)
+
+
+def test_resize_packed_dataset(tmp_path):
+    path = str(tmp_path)
+    frames, ground_truth = create_small_packed_dataset(path, resolutions=(16,))
+    frames_16 = np.array(open_packed_frames(path, resolution=16))
+
+    resize_packed_dataset(path, 10)
+
+    resized_frames, resized_ground_truth = open_packed_dataset(path)
+    assert resized_frames.shape == (10, 8, 32, 32)
+    np.testing.assert_array_equal(resized_frames[:6], frames)
+    np.testing.assert_array_equal(resized_ground_truth[:6], ground_truth)
+    np.testing.assert_array_equal(open_packed_frames(path, resolution=16)[:6], frames_16)
+    assert not resized_frames[6:].any()
+
+    resize_packed_dataset(path, 4)
+
+    np.testing.assert_array_equal(open_packed_dataset(path)[0], frames[:4])
+
+
+@pytest.mark.parametrize('window_size', [32, 20])
+@pytest.mark.parametrize('ram_format', ['uint8', 'bits', 'float'])
+def test_ram_formats_match_disk(tmp_path, ram_format, window_size):
+    path = str(tmp_path)
+    create_small_packed_dataset(path, window_size=window_size)
+
+    on_disk = CustomDataset(path, None, 5, 1)
+    in_ram = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format=ram_format)
+
+    if ram_format == 'bits':
+        # Eight pixels per byte, the last byte of a row is padded
+        assert in_ram.frames.shape == (6, 8, window_size, (window_size + 7) // 8)
+
+    for index in range(len(on_disk)):
+        for expected, sample in zip(on_disk[index][:2], in_ram[index][:2]):
+            assert torch.equal(sample, expected)
+
+
+def test_bits_only_keep_pixels_from_half_intensity(tmp_path):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path, anti_aliasing=True)
+
+    dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format='bits')
+
+    np.testing.assert_array_equal(dataset.get_packed_sequence(2), (frames[2] >= 128) * np.uint8(255))
+
+
+def test_bits_with_load_indices(tmp_path):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path, resolutions=(16,))
+
+    dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format='bits', load_indices=[4, 1])
+
+    assert dataset.frames.shape[0] == 2
+    np.testing.assert_array_equal(dataset.get_packed_sequence(4), frames[4])
+    np.testing.assert_array_equal(dataset.get_packed_sequence(1), frames[1])
+
+    with pytest.raises(Exception):
+        dataset.get_packed_sequence(0)
+
+    # Other resolutions are bit-packed as well
+    dataset.set_resolution(16)
+    np.testing.assert_array_equal(dataset.get_packed_sequence(4), open_packed_frames(path, resolution=16)[4])
+
+
+def shared_frames_exist(path, ram_format):
+    try:
+        segment = shared_memory.SharedMemory(name=get_shared_memory_name(path, ram_format))
+    except FileNotFoundError:
+        return False
+
+    # Attaching registered the segment with the resource tracker again
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    segment.close()
+
+    return True
+
+
+def unlink_shared_frames(path, ram_format):
+    try:
+        segment = shared_memory.SharedMemory(name=get_shared_memory_name(path, ram_format))
+    except FileNotFoundError:
+        return
+
+    segment.close()
+    segment.unlink()
+
+
+@pytest.mark.parametrize('ram_format', ['uint8', 'float'])
+def test_close_closes_shared_memory_segments(tmp_path, ram_format):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path)
+
+    try:
+        dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format=ram_format, shared_memory=True)
+        segment = dataset.shared_memory_segments[0]
+
+        # Float samples are views of the segment
+        x, y, _, _ = dataset[2]
+        np.testing.assert_array_equal(x.numpy(), frames[2, :5] / np.float32(255))
+        del x, y
+
+        dataset.close()
+
+        assert dataset.frames is None
+        assert dataset.shared_memory_segments == []
+        # A closed segment has no buffer anymore
+        assert segment.buf is None
+        # The only user removed it
+        assert not shared_frames_exist(path, ram_format)
+    finally:
+        unlink_shared_frames(path, ram_format)
+
+
+def test_last_user_removes_shared_memory_segment(tmp_path):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path)
+
+    try:
+        first = CustomDataset(path, None, 5, 1, load_to_ram=True, shared_memory=True)
+        second = CustomDataset(path, None, 5, 1, load_to_ram=True, shared_memory=True)
+
+        first.close()
+
+        assert shared_frames_exist(path, 'uint8')
+        np.testing.assert_array_equal(second.frames, frames)
+
+        second.close()
+
+        assert not shared_frames_exist(path, 'uint8')
+
+        # The next dataset builds the segment again
+        third = CustomDataset(path, None, 5, 1, load_to_ram=True, shared_memory=True)
+        np.testing.assert_array_equal(third.frames, frames)
+        third.close()
+
+        assert not shared_frames_exist(path, 'uint8')
+    finally:
+        unlink_shared_frames(path, 'uint8')
+
+
+@pytest.mark.parametrize('ram_format', ['uint8', 'float'])
+def test_load_workers_decode_the_same_frames(tmp_path, ram_format):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+
+    single = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format=ram_format, num_load_workers=1)
+    pool = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format=ram_format, num_load_workers=3)
+
+    assert single.frames.shape == (10, 6, 64, 64)
+    np.testing.assert_array_equal(np.asarray(pool.frames), np.asarray(single.frames))
+
+
+def test_default_load_workers_share_the_cores(monkeypatch):
+    monkeypatch.setattr(dl4cv.dataset.utils.os, 'cpu_count', lambda: 8)
+    assert get_default_load_workers() == 8
+
+    # Every rank of a distributed run loads its frames with its own pool
+    monkeypatch.setattr(dl4cv.dataset.utils.dist, 'is_initialized', lambda: True)
+    monkeypatch.setattr(dl4cv.dataset.utils.dist, 'get_world_size', lambda: 3)
+    assert get_default_load_workers() == 2
+
+    monkeypatch.setattr(dl4cv.dataset.utils.dist, 'get_world_size', lambda: 16)
+    assert get_default_load_workers() == 1
+
+
+def test_read_ahead_continues_after_failed_sequence(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+
+    dataset = CustomDataset(path, None, 5, 1, cache_bytes=10 ** 8, readahead=4)
+    dataset.init_cache()
+    load_sequence = dataset.load_sequence
+
+    def failing_load_sequence(seq_path):
+        if seq_path == dataset.sequence_paths[2]:
+            raise OSError('Unreadable sequence')
+
+        return load_sequence(seq_path)
+
+    monkeypatch.setattr(dataset, 'load_sequence', failing_load_sequence)
+
+    dataset.readahead_queued.update([2, 3])
+    dataset.readahead_queue.put(2)
+    dataset.readahead_queue.put(3)
+
+    deadline = time.time() + 10
+
+    while len(dataset.readahead_queued) > 0 and time.time() < deadline:
+        time.sleep(0.01)
+
+    # The failed sequence is no longer queued, so the next request queues it again
+    assert dataset.readahead_queued == set()
+    assert 2 not in dataset.cache
+    assert 3 in dataset.cache
+
+
+def test_shared_memory_with_transformed_float_frames(tmp_path):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+    transform = transforms.Compose([transforms.Grayscale(), transforms.ToTensor()])
+
+    try:
+        dataset = CustomDataset(path, transform, 5, 1, load_to_ram=True, ram_format='float', shared_memory=True,
+                                num_load_workers=1)
+        attached = CustomDataset(path, transform, 5, 1, load_to_ram=True, ram_format='float', shared_memory=True,
+                                 num_load_workers=1)
+
+        assert dataset.frame_width == attached.frame_width == 64
+        assert torch.equal(attached[3][0], dataset[3][0])
+
+        dataset.close()
+        attached.close()
+    finally:
+        unlink_shared_frames(path, 'float')
+
+
+def test_sequence_index_is_built_on_the_first_open(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path, num_sequences=12)
+    indexed = CustomDataset(path, None, 5, 1)
+    os.remove(os.path.join(path, SEQUENCE_INDEX))
+
+    walked = CustomDataset(path, None, 5, 1)
+
+    # The sequences are in numeric order, seq10 follows seq9
+    assert walked.sequence_paths == indexed.sequence_paths == [os.path.join(path, 'seq' + str(i)) for i in range(12)]
+    assert walked.sequences == indexed.sequences
+    assert os.path.exists(os.path.join(path, SEQUENCE_INDEX))
+
+    # Later opens don't walk the dataset anymore
+    def walk_sequences(self):
+        raise AssertionError('The dataset was walked')
+
+    monkeypatch.setattr(CustomDataset, 'walk_sequences', walk_sequences)
+    assert CustomDataset(path, None, 5, 1).sequences == indexed.sequences
+
+
+def test_float_samples_are_views_of_the_store(tmp_path):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+
+    on_disk = CustomDataset(path, None, 5, 1)
+    in_ram = CustomDataset(path, None, 5, 1, load_to_ram=True, ram_format='float', num_load_workers=1)
+
+    assert in_ram.frames.shape == (10, 6, 64, 64) and in_ram.frames.is_contiguous()
+
+    for index in range(len(on_disk)):
+        x, y, _, _ = in_ram[index]
+        expected_x, expected_y, _, _ = on_disk[index]
+
+        assert torch.equal(x, expected_x) and torch.equal(y, expected_y)
+        # No copy of the frames
+        assert x.untyped_storage().data_ptr() == in_ram.frames.untyped_storage().data_ptr()
+
+
+def test_segment_of_a_dead_process_is_rebuilt(tmp_path):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path)
+
+    # A process that died while it filled the segment
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+
+    segment = shared_memory.SharedMemory(name=get_shared_memory_name(path, 'uint8'), create=True, size=1024)
+
+    try:
+        header = np.ndarray((SHARED_HEADER_LENGTH,), dtype=np.int64, buffer=segment.buf)
+        header[SHARED_PID] = process.pid
+        del header
+
+        dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, shared_memory=True)
+
+        np.testing.assert_array_equal(dataset.frames, frames)
+        dataset.close()
+    finally:
+        segment.close()
+        unlink_shared_frames(path, 'uint8')
+
+
+def test_consolidated_ground_truth_matches_the_sequence_files(tmp_path):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+    expected = np.stack([np.load(os.path.join(path, 'seq' + str(i), 'ground_truth.npy')) for i in range(10)])
+
+    # Datasets of older generators only have the files of the sequences
+    os.remove(os.path.join(path, CONSOLIDATED_GROUND_TRUTH))
+    dataset = CustomDataset(path, None, 5, 1, load_ground_truth=True)
+
+    np.testing.assert_array_equal(dataset.get_ground_truths(), expected)
+    np.testing.assert_array_equal(dataset.get_ground_truths([7, 2]), expected[[7, 2]])
+    np.testing.assert_array_equal(dataset[4][3], expected[4])
+
+    # The first access saved the consolidated file, later datasets memory map it
+    assert os.path.exists(os.path.join(path, CONSOLIDATED_GROUND_TRUTH))
+    assert isinstance(CustomDataset(path, None, 5, 1).get_ground_truth_array(), np.memmap)
+
+
+def test_samples_with_several_questions(tmp_path):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path)
+    dataset = CustomDataset(path, None, 3, 2, question=True, num_questions=4)
+
+    x, y, question, _ = dataset[1]
+
+    assert y.shape == (4, 2, 32, 32) and question.shape == (4,)
+
+    for target, t in zip(y, question.long().tolist()):
+        np.testing.assert_array_equal(target.numpy(), frames[1, t:t + 2] / np.float32(255))
+
+
+def test_sequence_cache_evicts_the_least_recently_used(tmp_path):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+    on_disk = CustomDataset(path, None, 5, 1)
+    # Room for three sequences of 6 frames
+    dataset = CustomDataset(path, None, 5, 1, cache_bytes=3 * 6 * 64 * 64)
+
+    for index in [0, 1, 2, 0, 3, 0]:
+        assert torch.equal(dataset[index][0], on_disk[index][0])
+
+    assert list(dataset.cache.keys()) == [2, 3, 0]
+    statistics = dataset.get_cache_statistics()
+    assert (statistics['hits'], statistics['misses']) == (2, 4)
+    assert statistics['bytes'] == 3 * 6 * 64 * 64
+
+
+def test_readahead_follows_the_order_of_the_sampler(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    create_small_jpeg_dataset(path)
+    dataset = CustomDataset(path, None, 5, 1, cache_bytes=10 ** 8, readahead=3)
+    sampler = ReadaheadSampler(range(10), seed=3)
+    dataset.set_readahead_sampler(sampler, 2)
+
+    first_epoch = list(sampler)
+    second_epoch = list(sampler)
+
+    assert sorted(first_epoch) == list(range(10)) and first_epoch != second_epoch
+    # The order only depends on the seed and the epoch
+    assert sampler.get_order()[0] == second_epoch
+    assert list(ReadaheadSampler(range(10), seed=3)) == first_epoch
+
+    # The second of two workers gets the batches 1 and 3 with the positions 2, 3, 6 and 7
+    monkeypatch.setattr(dl4cv.dataset.utils, 'get_worker_info', lambda: SimpleNamespace(num_workers=2, id=1))
+    assert dataset.get_upcoming_indices(second_epoch[2]) == [second_epoch[3], second_epoch[6], second_epoch[7]]
+    monkeypatch.undo()
+
+    assert dataset.get_upcoming_indices(second_epoch[4]) == second_epoch[5:8]
+
+    dataset[second_epoch[4]]
+    deadline = time.time() + 10
+
+    while len(dataset.readahead_queued) > 0 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert set(second_epoch[4:8]) == set(dataset.cache.keys())
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_distributed_subset_sampler_splits_the_indices(shuffle):
+    indices = list(range(100, 150, 2))
+    world_size = 3
+
+    def get_parts(epoch):
+        parts = []
+
+        for rank in range(world_size):
+            sampler = DistributedSubsetSampler(indices, num_replicas=world_size, rank=rank, shuffle=shuffle, seed=5,
+                                               drop_last=True)
+            sampler.set_epoch(epoch)
+            parts.append(list(sampler))
+
+        return parts
+
+    parts = get_parts(0)
+    sampled = [index for part in parts for index in part]
+
+    # Every rank gets the same number of indices of the subset and no index twice
+    assert all(len(part) == len(indices) // world_size for part in parts)
+    assert len(set(sampled)) == len(sampled) and set(sampled) <= set(indices)
+
+    if shuffle:
+        assert get_parts(1) != parts
+    else:
+        assert get_parts(1) == parts
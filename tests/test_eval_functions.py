@@ -0,0 +1,61 @@
+import matplotlib
+import numpy as np
+
+matplotlib.use('Agg')
+
+from dl4cv.eval.eval_functions import analyze_dataset, _get_occupancy, _merge_statistics
+
+
+def get_trajectories(num_sequences=50, len_sequence=8, seed=0):
+    random_state = np.random.RandomState(seed)
+    trajectories = random_state.uniform(0, 32, (num_sequences, len_sequence, 6))
+    # Smooth positions, so the segments between the frames are short
+    trajectories[:, :, :2] = np.cumsum(random_state.uniform(-1, 1, (num_sequences, len_sequence, 2)), axis=1) + 16
+
+    return trajectories
+
+
+def test_merged_statistics_match_the_whole_array():
+    values = get_trajectories(100)[:, 0]
+    statistics = None
+
+    for i_chunk in range(0, 100, 30):
+        statistics = _merge_statistics(statistics, values[i_chunk:i_chunk + 30])
+
+    n, mean, scatter_matrix = statistics
+
+    assert n == 100
+    np.testing.assert_allclose(mean, values.mean(axis=0))
+    np.testing.assert_allclose(scatter_matrix, np.cov(values, rowvar=False) * 99)
+
+
+def test_occupancy_covers_every_bin_of_a_segment():
+    trajectory = np.zeros((1, 2, 6))
+    trajectory[0, :, 0] = [2.1, 9.9]
+    trajectory[0, :, 1] = 5.5
+
+    occupancy = _get_occupancy(trajectory, 16, 16, 2)
+
+    # The segment crosses the bins 4 to 19 in x in the row of y = 5.5
+    assert (occupancy[4:20, 11] > 0).all()
+    assert occupancy.sum() == occupancy[4:20, 11].sum()
+
+
+def test_occupancy_does_not_depend_on_the_blocks():
+    trajectories = get_trajectories()
+
+    occupancy = _get_occupancy(trajectories, 32, 32, 4)
+
+    np.testing.assert_array_equal(_get_occupancy(trajectories, 32, 32, 4, max_samples=100), occupancy)
+    np.testing.assert_array_equal(_get_occupancy(trajectories[:20], 32, 32, 4) +
+                                  _get_occupancy(trajectories[20:], 32, 32, 4), occupancy)
+
+
+def test_analyze_dataset_in_chunks(tmp_path):
+    trajectories = get_trajectories()
+    chunks = (trajectories[i_chunk:i_chunk + 16] for i_chunk in range(0, 50, 16))
+
+    analyze_dataset(chunks, window_size_x=32, window_size_y=32, mode='density',
+                    save_path=str(tmp_path / 'positions.png'))
+
+    assert (tmp_path / 'positions.png').exists()
@@ -0,0 +1,139 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import torch
+
+from dl4cv.dataset.generateDataset import get_argument_parser, generate_data, init_config, sample_trajectories, \
+    get_collisions, MANIFEST
+from dl4cv.dataset.utils import CustomDataset, open_packed_dataset, is_packed_dataset
+
+
+def get_config(path, *args):
+    return get_argument_parser().parse_args(['--save_dir_path', path, '--eval_before_saving', 'False',
+                                             '--len_sequence', '6', '--shard_size', '4'] + list(args))
+
+
+def read_dataset(path):
+    """
+    Returns the frames and the ground truth of a generated dataset
+    """
+    if is_packed_dataset(path):
+        frames, ground_truth = open_packed_dataset(path)
+        return np.array(frames), np.array(ground_truth)
+
+    dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, num_load_workers=1)
+
+    return dataset.frames, dataset.get_ground_truths()
+
+
+@pytest.mark.parametrize('packed', ['True', 'False'])
+def test_frames_do_not_depend_on_the_number_of_workers(tmp_path, packed):
+    single = str(tmp_path / 'single')
+    parallel = str(tmp_path / 'parallel')
+
+    generate_data(get_config(single, '--num_sequences', '10', '--packed', packed))
+    generate_data(get_config(parallel, '--num_sequences', '10', '--packed', packed, '--num_workers', '3'))
+
+    frames, ground_truth = read_dataset(single)
+
+    assert frames.shape == (10, 6, 64, 64)
+    assert frames.any()
+
+    for expected, generated in zip((frames, ground_truth), read_dataset(parallel)):
+        np.testing.assert_array_equal(generated, expected)
+
+
+def test_shards_only_depend_on_the_seed(tmp_path):
+    small = str(tmp_path / 'small')
+    large = str(tmp_path / 'large')
+    other_seed = str(tmp_path / 'other_seed')
+
+    generate_data(get_config(small, '--num_sequences', '8', '--packed', 'True'))
+    generate_data(get_config(large, '--num_sequences', '12', '--packed', 'True'))
+    generate_data(get_config(other_seed, '--num_sequences', '8', '--packed', 'True', '--seed', '2'))
+
+    # The first two shards are the same, no matter how many shards follow
+    for expected, generated in zip(read_dataset(small), read_dataset(large)):
+        np.testing.assert_array_equal(generated[:8], expected)
+
+    assert not np.array_equal(read_dataset(other_seed)[1], read_dataset(small)[1])
+
+
+@pytest.mark.parametrize('feasible_sampling', ['False', 'True'])
+def test_sampler_only_resamples_rejected_trajectories(feasible_sampling):
+    args = ['--len_sequence', '30', '--feasible_sampling', feasible_sampling]
+    first_pass = init_config(get_config('', '--avoid_collisions', 'False', *args))
+    rejection = init_config(get_config('', *args))
+
+    # Without collision avoidance the sampler stops after the first pass
+    x_first, y_first = sample_trajectories(first_pass, 256, 7, verbose=False)[:2]
+    x, y = sample_trajectories(rejection, 256, 7, verbose=False)[:2]
+
+    collided = get_collisions(x_first, y_first, first_pass.x_min, first_pass.x_max, first_pass.y_min,
+                              first_pass.y_max).astype(bool)
+
+    assert not get_collisions(x, y, rejection.x_min, rejection.x_max, rejection.y_min, rejection.y_max).any()
+    assert torch.equal(x[~collided], x_first[~collided]) and torch.equal(y[~collided], y_first[~collided])
+
+    if feasible_sampling == 'False':
+        assert collided.any()
+
+
+def interrupt_after_first_shard(path):
+    # Leave the dataset as if the generator crashed after the first shard with 4 sequences
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        f.write("0 4\n")
+
+    for name in os.listdir(path):
+        if name.startswith('seq') and int(name[3:]) >= 4:
+            shutil.rmtree(os.path.join(path, name))
+        elif name in ['frames.npy', 'ground_truth.npy']:
+            array = np.load(os.path.join(path, name), mmap_mode='r+')
+            array[4:] = 0
+            array.flush()
+        elif name == 'index.p':
+            os.remove(os.path.join(path, name))
+
+
+@pytest.mark.parametrize('packed', ['True', 'False'])
+def test_resumed_dataset_equals_fresh_dataset(tmp_path, packed):
+    fresh = str(tmp_path / 'fresh')
+    resumed = str(tmp_path / 'resumed')
+
+    generate_data(get_config(fresh, '--num_sequences', '10', '--packed', packed))
+    generate_data(get_config(resumed, '--num_sequences', '10', '--packed', packed))
+    interrupt_after_first_shard(resumed)
+
+    generate_data(get_config(resumed, '--num_sequences', '10', '--packed', packed, '--resume', 'True',
+                             '--num_workers', '2'))
+
+    for expected, generated in zip(read_dataset(fresh), read_dataset(resumed)):
+        np.testing.assert_array_equal(generated, expected)
+
+
+@pytest.mark.parametrize('packed', ['True', 'False'])
+def test_appended_dataset_equals_fresh_dataset(tmp_path, packed):
+    fresh = str(tmp_path / 'fresh')
+    appended = str(tmp_path / 'appended')
+
+    generate_data(get_config(fresh, '--num_sequences', '14', '--packed', packed))
+    # The last shard of the smaller dataset is incomplete and gets generated again
+    generate_data(get_config(appended, '--num_sequences', '10', '--packed', packed))
+    generate_data(get_config(appended, '--num_sequences', '14', '--packed', packed, '--resume', 'True'))
+
+    for expected, generated in zip(read_dataset(fresh), read_dataset(appended)):
+        np.testing.assert_array_equal(generated, expected)
+
+
+def test_resume_rejects_other_settings(tmp_path):
+    path = str(tmp_path)
+    generate_data(get_config(path, '--num_sequences', '8', '--packed', 'True'))
+
+    with pytest.raises(Exception):
+        generate_data(get_config(path, '--num_sequences', '8', '--packed', 'True', '--resume', 'True',
+                                 '--ball_radius', '3'))
+
+    with pytest.raises(Exception):
+        generate_data(get_config(path, '--num_sequences', '4', '--packed', 'True', '--resume', 'True'))
@@ -0,0 +1,116 @@
+import os
+import threading
+
+import numpy as np
+
+from dl4cv.history import History, Column, CHUNK_SIZE
+
+
+def append_iterations(history, start, num_rows):
+    # Rows whose values tell the iteration they belong to
+    iterations = np.arange(start, start + num_rows, dtype=np.float32)
+    history.append_rows('train_loss', iterations)
+    history.append_rows('kl_divergence_dim_wise', np.stack([iterations, -iterations], axis=1))
+
+
+def assert_iterations(history, num_rows):
+    iterations = np.arange(num_rows, dtype=np.float32)
+    np.testing.assert_array_equal(history['train_loss'], iterations)
+    np.testing.assert_array_equal(history['kl_divergence_dim_wise'], np.stack([iterations, -iterations], axis=1))
+
+
+def test_save_and_load(tmp_path):
+    history = History()
+    # More rows than one chunk holds
+    append_iterations(history, 0, CHUNK_SIZE + 10)
+    history.append({'val_loss': 0.5})
+
+    state = history.save(str(tmp_path))
+    loaded = History.load(state, str(tmp_path))
+
+    assert set(loaded.keys()) == {'train_loss', 'kl_divergence_dim_wise', 'val_loss'}
+    assert_iterations(loaded, CHUNK_SIZE + 10)
+    np.testing.assert_array_equal(loaded['val_loss'], [0.5])
+    np.testing.assert_array_equal(loaded.get('train_loss', 7), np.arange(0, CHUNK_SIZE + 10, 7))
+
+
+def test_append_after_save(tmp_path):
+    history = History()
+    append_iterations(history, 0, 100)
+    first_state = history.save(str(tmp_path))
+
+    append_iterations(history, 100, 50)
+    np.testing.assert_array_equal(history.get('train_loss', 3), np.arange(0, 150, 3))
+    second_state = history.save(str(tmp_path))
+
+    # Both checkpoints share the files, the first one only reads its rows
+    assert first_state['directory'] == second_state['directory']
+    assert_iterations(History.load(first_state, str(tmp_path)), 100)
+    assert_iterations(History.load(second_state, str(tmp_path)), 150)
+
+
+def test_continue_from_earlier_checkpoint(tmp_path):
+    history = History()
+    append_iterations(history, 0, 100)
+    first_state = history.save(str(tmp_path))
+    append_iterations(history, 100, 50)
+    second_state = history.save(str(tmp_path))
+
+    # A second run continues from the first checkpoint and must not change the rows of the second one
+    continued = History.load(first_state, str(tmp_path))
+    append_iterations(continued, 100, 20)
+    continued_state = continued.save(str(tmp_path))
+
+    assert continued_state['directory'] != second_state['directory']
+    assert_iterations(History.load(first_state, str(tmp_path)), 100)
+    assert_iterations(History.load(second_state, str(tmp_path)), 150)
+    assert_iterations(History.load(continued_state, str(tmp_path)), 120)
+
+
+def test_load_dict_of_lists():
+    # Checkpoints before the columnar history stored the lists of every metric
+    state = {'train_loss': [3., 2., 1.], 'posterior_mu': [[0., 1.], [2., 3.]]}
+
+    history = History.load(state, None)
+
+    np.testing.assert_array_equal(history['train_loss'], [3., 2., 1.])
+    np.testing.assert_array_equal(history['posterior_mu'], [[0., 1.], [2., 3.]])
+    assert history.num_rows('posterior_mu') == 2
+
+
+def test_checkpoint_stays_small(tmp_path):
+    history = History()
+    append_iterations(history, 0, 10000)
+
+    state = history.save(str(tmp_path))
+
+    # The state in the checkpoint only holds the lengths, the rows are in the files beside it
+    assert state['lengths'] == {'train_loss': 10000, 'kl_divergence_dim_wise': 10000}
+    assert os.path.getsize(os.path.join(str(tmp_path), state['directory'], 'train_loss.f32')) == 10000 * 4
+
+
+
+def test_rows_appended_during_save_are_kept(tmp_path, monkeypatch):
+    history = History()
+    append_iterations(history, 0, 10)
+
+    open_column = Column.open
+    threads = []
+
+    def open_while_appending(column, path, length):
+        # The MetricLogger thread appends a row after the rows were written but before the column reopens them
+        if len(threads) == 0:
+            threads.append(threading.Thread(target=append_iterations, args=(history, 10, 1)))
+            threads[0].start()
+            threads[0].join(0.2)
+
+        open_column(column, path, length)
+
+    monkeypatch.setattr(Column, 'open', open_while_appending)
+    history.save(str(tmp_path))
+    threads[0].join()
+    monkeypatch.undo()
+
+    state = history.save(str(tmp_path))
+
+    assert_iterations(History.load(state, str(tmp_path)), 11)
@@ -0,0 +1,114 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from dl4cv.dataset.inMemoryLoader import InMemoryLoader
+from dl4cv.dataset.prefetchLoader import PrefetchLoader
+from dl4cv.dataset.utils import CustomDataset
+from test_dataset_utils import create_small_packed_dataset
+
+
+def assert_batches_equal(batches, expected_batches):
+    batches = list(batches)
+    expected_batches = list(expected_batches)
+
+    assert len(batches) == len(expected_batches)
+
+    for batch, expected_batch in zip(batches, expected_batches):
+        for tensor, expected in zip(batch, expected_batch):
+            assert torch.equal(tensor, expected)
+
+
+@pytest.mark.parametrize('ram_format', ['uint8', 'bits', 'float'])
+@pytest.mark.parametrize('drop_last', [True, False])
+def test_in_memory_loader_matches_data_loader(tmp_path, ram_format, drop_last):
+    path = str(tmp_path)
+    create_small_packed_dataset(path, num_sequences=11, window_size=20)
+    dataset = CustomDataset(path, None, 5, 2, load_ground_truth=True, load_to_ram=True, ram_format=ram_format)
+    indices = [7, 2, 9, 0, 4, 10, 3]
+
+    loader = InMemoryLoader(dataset, indices, 3, shuffle=False, drop_last=drop_last)
+    data_loader = DataLoader(dataset, batch_size=3, sampler=indices, drop_last=drop_last)
+
+    assert len(loader) == len(data_loader)
+    assert_batches_equal(loader, data_loader)
+
+
+@pytest.mark.parametrize('num_questions', [1, 3])
+def test_in_memory_loader_targets_match_the_questions(tmp_path, num_questions):
+    path = str(tmp_path)
+    frames, _ = create_small_packed_dataset(path, num_sequences=8)
+    dataset = CustomDataset(path, None, 3, 2, question=True, num_questions=num_questions, load_to_ram=True)
+
+    x, y, question, _ = next(iter(InMemoryLoader(dataset, range(8), 8, shuffle=False)))
+
+    assert question.shape == ((8,) if num_questions == 1 else (8, num_questions))
+    y = y.view(8, num_questions, 2, 32, 32)
+    question = question.view(8, num_questions).long()
+
+    for index in range(8):
+        np.testing.assert_array_equal(x[index].numpy(), frames[index, :3] / np.float32(255))
+
+        for i_question in range(num_questions):
+            t = int(question[index, i_question])
+            np.testing.assert_array_equal(y[index, i_question].numpy(), frames[index, t:t + 2] / np.float32(255))
+
+
+def test_in_memory_loader_needs_the_sequences_in_ram(tmp_path):
+    path = str(tmp_path)
+    create_small_packed_dataset(path)
+
+    with pytest.raises(Exception):
+        InMemoryLoader(CustomDataset(path, None, 5, 1), range(6), 2)
+
+    dataset = CustomDataset(path, None, 5, 1, load_to_ram=True, load_indices=[0, 1, 2])
+
+    with pytest.raises(Exception):
+        list(InMemoryLoader(dataset, range(6), 2, shuffle=False))
+
+
+def get_batches(num_batches=5):
+    return [(torch.rand(2, 5, 8, 8), torch.rand(2, 1, 8, 8), torch.arange(2), 0) for _ in range(num_batches)]
+
+
+@pytest.mark.parametrize('num_prefetch', [0, 1, 3])
+def test_prefetch_loader_passes_batches_through_on_cpu(num_prefetch):
+    batches = get_batches()
+    loader = PrefetchLoader(batches, 'cpu', num_prefetch)
+
+    assert len(loader) == 5
+
+    # Every epoch iterates the wrapped loader again
+    for _ in range(2):
+        prefetched = list(loader)
+
+        assert len(prefetched) == len(batches)
+        for batch, expected in zip(prefetched, batches):
+            assert all(tensor is expected_tensor for tensor, expected_tensor in zip(batch, expected))
+
+
+class FailingLoader(object):
+
+    def __iter__(self):
+        yield get_batches(1)[0]
+        raise OSError('Unreadable batch')
+
+
+def test_prefetch_loader_raises_the_errors_of_the_loader():
+    with pytest.raises(OSError):
+        list(PrefetchLoader(FailingLoader(), 'cpu', 2))
+
+
+def test_prefetch_loader_stops_when_the_loop_breaks():
+    loader = PrefetchLoader(get_batches(100), 'cpu', 2)
+    num_threads = threading.active_count()
+
+    for i_batch, batch in enumerate(loader):
+        if i_batch == 3:
+            break
+
+    # Dropping the generator of the loop closes it, which stops its thread
+    assert threading.active_count() == num_threads
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from dl4cv.history import History
+from dl4cv.metricLogger import MetricLogger
+
+
+def log_iterations(metric_logger, iterations, z_dim=3):
+    """
+    Logs iterations whose metrics tell the iteration they belong to and returns the logged mu and logvar
+    """
+    mus = []
+    logvars = []
+
+    for i_iter in iterations:
+        value = torch.tensor(float(i_iter))
+        dim_wise_kld = torch.arange(z_dim).float() + i_iter
+        mu = torch.rand(4, z_dim)
+        logvar = torch.rand(4, z_dim)
+
+        metric_logger.log(i_iter, value, value + 1, value + 2, value + 3, dim_wise_kld, mu, logvar, 0.01)
+        mus.append(mu.mean(dim=0).numpy())
+        logvars.append(logvar.exp().mean(dim=0).numpy())
+
+    return np.array(mus), np.array(logvars)
+
+
+@pytest.mark.parametrize('flush_after_iters', [1, 7, 100])
+def test_history_gets_the_logged_metrics(flush_after_iters):
+    solver = SimpleNamespace(history=History())
+    metric_logger = MetricLogger(solver, None, 20, log_after_iters=None, flush_after_iters=flush_after_iters)
+
+    mus, variances = log_iterations(metric_logger, range(1, 21))
+    metric_logger.close()
+
+    iterations = np.arange(1, 21, dtype=np.float32)
+    np.testing.assert_array_equal(solver.history['train_loss'], iterations)
+    np.testing.assert_array_equal(solver.history['reconstruction_loss'], iterations + 1)
+    np.testing.assert_array_equal(solver.history['total_kl_divergence'], iterations + 2)
+    np.testing.assert_array_equal(solver.history['kl_divergence_dim_wise'], iterations[:, None] + np.arange(3))
+    np.testing.assert_allclose(solver.history['posterior_mu'], mus, rtol=1e-6)
+    np.testing.assert_allclose(solver.history['posterior_var'], variances, rtol=1e-6)
+
+
+def test_history_downsample():
+    solver = SimpleNamespace(history=History())
+    metric_logger = MetricLogger(solver, None, 20, log_after_iters=None, flush_after_iters=3, history_downsample=5)
+
+    log_iterations(metric_logger, range(1, 21))
+    metric_logger.wait()
+
+    np.testing.assert_array_equal(solver.history['train_loss'], [5, 10, 15, 20])
+    metric_logger.close()
+
+
+def test_metrics_stay_on_the_device_until_the_flush():
+    solver = SimpleNamespace(history=History())
+    metric_logger = MetricLogger(solver, None, 20, log_after_iters=None, flush_after_iters=5)
+
+    log_iterations(metric_logger, range(1, 5))
+    metric_logger.batches.join()
+
+    assert 'train_loss' not in solver.history
+
+    log_iterations(metric_logger, range(5, 6))
+    metric_logger.batches.join()
+
+    assert solver.history.num_rows('train_loss') == 5
+    metric_logger.close()
+
+
+def test_write_errors_are_raised_in_the_training_loop():
+    # The history is missing, writing the first batch fails on the background thread
+    metric_logger = MetricLogger(SimpleNamespace(), None, 20, log_after_iters=None, flush_after_iters=2)
+
+    log_iterations(metric_logger, range(1, 3))
+
+    with pytest.raises(AttributeError):
+        metric_logger.wait()
@@ -0,0 +1,133 @@
+import copy
+
+import pytest
+import torch
+
+from dl4cv.models.models import VariationalAutoEncoder, compile_model
+from dl4cv.utils import benchmark_mixed_precision
+
+
+def get_questions(batch_size, num_questions, missing):
+    shape = (batch_size,) if num_questions is None else (batch_size, num_questions)
+
+    if missing:
+        return torch.full(shape, -1.)
+
+    return torch.randint(-5, 6, shape).float()
+
+
+@pytest.mark.parametrize('use_physics, use_question', [(True, True), (True, False), (False, True), (False, False)])
+@pytest.mark.parametrize('num_questions', [None, 3])
+@pytest.mark.parametrize('missing', [True, False])
+def test_bottleneck_modes_match_per_batch_check(use_physics, use_question, num_questions, missing):
+    if not use_question and not missing:
+        pytest.skip('Models without questions only get batches without questions')
+    if use_question and not use_physics and missing:
+        pytest.skip('Questions models without physics need questions for the size of the decoder input')
+    if use_question and num_questions is not None and missing:
+        pytest.skip('Only datasets with questions have several questions per sample')
+
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2 if use_physics else 7,
+                                   use_physics=use_physics, use_question=use_question)
+    # Models saved before the modes existed decide per batch
+    legacy_model = copy.deepcopy(model)
+    legacy_model.use_question = None
+
+    z_encoder = torch.randn(8, 6)
+    q = get_questions(8, num_questions, missing)
+
+    assert torch.equal(model.bottleneck(z_encoder, q), legacy_model.bottleneck(z_encoder, q))
+
+
+def test_physics_without_questions_predicts_one_step_ahead():
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=True)
+    z_encoder = torch.randn(8, 6)
+
+    z_decoder = model.bottleneck(z_encoder, torch.full((8,), -1.))
+
+    assert torch.equal(z_decoder, model.physics_layer(z_encoder, torch.ones(8)))
+
+
+@pytest.mark.parametrize('mixed_precision', [False, True])
+def test_forward_does_not_look_up_the_parameters(mixed_precision, monkeypatch):
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    model.set_mixed_precision(mixed_precision)
+
+    def parameters(*args, **kwargs):
+        raise AssertionError('The forward pass looked up the parameters')
+
+    monkeypatch.setattr(model, 'parameters', parameters)
+
+    y, (mu, logvar) = model(torch.rand(2, 5, 64, 64))
+
+    assert y.dtype == torch.float32 and y.shape == (2, 1, 64, 64)
+
+
+def test_compiled_encode_and_decode_match_the_model(tmp_path):
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    model.eval()
+    compiled = compile_model(model, ['encode', 'decode'])
+    x = torch.rand(2, 5, 64, 64)
+
+    with torch.no_grad():
+        _, mu, logvar = compiled.encode(x)
+        _, expected_mu, expected_logvar = model.encode(x)
+        assert torch.allclose(mu, expected_mu, atol=1e-5) and torch.allclose(logvar, expected_logvar, atol=1e-5)
+        assert torch.allclose(compiled.decode(mu[:, :2]), model.decode(mu[:, :2]), atol=1e-5)
+
+    # The compiled methods stay on the compiled model, the model itself can still be saved
+    assert 'encode' not in vars(model) and 'decode' not in vars(model)
+    model.save(str(tmp_path / 'model'))
+
+
+@pytest.mark.parametrize('use_physics', [True, False])
+def test_several_questions_match_single_questions(use_physics):
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 2, z_dim_encoder=6, z_dim_decoder=2 if use_physics else 7,
+                                   use_physics=use_physics, use_question=True)
+    model.eval()
+    x = torch.rand(4, 5, 64, 64)
+    q = get_questions(4, 3, missing=False)
+
+    # The encoder samples z, every call has to draw the same noise
+    torch.manual_seed(1)
+    y, (mu, logvar) = model(x, q)
+
+    assert y.shape == (4, 3, 2, 64, 64)
+
+    for i_question in range(3):
+        torch.manual_seed(1)
+        y_single, (mu_single, _) = model(x, q[:, i_question])
+
+        assert torch.allclose(y[:, i_question], y_single, atol=1e-5)
+        assert torch.equal(mu, mu_single)
+
+
+def test_mixed_precision_stays_close_to_float32():
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    x = torch.rand(2, 5, 64, 64)
+
+    torch.manual_seed(1)
+    y, (mu, logvar) = model(x)
+    model.set_mixed_precision(True)
+    torch.manual_seed(1)
+    y_bf16, (mu_bf16, logvar_bf16) = model(x)
+
+    # The sampling and the outputs stay in float32
+    assert y_bf16.dtype == mu_bf16.dtype == logvar_bf16.dtype == torch.float32
+    assert torch.allclose(mu_bf16, mu, atol=0.05) and torch.allclose(y_bf16, y, atol=0.1)
+
+
+def test_benchmark_leaves_the_model_unchanged():
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    parameters = copy.deepcopy(model.state_dict())
+
+    times = benchmark_mixed_precision(model, torch.rand(2, 5, 64, 64), torch.full((2,), -1.), num_iters=1)
+
+    assert len(times) == 2 and all(t > 0 for t in times)
+    assert not getattr(model, 'mixed_precision', False)
+    assert all(parameter.grad is None for parameter in model.parameters())
+    assert all(torch.equal(model.state_dict()[key], value) for key, value in parameters.items())
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import torch
+
+from dl4cv.dataset.generateDataset import get_argument_parser, generate_data
+from dl4cv.dataset.proceduralDataset import ProceduralDataset, get_generator_config
+from dl4cv.dataset.utils import CustomDataset, open_packed_frames
+
+
+def generate_packed_dataset(path):
+    config = get_argument_parser().parse_args(['--save_dir_path', path, '--eval_before_saving', 'False',
+                                               '--num_sequences', '6', '--len_sequence', '6', '--shard_size', '1',
+                                               '--packed', 'True', '--resolutions', '16'])
+    generate_data(config)
+
+
+def test_sequences_match_the_generated_dataset(tmp_path):
+    path = str(tmp_path)
+    generate_packed_dataset(path)
+
+    generated = CustomDataset(path, None, 5, 1, load_ground_truth=True)
+    procedural = ProceduralDataset(get_generator_config(path), 6, 5, 1, load_ground_truth=True)
+
+    assert len(procedural) == 6
+    np.testing.assert_array_equal(procedural.get_ground_truths(), generated.get_ground_truths())
+
+    # In reverse order, so no sequence comes from the cache of the previous one
+    for index in reversed(range(6)):
+        for expected, sample in zip(generated[index], procedural[index]):
+            if torch.is_tensor(expected):
+                assert torch.equal(sample, expected)
+            else:
+                np.testing.assert_array_equal(sample, expected)
+
+    procedural.set_resolution(16)
+    np.testing.assert_array_equal(procedural.get_packed_sequence(4), open_packed_frames(path, resolution=16)[4])
+
+
+def test_sampling_keeps_the_random_state():
+    dataset = ProceduralDataset(get_generator_config(), 10, 5, 1)
+    torch.manual_seed(0)
+    state = torch.get_rng_state()
+
+    x, y, _, _ = dataset[3]
+
+    assert torch.equal(torch.get_rng_state(), state)
+    # Another dataset instance renders the same sequence
+    assert torch.equal(ProceduralDataset(get_generator_config(), 10, 5, 1)[3][0], x)
+
+
+def test_generator_config_overrides(tmp_path):
+    path = str(tmp_path)
+    generate_packed_dataset(path)
+
+    config = get_generator_config(path, {'ball_radius': 3})
+
+    assert config.ball_radius == 3
+    # The rest comes from the config of the dataset instead of the defaults
+    assert config.len_sequence == 6 and config.shard_size == 1
+
+    with pytest.raises(Exception):
+        get_generator_config(path, {'ball_radus': 3})
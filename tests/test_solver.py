@@ -0,0 +1,157 @@
+import os
+import socket
+import time
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, TensorDataset
+
+import dl4cv.solver
+from dl4cv.metricLogger import MetricLogger
+from dl4cv.models.models import VariationalAutoEncoder
+from dl4cv.solver import Solver
+
+# Seconds the patched mixed precision benchmark takes
+BENCHMARK_SECONDS = 3
+
+
+def get_loader(num_samples=8, batch_size=2, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.rand(num_samples, 5, 64, 64, generator=generator)
+    y = torch.rand(num_samples, 1, 64, 64, generator=generator)
+    # No questions
+    question = torch.full((num_samples,), -1.)
+    ground_truth = torch.zeros(num_samples, 6, 6)
+
+    return DataLoader(TensorDataset(x, y, question, ground_truth), batch_size=batch_size, drop_last=True)
+
+
+def train_solver(save_path, solver=None, **kwargs):
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    solver = solver if solver is not None else Solver()
+
+    solver.train(model=model,
+                 train_config={},
+                 dataset_config={},
+                 tensorboard_path=os.path.join(save_path, 'tensorboard'),
+                 optim=torch.optim.Adam(model.parameters(), lr=1e-3),
+                 train_loader=kwargs.pop('train_loader', get_loader()),
+                 val_loader=kwargs.pop('val_loader', get_loader(seed=1)),
+                 log_after_iters=None,
+                 save_path=save_path,
+                 log_reconstructed_images=False,
+                 **kwargs)
+
+    return solver, model
+
+
+@pytest.mark.parametrize('validate_after_epochs, validate_after_iters, val_iterations', [
+    (1, None, [4, 8]),
+    (2, None, [8]),
+    (None, 3, [3, 6]),
+    (1, 3, [3, 4, 6, 8])
+])
+def test_validation_cadence(tmp_path, validate_after_epochs, validate_after_iters, val_iterations):
+    # 4 iterations per epoch
+    solver, _ = train_solver(str(tmp_path), num_epochs=2, validate_after_epochs=validate_after_epochs,
+                             validate_after_iters=validate_after_iters)
+
+    np.testing.assert_array_equal(solver.history['val_iteration'], val_iterations)
+    assert solver.history.num_rows('val_loss') == len(val_iterations)
+
+
+def test_validate_returns_the_loss_per_target(tmp_path):
+    solver, model = train_solver(str(tmp_path), num_epochs=1)
+    num_rows = solver.history.num_rows('val_loss')
+    # The last batch isn't full
+    val_loader = DataLoader(get_loader(num_samples=7, seed=1).dataset, batch_size=3)
+
+    model.train()
+    # The encoder samples z, both passes have to draw the same noise
+    torch.manual_seed(2)
+    val_loss = solver.validate(model, val_loader, 10)
+
+    assert not model.training
+
+    torch.manual_seed(2)
+    with torch.no_grad():
+        expected = sum(F.binary_cross_entropy_with_logits(model(x, question)[0], y, reduction='sum')
+                       for x, y, question, _ in val_loader) / 7
+
+    assert abs(val_loss - expected.item()) < 1e-3 * expected.item()
+    assert solver.history.num_rows('val_loss') == num_rows + 1
+    assert solver.history['val_iteration'][-1] == 10
+
+
+def train_distributed(rank, world_size, port, save_path, results):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+
+    def benchmark_mixed_precision(model, x, question):
+        time.sleep(BENCHMARK_SECONDS)
+        return 1., 1.
+
+    # Spawned processes don't see the monkeypatches of the test
+    dl4cv.solver.benchmark_mixed_precision = benchmark_mixed_precision
+    log = MetricLogger.log
+
+    def log_iteration_time(self, i_iter, *args):
+        results[('t_iter', rank, i_iter)] = args[-1]
+        log(self, i_iter, *args)
+
+    MetricLogger.log = log_iteration_time
+
+    try:
+        # Every process trains on other batches
+        solver, model = train_solver(save_path, num_epochs=1, mixed_precision=True, train_loader=get_loader(seed=rank),
+                                     val_loader=get_loader(num_samples=4, seed=2 + rank))
+        results[('parameters', rank)] = torch.cat([p.detach().view(-1) for p in model.parameters()]).numpy()
+        results[('val_loss', rank)] = solver.history['val_loss']
+    finally:
+        dist.destroy_process_group()
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def distributed_results(tmp_path_factory):
+    # Spawning the processes takes a while, all distributed tests share one run
+    results = torch.multiprocessing.Manager().dict()
+
+    torch.multiprocessing.spawn(train_distributed, args=(2, get_free_port(), str(tmp_path_factory.mktemp('saves')),
+                                                         results), nprocs=2)
+
+    return dict(results)
+
+
+def test_benchmark_does_not_delay_the_other_processes(distributed_results):
+    iteration_times = [value for key, value in distributed_results.items() if key[0] == 't_iter']
+
+    # Rank 0 benchmarks before its first iteration, neither process counts the benchmark in that iteration
+    assert len(iteration_times) == 2 * 4
+    assert all(t_iter < BENCHMARK_SECONDS for t_iter in iteration_times)
+
+
+def test_distributed_processes_keep_the_same_parameters(distributed_results):
+    # The model that train_solver starts from
+    torch.manual_seed(0)
+    model = VariationalAutoEncoder(5, 1, z_dim_encoder=6, z_dim_decoder=2, use_physics=True, use_question=False)
+    initial = torch.cat([p.detach().view(-1) for p in model.parameters()]).numpy()
+
+    parameters = distributed_results[('parameters', 0)]
+
+    # The gradients are averaged, so both processes take the same steps
+    np.testing.assert_array_equal(distributed_results[('parameters', 1)], parameters)
+    assert not np.array_equal(parameters, initial)
+    # The validation loss is reduced over both processes
+    np.testing.assert_array_equal(distributed_results[('val_loss', 0)], distributed_results[('val_loss', 1)])